@@ -0,0 +1,372 @@
+import os, csv, json, lzma, zlib, struct, sqlite3, datetime, threading, time, argparse
+
+import numpy as np
+
+from storage import FrameGap, SQL_TIME_FORMAT
+
+ARCHIVE_FORMAT = 'msl-archive'
+ARCHIVE_VERSION = 1
+ARCHIVE_EXT = '.msa'
+ARCHIVE_MAGIC = b'MSLA'
+ARCHIVE_CODECS = ('zlib', 'lzma')
+ARCHIVE_CODEC = 'zlib'
+ARCHIVE_LEVELS = {'zlib': 6, 'lzma': 6}
+ARCHIVE_BLOCK_ROWS = 8192
+ARCHIVE_CACHE_BLOCKS = 32 # decoded field blocks kept by a reader
+
+# sqlite column prefix of each array field, see storage.AioDataTable and ringbuffer.frame_dtype
+_SQL_GROUPS = (('ai_raw', 'ai_raw_', np.int16), ('ai_phy', 'ai_phy_', np.float32), ('ao_raw', 'ao_raw_', np.uint16), ('ao_phy', 'ao_phy_', np.float32), ('param', 'param_phy_', np.float32))
+_TRAILER = struct.Struct('<Q4s') # index offset, magic
+
+def _unsigned(dtype:np.dtype) -> np.dtype:
+    return np.dtype('u%d'%dtype.itemsize)
+
+def _signed(dtype:np.dtype) -> np.dtype:
+    return np.dtype('i%d'%dtype.itemsize)
+
+def _compress(data:bytes, codec:str, level:int) -> bytes:
+    return zlib.compress(data, level) if codec == 'zlib' else lzma.compress(data, preset=level)
+
+def _decompress(data:bytes, codec:str) -> bytes:
+    return zlib.decompress(data) if codec == 'zlib' else lzma.decompress(data)
+
+def _encode(values:np.ndarray, codec:str, level:int) -> bytes:
+    # channel major; integers as zigzag deltas (modulo their width, so any int16
+    # step fits), then the bytes of each significance grouped: slowly changing
+    # signals leave runs of zero high bytes that the codec squeezes out
+    _a = np.ascontiguousarray(values.reshape(len(values), -1).T)
+    if _a.dtype.kind in 'iu':
+        _u = _a.view(_unsigned(_a.dtype))
+        _d = np.diff(_u, axis=1, prepend=np.zeros((_u.shape[0], 1), dtype=_u.dtype)).view(_signed(_a.dtype))
+        _a = ((_d << 1) ^ (_d >> (8*_a.dtype.itemsize - 1))).view(_u.dtype)
+    _bytes = np.ascontiguousarray(_a).view(np.uint8).reshape(-1, _a.dtype.itemsize).T
+    return _compress(_bytes.tobytes(), codec, level)
+
+def _decode(data:bytes, codec:str, dtype:np.dtype, shape:tuple, rows:int) -> np.ndarray:
+    _stored = _unsigned(dtype) if dtype.kind in 'iu' else dtype
+    _bytes = np.frombuffer(_decompress(data, codec), dtype=np.uint8).reshape(_stored.itemsize, -1)
+    _a = np.ascontiguousarray(_bytes.T).view(_stored).reshape(-1, rows)
+    if dtype.kind in 'iu':
+        _d = (_a >> 1) ^ (0 - (_a & 1))
+        _a = np.cumsum(_d, axis=1, dtype=_stored).view(dtype)
+    return np.ascontiguousarray(_a.T).reshape((rows,)+shape)
+
+def _times_ns(times:list[str]) -> np.ndarray:
+    # session times are local wall clock text; one UTC offset per block unless
+    # the block crosses a DST change
+    _naive = np.array(times, dtype='datetime64[us]').astype(np.int64)
+    _offsets = {int(datetime.datetime.fromisoformat(times[i]).timestamp()*1E6) - int(_naive[i]) for i in (0, -1)}
+    if len(_offsets) == 1:
+        return (_naive + _offsets.pop()) * 1000
+    return np.array([int(datetime.datetime.fromisoformat(t).timestamp()*1E6) for t in times], dtype=np.int64) * 1000
+
+def _time_str(time_ns:int) -> str:
+    return datetime.datetime.fromtimestamp(time_ns/1E9).strftime(SQL_TIME_FORMAT)
+
+def _sqlite_source(path:str, block_rows:int):
+    # (fields, gaps, blocks) of a session file; blocks are read lazily by id
+    _conn = sqlite3.connect('file:%s?mode=ro'%path, uri=True)
+    _columns = [r[1] for r in _conn.execute('PRAGMA table_info(data)').fetchall()]
+    _select = ['time'] + [c for c in ('seq', 'mono_ns') if c in _columns]
+    _fields = [('time_ns', np.dtype(np.int64), ())] + [(c, np.dtype(np.int64), ()) for c in _select[1:]]
+    _groups = []
+    for name, _prefix, _dtype in _SQL_GROUPS:
+        _group = [c for c in _columns if c.startswith(_prefix) and c[len(_prefix):].isdigit()]
+        if _group:
+            _groups.append((name, len(_select), len(_group), np.dtype(_dtype)))
+            _fields.append((name, np.dtype(_dtype), (len(_group),)))
+            _select += _group
+    _gaps = []
+    if _conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'gaps'").fetchone():
+        for r in _conn.execute('SELECT seq, frames, time, end_time, mono_ns FROM gaps ORDER BY seq').fetchall():
+            _ns = _times_ns([r[2], r[3]])
+            _gaps.append(FrameGap(r[0], r[1], int(_ns[0]), r[4], int(_ns[1])))
+    _sql = 'SELECT id, %s FROM data WHERE id > ? ORDER BY id LIMIT ?'%', '.join(_select)
+
+    def _blocks():
+        try:
+            _last = 0
+            while True:
+                _rows = _conn.execute(_sql, (_last, block_rows)).fetchall()
+                if not _rows:
+                    return
+                _last = _rows[-1][0]
+                _values = list(zip(*_rows))
+                ret = {'time_ns': _times_ns(_values[1])}
+                for i, name in enumerate(_select[1:3]):
+                    if name in ('seq', 'mono_ns'):
+                        ret[name] = np.array(_values[2+i], dtype=np.int64)
+                for name, _first, _n, _dtype in _groups:
+                    # float columns may hold NULL (nan); raw columns never do
+                    _block = np.array(_values[1+_first:1+_first+_n], dtype=np.float64 if _dtype.kind == 'f' else np.int64)
+                    ret[name] = _block.T.astype(_dtype)
+                yield ret
+        finally:
+            _conn.close()
+
+    return _fields, _gaps, _blocks()
+
+def _columnar_source(path:str, block_rows:int):
+    from columnar import ColumnarReader
+    _reader = ColumnarReader(path)
+    _fields = [(name, a.dtype, a.shape[1:]) for name, a in _reader.read(None, 0, 0).items()]
+
+    def _blocks():
+        with _reader:
+            for _start in range(0, len(_reader), block_rows):
+                yield _reader.read(None, _start, _start + block_rows)
+
+    return _fields, _reader.gaps, _reader.meta, _blocks()
+
+def archive_path(path:str) -> str:
+    # 20240101120000.001.sqlite3 -> 20240101120000.001.msa
+    return os.path.splitext(path.rstrip('/\\'))[0] + ARCHIVE_EXT
+
+def source_size(path:str) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return sum(os.path.getsize(p) for p in (path, path+'-wal') if os.path.exists(p))
+
+def archive_session(path:str, out_path:str|None=None, meta:dict|None=None, codec:str=ARCHIVE_CODEC, level:int|None=None, block_rows:int=ARCHIVE_BLOCK_ROWS) -> dict:
+    # Compresses a closed session file (.sqlite3) or directory (.msl) into one
+    # archive file; runs in worker processes. The archive is written under a
+    # temporary name and renamed when complete, the source is left alone.
+    if codec not in ARCHIVE_CODECS or block_rows <= 0:
+        raise ValueError('Invalid archive settings')
+    _level = ARCHIVE_LEVELS[codec] if level is None else level
+    _out = out_path or archive_path(path)
+    if os.path.exists(_out):
+        raise FileExistsError(_out)
+    if os.path.isdir(path):
+        _fields, _gaps, _meta, _blocks = _columnar_source(path, block_rows)
+        _meta = meta if meta is not None else _meta
+    else:
+        _fields, _gaps, _blocks = _sqlite_source(path, block_rows)
+        _meta = meta or {}
+
+    _index = {
+        'format': ARCHIVE_FORMAT,
+        'version': ARCHIVE_VERSION,
+        'created': datetime.datetime.now().isoformat(),
+        'source': os.path.basename(path.rstrip('/\\')),
+        'codec': codec,
+        'fields': [{'name': name, 'dtype': _dtype.str, 'shape': list(_shape)} for name, _dtype, _shape in _fields],
+        'rows': 0,
+        'blocks': [], # {rows, first_ns, last_ns, first_seq, offsets: {field: [offset, length]}}
+        'gaps': [list(g) for g in _gaps],
+        'meta': _meta,
+    }
+    _tmp = _out + '.tmp'
+    _started = time.perf_counter()
+    with open(_tmp, 'wb') as f:
+        f.write(ARCHIVE_MAGIC)
+        for _block in _blocks:
+            _rows = len(_block['time_ns'])
+            if not _rows:
+                continue
+            _offsets = {}
+            for name, _dtype, _shape in _fields:
+                _data = _encode(np.asarray(_block[name], dtype=_dtype), codec, _level)
+                _offsets[name] = [f.tell(), len(_data)]
+                f.write(_data)
+            _index['blocks'].append({'rows': _rows, 'first_ns': int(_block['time_ns'][0]), 'last_ns': int(_block['time_ns'][-1]),
+                                     'first_seq': int(_block['seq'][0]) if 'seq' in _block else None, 'offsets': _offsets})
+            _index['rows'] += _rows
+        _offset = f.tell()
+        f.write(zlib.compress(json.dumps(_index).encode()))
+        f.write(_TRAILER.pack(_offset, ARCHIVE_MAGIC))
+    os.replace(_tmp, _out)
+    return {'path': _out, 'rows': _index['rows'], 'source_bytes': source_size(path), 'bytes': os.path.getsize(_out), 'seconds': time.perf_counter() - _started}
+
+class ArchiveReader():
+    # Read side of archive_session(), the same calls as columnar.ColumnarReader.
+    # Only the blocks of the requested fields and rows are decompressed; the
+    # index holds every block's time range, so a time window costs a bisection.
+    def __init__(self, path:str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'rb')
+        try:
+            self._file.seek(-_TRAILER.size, os.SEEK_END)
+            _offset, _magic = _TRAILER.unpack(self._file.read(_TRAILER.size))
+            if _magic != ARCHIVE_MAGIC:
+                raise ValueError('Not a session archive: %s'%path)
+            self._file.seek(_offset)
+            self._index = json.loads(zlib.decompress(self._file.read(os.path.getsize(path) - _TRAILER.size - _offset)))
+        except Exception:
+            self._file.close()
+            raise
+        if self._index.get('format') != ARCHIVE_FORMAT:
+            self._file.close()
+            raise ValueError('Not a session archive: %s'%path)
+        self._fields = {f['name']: (np.dtype(f['dtype']), tuple(f['shape'])) for f in self._index['fields']}
+        self._blocks = self._index['blocks']
+        self._starts = np.cumsum([0] + [b['rows'] for b in self._blocks])
+        self._last_ns = np.array([b['last_ns'] for b in self._blocks], dtype=np.int64)
+        self._cache: dict[tuple[str, int], np.ndarray] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self) -> int:
+        return int(self._index['rows'])
+
+    def close(self):
+        self._file.close()
+        self._cache = {}
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def source(self) -> str:
+        return self._index['source']
+
+    @property
+    def codec(self) -> str:
+        return self._index['codec']
+
+    @property
+    def meta(self) -> dict:
+        return self._index.get('meta', {})
+
+    @property
+    def fields(self) -> list[str]:
+        return list(self._fields)
+
+    @property
+    def gaps(self) -> list[FrameGap]:
+        return [FrameGap(*g) for g in self._index.get('gaps', [])]
+
+    @property
+    def blocks(self) -> list[dict]:
+        return [{k: v for k, v in b.items() if k != 'offsets'} for b in self._blocks]
+
+    def _check(self, fields:list[str]|None) -> list[str]:
+        _fields = list(self._fields) if fields is None else fields
+        for name in _fields:
+            if name not in self._fields:
+                raise ValueError('Invalid field: %s'%name)
+        return _fields
+
+    def _block(self, name:str, block:int) -> np.ndarray:
+        _key = (name, block)
+        ret = self._cache.get(_key)
+        if ret is not None:
+            return ret
+        _offset, _length = self._blocks[block]['offsets'][name]
+        with self._lock:
+            self._file.seek(_offset)
+            _data = self._file.read(_length)
+        _dtype, _shape = self._fields[name]
+        ret = _decode(_data, self.codec, _dtype, _shape, self._blocks[block]['rows'])
+        if len(self._cache) >= ARCHIVE_CACHE_BLOCKS:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[_key] = ret
+        return ret
+
+    def iter_blocks(self, fields:list[str]|None=None, start:int=0, stop:int|None=None):
+        # yields (first row index, {field: array}) block by block
+        _fields = self._check(fields)
+        _stop = len(self) if stop is None else min(stop, len(self))
+        _index = max(0, start)
+        while _index < _stop:
+            _block = int(np.searchsorted(self._starts, _index, side='right')) - 1
+            _offset = _index - int(self._starts[_block])
+            _n = min(_stop - _index, self._blocks[_block]['rows'] - _offset)
+            yield _index, {name: self._block(name, _block)[_offset:_offset+_n] for name in _fields}
+            _index += _n
+
+    def read(self, fields:list[str]|None=None, start:int=0, stop:int|None=None) -> dict[str, np.ndarray]:
+        _fields = self._check(fields)
+        _parts = [views for _, views in self.iter_blocks(_fields, start, stop)]
+        if len(_parts) == 1:
+            return _parts[0]
+        if not _parts:
+            return {name: np.empty((0,)+self._fields[name][1], dtype=self._fields[name][0]) for name in _fields}
+        return {name: np.concatenate([p[name] for p in _parts]) for name in _fields}
+
+    def index_at(self, time_ns:int) -> int:
+        # first row with time_ns >= the given time, rows are in time order
+        _block = int(np.searchsorted(self._last_ns, time_ns, side='left'))
+        if _block >= len(self._blocks):
+            return len(self)
+        return int(self._starts[_block]) + int(np.searchsorted(self._block('time_ns', _block), time_ns, side='left'))
+
+    def window_by_time(self, fields:list[str]|None=None, start_ns:int|None=None, stop_ns:int|None=None) -> dict[str, np.ndarray]:
+        _start = 0 if start_ns is None else self.index_at(start_ns)
+        _stop = None if stop_ns is None else self.index_at(stop_ns)
+        return self.read(fields, _start, _stop)
+
+def _csv_columns(reader:ArchiveReader) -> list[tuple[str, str, int|None]]:
+    # (header, field, channel) in session column order
+    _prefixes = {name: prefix for name, prefix, _ in _SQL_GROUPS}
+    ret = [('time', 'time_ns', None)]
+    for name in reader.fields:
+        _shape = reader._fields[name][1]
+        if name == 'time_ns':
+            continue
+        if _shape:
+            ret += [('%s%d'%(_prefixes.get(name, name+'_'), ch), name, ch) for ch in range(_shape[0])]
+        else:
+            ret.append((name, name, None))
+    return ret
+
+def write_csv(reader:ArchiveReader, out_path:str, start_ns:int|None=None, stop_ns:int|None=None) -> int:
+    if os.path.exists(out_path):
+        raise FileExistsError(out_path)
+    _columns = _csv_columns(reader)
+    _start = 0 if start_ns is None else reader.index_at(start_ns)
+    _stop = None if stop_ns is None else reader.index_at(stop_ns)
+    _count = 0
+    with open(out_path, 'w', newline='') as f:
+        _writer = csv.writer(f)
+        _writer.writerow([c[0] for c in _columns])
+        for _, _views in reader.iter_blocks(None, _start, _stop):
+            _lists = {name: v.tolist() for name, v in _views.items() if name != 'time_ns'}
+            _cells = [[_time_str(t) for t in _views['time_ns'].tolist()] if field == 'time_ns' else _lists[field] if ch is None else [r[ch] for r in _lists[field]] for _, field, ch in _columns]
+            _writer.writerows(zip(*_cells))
+            _count += len(_views['time_ns'])
+    return _count
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive a closed session, or inspect and read an archive (%s)'%ARCHIVE_EXT)
+    parser.add_argument('path', help='session file (.sqlite3), columnar session (.msl) or archive')
+    parser.add_argument('--codec', choices=ARCHIVE_CODECS, default=ARCHIVE_CODEC, help='block compression')
+    parser.add_argument('--block-rows', type=int, default=ARCHIVE_BLOCK_ROWS, help='rows per compressed block')
+    parser.add_argument('--to', choices=('csv', 'sqlite'), default=None, help='read an archive back')
+    parser.add_argument('--start', default=None, help='csv from this time, ISO 8601')
+    parser.add_argument('--end', default=None, help='csv until this time, ISO 8601')
+    parser.add_argument('--out', default=None, help='output file (default: next to the input)')
+    args = parser.parse_args()
+
+    if not args.path.endswith(ARCHIVE_EXT):
+        _result = archive_session(args.path, args.out, codec=args.codec, block_rows=args.block_rows)
+        print('Archived %d rows to %s in %.2f s, %.1f MB -> %.1f MB (%.1fx)'%(_result['rows'], _result['path'], _result['seconds'], _result['source_bytes']/1E6, _result['bytes']/1E6, _result['source_bytes']/max(1, _result['bytes'])))
+        return
+
+    with ArchiveReader(args.path) as _reader:
+        if args.to is None:
+            _blocks = _reader.blocks
+            print('%s: %d rows in %d blocks (%s), from %s'%(args.path, len(_reader), len(_blocks), _reader.codec, _reader.source))
+            if _blocks:
+                print('from %s to %s'%(_time_str(_blocks[0]['first_ns']), _time_str(_blocks[-1]['last_ns'])))
+            if _reader.gaps:
+                print('%d frames missing in %d gaps'%(sum(g.frames for g in _reader.gaps), len(_reader.gaps)))
+            return
+        _started = time.perf_counter()
+        _out = args.out or os.path.splitext(args.path)[0] + ('.csv' if args.to == 'csv' else '.restored.sqlite3')
+        if args.to == 'csv':
+            _ns = lambda t: None if t is None else int(datetime.datetime.fromisoformat(t).timestamp()*1E9)
+            _count = write_csv(_reader, _out, _ns(args.start), _ns(args.end))
+        else:
+            from columnar import convert_to_sqlite
+            _count = convert_to_sqlite(_reader, _out)
+        print('Wrote %d rows to %s in %.2f s'%(_count, _out, time.perf_counter() - _started))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+import os, sys, json, time, signal, socket, asyncio, platform, argparse, datetime, tempfile, threading, subprocess
+import urllib.request, urllib.error
+
+import numpy as np
+import psutil
+import websockets
+
+import pymodbus
+from pymodbus import FramerType
+from pymodbus.server import ModbusTcpServer
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+
+BENCH_FORMAT_VERSION = 1
+BENCH_HOST = '127.0.0.1'
+BENCH_MODES = ('TCP', 'RTU_OVER_TCP')
+BENCH_INTERVALS_MS = (100, 50, 20, 10, 5, 2, 1)
+BENCH_STEP_S = 5.0
+BENCH_WARMUP_S = 2.0
+BENCH_FANOUT_CLIENTS = (0, 1, 4, 16)
+BENCH_FANOUT_INTERVAL_MS = 10
+BENCH_SOAK_S = 60.0
+BENCH_SOAK_SAMPLE_S = 1.0
+BENCH_LOSS_LIMIT = 0.01 # missed or failed ticks still counted as sustained
+BENCH_START_TIMEOUT_S = 20.0
+# same layout as the README example: a Trio and a Quartet behind one gateway
+BENCH_DEVICES = [
+    {'name': 'trio', 'slave': 1, 'ai': [0, 8], 'ao': [0, 4]},
+    {'name': 'quartet', 'slave': 2, 'ai': [8, 8], 'ao': [4, 4]},
+]
+BENCH_HEADLESS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'headless.py')
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind((BENCH_HOST, 0))
+        return s.getsockname()[1]
+
+def _percentiles(values, scale:float=1.0) -> dict:
+    if len(values) == 0:
+        return {'count': 0}
+    _v = np.asarray(values, dtype=np.float64) * scale
+    return {'count': len(_v), 'p50': float(np.percentile(_v, 50)), 'p90': float(np.percentile(_v, 90)), 'p99': float(np.percentile(_v, 99)), 'max': float(_v.max())}
+
+class _RampBlock(ModbusSequentialDataBlock):
+    # Input registers that change on every read. The first register counts the
+    # reads and, when stamps is given, the time each count was served is kept so
+    # a value seen by a WebSocket client can be traced back to the slave.
+    def __init__(self, count:int, stamps:list|None=None):
+        super().__init__(0, [0] * count)
+        self._stamps = stamps
+        self._seq = 0
+
+    def getValues(self, address, count=1):
+        self._seq = (self._seq + 1) & 0x7fff
+        if self._stamps is not None:
+            self._stamps[self._seq] = time.perf_counter_ns()
+        self.values = [self._seq] + [(self._seq * (i + 1)) & 0x7fff for i in range(1, len(self.values))]
+        return super().getValues(address, count)
+
+class SimulatedSlave():
+    # pymodbus server with one unit per device of the logger config, on its own
+    # thread and event loop
+    def __init__(self, devices:list[dict]=BENCH_DEVICES, mode:str='TCP', port:int|None=None):
+        if mode not in BENCH_MODES:
+            raise ValueError('Invalid mode: %s'%mode)
+        self.mode = mode
+        self.port = port or _free_port()
+        self.stamps = [0] * 0x8000
+        _slaves = {}
+        for dev in devices:
+            _ai_count = int(dev['ai'][1]) + int(dev.get('ai_address', 0))
+            _ao_count = int(dev['ao'][1]) + int(dev.get('ao_address', 0))
+            _stamps = self.stamps if int(dev['ai'][0]) == 0 else None
+            _slaves[int(dev['slave'])] = ModbusSlaveContext(ir=_RampBlock(max(1, _ai_count), _stamps), hr=ModbusSequentialDataBlock(0, [0] * max(1, _ao_count)), zero_mode=True)
+        self._context = ModbusServerContext(slaves=_slaves, single=False)
+        self._server = None
+        self._loop = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    def config_devices(self, devices:list[dict]=BENCH_DEVICES) -> list[dict]:
+        return [dict(dev, mode=self.mode, host=BENCH_HOST, port=self.port) for dev in devices]
+
+    def start(self):
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._serve()), daemon=True)
+        self._thread.name = 'SimulatedSlave'
+        self._thread.start()
+        if not self._ready.wait(BENCH_START_TIMEOUT_S):
+            raise RuntimeError('Simulated slave did not start')
+
+    async def _serve(self):
+        _framer = FramerType.SOCKET if self.mode == 'TCP' else FramerType.RTU
+        self._server = ModbusTcpServer(self._context, framer=_framer, address=(BENCH_HOST, self.port))
+        self._loop = asyncio.get_running_loop()
+        self._loop.call_later(0.2, self._ready.set)
+        await self._server.serve_forever()
+
+    def stop(self):
+        if self._loop and self._server:
+            asyncio.run_coroutine_threadsafe(self._server.shutdown(), self._loop).result(5.0)
+        if self._thread:
+            self._thread.join(5.0)
+            self._thread = None
+
+class LoggerProcess():
+    # headless.py in its own process, as it runs on the shop floor, with its
+    # config, sessions and output in a scratch directory
+    def __init__(self, workdir:str, devices:list[dict], acquire_ms:int, publish_ms:int|None=None, backend:str='sqlite'):
+        self.workdir = workdir
+        self.port = _free_port()
+        self.url = 'http://%s:%d'%(BENCH_HOST, self.port)
+        self.ws_url = 'ws://%s:%d/ws'%(BENCH_HOST, self.port)
+        self._config_path = os.path.join(workdir, 'config.json')
+        with open(self._config_path, 'w') as f:
+            json.dump({'devices': devices}, f)
+        self._args = [sys.executable, BENCH_HEADLESS_PATH, '--config', self._config_path, '--host', BENCH_HOST, '--port', str(self.port),
+                      '--backend', backend, '--record', '--acquire-interval', str(acquire_ms), '--interval', str(acquire_ms),
+                      '--publish-interval', str(publish_ms or acquire_ms)]
+        self._proc = None
+        self._ps = None
+        self._log = None
+
+    async def start(self):
+        self._log = open(os.path.join(self.workdir, 'headless.log'), 'ab')
+        _env = dict(os.environ, TEMP=self.workdir, APPDATA=self.workdir)
+        self._proc = subprocess.Popen(self._args, env=_env, stdout=self._log, stderr=subprocess.STDOUT)
+        self._ps = psutil.Process(self._proc.pid)
+        _deadline = time.perf_counter() + BENCH_START_TIMEOUT_S
+        while time.perf_counter() < _deadline:
+            if self._proc.poll() is not None:
+                raise RuntimeError('headless.py exited, see %s'%self._log.name)
+            try:
+                await self.stats()
+                return
+            except (urllib.error.URLError, OSError):
+                await asyncio.sleep(0.2)
+        raise RuntimeError('headless.py did not start')
+
+    def _get_json(self, path:str) -> dict:
+        with urllib.request.urlopen(self.url + path, timeout=10.0) as _res:
+            return json.load(_res)
+
+    async def stats(self, reset:bool=False) -> dict:
+        return await asyncio.to_thread(self._get_json, '/stats?reset=%s'%('true' if reset else 'false'))
+
+    def cpu_seconds(self) -> float:
+        _times = self._ps.cpu_times()
+        return _times.user + _times.system
+
+    def rss(self) -> int:
+        return self._ps.memory_info().rss
+
+    def stop(self):
+        if self._proc is None:
+            return
+        if os.name == 'nt':
+            self._proc.terminate()
+        else:
+            self._proc.send_signal(signal.SIGTERM)
+        try:
+            self._proc.wait(15.0)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc = None
+        self._log.close()
+
+class WsClient():
+    # JSON subscriber; with stamps it turns every new ai_raw_0 into an end-to-end
+    # latency (slave served the register -> message received), otherwise it only drains
+    def __init__(self, url:str, stamps:list|None=None):
+        self._url = url
+        self._stamps = stamps
+        self._task = None
+        self.received = 0
+        self.latency_ns: list[int] = []
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        _last = -1
+        async with websockets.connect(self._url, max_size=None) as _ws:
+            async for _msg in _ws:
+                _now = time.perf_counter_ns()
+                self.received += 1
+                if self._stamps is None:
+                    continue
+                _seq = json.loads(_msg)['data'][0]['ai_raw_0']
+                if _seq != _last and self._stamps[_seq & 0x7fff]:
+                    self.latency_ns.append(_now - self._stamps[_seq & 0x7fff])
+                _last = _seq
+
+def _delta(s0:dict, s1:dict, name:str, label:str|None=None) -> float:
+    _v0, _v1 = s0['metrics'].get(name, 0), s1['metrics'].get(name, 0)
+    if label is not None:
+        _v0, _v1 = _v0.get(label, 0), _v1.get(label, 0)
+    return _v1 - _v0
+
+async def _measure(proc:LoggerProcess, seconds:float, probe:WsClient|None=None) -> dict:
+    # counters as rates over the window, stage histograms of the window only
+    _s0 = await proc.stats(reset=True)
+    _cpu0 = proc.cpu_seconds()
+    if probe is not None:
+        probe.latency_ns = []
+    _t0 = time.perf_counter()
+    await asyncio.sleep(seconds)
+    _s1 = await proc.stats()
+    _elapsed = time.perf_counter() - _t0
+    _ticks = _delta(_s0, _s1, 'scheduler_ticks_total', 'ai_receive')
+    _missed = _delta(_s0, _s1, 'scheduler_missed_total', 'ai_receive')
+    _frames = _delta(_s0, _s1, 'frames_acquired_total')
+    _failed = _delta(_s0, _s1, 'frames_failed_total')
+    _stages = _s1['metrics'].get('stage_seconds', {})
+    # the writer commits once a second, so written rows come in steps; the rows
+    # handed to it are exact, and the flushes of the window give its capacity
+    _enqueued = _stages.get('sql_enqueue', {}).get('count', 0)
+    _flush = _stages.get('sql_flush', {'count': 0})
+    _flush_s = _flush['count'] * _flush.get('mean_us', 0.0) / 1E6
+    return {
+        'elapsed_s': _elapsed,
+        'acquired_hz': _frames / _elapsed,
+        'missed_ratio': _missed / (_ticks + _missed) if _ticks + _missed else 0.0,
+        'failed_ratio': _failed / (_frames + _failed) if _frames + _failed else 0.0,
+        'rows_per_s': (_enqueued - _delta(_s0, _s1, 'rows_dropped_total')) / _elapsed,
+        'rows_dropped': _delta(_s0, _s1, 'rows_dropped_total'),
+        'sql_write_rows_per_s': _delta(_s0, _s1, 'rows_written_total') / _flush_s if _flush_s > 0 else None,
+        'ws_messages_per_s': _delta(_s0, _s1, 'ws_messages_sent_total') / _elapsed,
+        'sql_queue_depth': _s1['metrics'].get('sql_queue_depth', 0),
+        'cpu_percent': (proc.cpu_seconds() - _cpu0) / _elapsed * 100.0,
+        'latency_ms': _percentiles(probe.latency_ns if probe else [], 1E-6),
+        'stages_us': _stages,
+    }
+
+async def run_rate_sweep(slave:SimulatedSlave, workdir:str, intervals:list[int], step_s:float, backend:str) -> list[dict]:
+    # one fresh logger per interval, fastest first would only measure the backlog
+    ret = []
+    for _interval in intervals:
+        _proc = LoggerProcess(workdir, slave.config_devices(), _interval, backend=backend)
+        await _proc.start()
+        _probe = WsClient(_proc.ws_url, slave.stamps)
+        _probe.start()
+        try:
+            await asyncio.sleep(BENCH_WARMUP_S)
+            _result = await _measure(_proc, step_s, _probe)
+        finally:
+            await _probe.stop()
+            _proc.stop()
+        _target = 1000.0 / _interval
+        _result.update({'interval_ms': _interval, 'target_hz': _target})
+        _result['sustained'] = _result['missed_ratio'] <= BENCH_LOSS_LIMIT and _result['failed_ratio'] <= BENCH_LOSS_LIMIT and _result['rows_dropped'] == 0
+        print('Bench: %4d ms: %7.1f Hz, missed %.3f, %7.1f rows/s (writer %s rows/s), cpu %5.1f %%, latency p99 %s ms, %s'%(
+            _interval, _result['acquired_hz'], _result['missed_ratio'], _result['rows_per_s'],
+            '%.0f'%_result['sql_write_rows_per_s'] if _result['sql_write_rows_per_s'] else '-', _result['cpu_percent'],
+            '%.2f'%_result['latency_ms']['p99'] if _result['latency_ms']['count'] else '-', 'ok' if _result['sustained'] else 'NOT sustained'))
+        ret.append(_result)
+        if not _result['sustained']:
+            break
+    return ret
+
+async def run_fanout(slave:SimulatedSlave, workdir:str, clients:list[int], interval_ms:int, step_s:float, backend:str) -> list[dict]:
+    # one logger, clients added step by step; the cost per message is the worker
+    # CPU above the 0 client step divided by the messages sent
+    ret = []
+    _proc = LoggerProcess(workdir, slave.config_devices(), interval_ms, backend=backend)
+    await _proc.start()
+    _clients: list[WsClient] = []
+    try:
+        _base = None
+        for _n in sorted(clients):
+            while len(_clients) < _n:
+                _clients.append(WsClient(_proc.ws_url, slave.stamps if not _clients else None))
+                _clients[-1].start()
+            await asyncio.sleep(BENCH_WARMUP_S)
+            _result = await _measure(_proc, step_s, _clients[0] if _clients else None)
+            _result['clients'] = _n
+            if _base is None:
+                _base = _result['cpu_percent']
+            _msgs = _result['ws_messages_per_s']
+            _result['cpu_us_per_message'] = (_result['cpu_percent'] - _base) / 100.0 / _msgs * 1E6 if _msgs > 0 else None
+            print('Bench: %3d clients: %8.1f msg/s, cpu %5.1f %%, %s us/message'%(_n, _msgs, _result['cpu_percent'],
+                '%.1f'%_result['cpu_us_per_message'] if _result['cpu_us_per_message'] is not None else '-'))
+            ret.append(_result)
+    finally:
+        for _client in _clients:
+            await _client.stop()
+        _proc.stop()
+    return ret
+
+async def run_soak(slave:SimulatedSlave, workdir:str, interval_ms:int, seconds:float, backend:str) -> dict:
+    _proc = LoggerProcess(workdir, slave.config_devices(), interval_ms, backend=backend)
+    await _proc.start()
+    _probe = WsClient(_proc.ws_url, slave.stamps)
+    _probe.start()
+    _times, _rss = [], []
+    try:
+        await asyncio.sleep(BENCH_WARMUP_S)
+        _s0 = await _proc.stats(reset=True)
+        _t0 = time.perf_counter()
+        _probe.latency_ns = []
+        while (_now := time.perf_counter() - _t0) < seconds:
+            _times.append(_now)
+            _rss.append(_proc.rss())
+            await asyncio.sleep(BENCH_SOAK_SAMPLE_S)
+        _s1 = await _proc.stats()
+    finally:
+        await _probe.stop()
+        _proc.stop()
+    # growth over the second half, the first one still fills caches and buffers
+    _half = len(_times) // 2
+    _slope = float(np.polyfit(_times[_half:], _rss[_half:], 1)[0]) if len(_times) - _half >= 2 else 0.0
+    ret = {
+        'interval_ms': interval_ms,
+        'seconds': seconds,
+        'rss_start_mb': _rss[0] / 2**20 if _rss else 0.0,
+        'rss_end_mb': _rss[-1] / 2**20 if _rss else 0.0,
+        'rss_max_mb': max(_rss) / 2**20 if _rss else 0.0,
+        'rss_growth_mb_per_h': _slope * 3600.0 / 2**20,
+        'rows_written': _delta(_s0, _s1, 'rows_written_total'),
+        'rows_dropped': _delta(_s0, _s1, 'rows_dropped_total'),
+        'latency_ms': _percentiles(_probe.latency_ns, 1E-6),
+    }
+    print('Bench: soak %.0f s: rss %.1f -> %.1f MB (%.2f MB/h), %d rows'%(seconds, ret['rss_start_mb'], ret['rss_end_mb'], ret['rss_growth_mb_per_h'], ret['rows_written']))
+    return ret
+
+def _git_revision() -> str|None:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(BENCH_HEADLESS_PATH), capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def headline(result:dict) -> dict[str, float]:
+    # flat numbers worth comparing between releases
+    ret = {}
+    if result.get('max_sustained_hz') is not None:
+        ret['max_sustained_hz'] = result['max_sustained_hz']
+    for _step in result.get('rate_sweep', []):
+        ret['rows_per_s@%dms'%_step['interval_ms']] = _step['rows_per_s']
+        if _step['sql_write_rows_per_s'] is not None:
+            ret['sql_write_rows_per_s@%dms'%_step['interval_ms']] = _step['sql_write_rows_per_s']
+        ret['cpu_percent@%dms'%_step['interval_ms']] = _step['cpu_percent']
+        if _step['latency_ms']['count']:
+            ret['latency_p99_ms@%dms'%_step['interval_ms']] = _step['latency_ms']['p99']
+    for _step in result.get('fanout', []):
+        if _step['cpu_us_per_message'] is not None:
+            ret['cpu_us_per_message@%dclients'%_step['clients']] = _step['cpu_us_per_message']
+    if result.get('soak'):
+        ret['rss_growth_mb_per_h'] = result['soak']['rss_growth_mb_per_h']
+        ret['rss_max_mb'] = result['soak']['rss_max_mb']
+    return ret
+
+def compare(baseline:dict, result:dict) -> list[str]:
+    _old, _new = headline(baseline), headline(result)
+    ret = []
+    for _key in _new:
+        if _key not in _old:
+            continue
+        _change = '%+.1f %%'%((_new[_key] - _old[_key]) / abs(_old[_key]) * 100.0) if _old[_key] else '-'
+        ret.append('%-32s %12.2f -> %12.2f  %s'%(_key, _old[_key], _new[_key], _change))
+    return ret
+
+async def run(args) -> dict:
+    _slave = SimulatedSlave(mode=args.mode)
+    _slave.start()
+    ret = {
+        'format_version': BENCH_FORMAT_VERSION,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': _git_revision(),
+        'platform': {
+            'system': platform.platform(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pymodbus': pymodbus.__version__,
+        },
+        'settings': {
+            'mode': args.mode,
+            'backend': args.backend,
+            'devices': BENCH_DEVICES,
+            'intervals_ms': args.intervals,
+            'step_s': args.step,
+            'warmup_s': BENCH_WARMUP_S,
+            'loss_limit': BENCH_LOSS_LIMIT,
+            'fanout_clients': args.clients,
+            'fanout_interval_ms': args.fanout_interval,
+            'soak_s': args.soak,
+        },
+    }
+    try:
+        with tempfile.TemporaryDirectory() as _workdir:
+            if 'rate' in args.phases:
+                ret['rate_sweep'] = await run_rate_sweep(_slave, _workdir, args.intervals, args.step, args.backend)
+                _sustained = [s['target_hz'] for s in ret['rate_sweep'] if s['sustained']]
+                ret['max_sustained_hz'] = max(_sustained) if _sustained else None
+            if 'fanout' in args.phases:
+                ret['fanout'] = await run_fanout(_slave, _workdir, args.clients, args.fanout_interval, args.step, args.backend)
+            if 'soak' in args.phases and args.soak > 0:
+                ret['soak'] = await run_soak(_slave, _workdir, args.fanout_interval, args.soak, args.backend)
+    finally:
+        _slave.stop()
+    return ret
+
+def main():
+    _int_list = lambda s: [int(v) for v in s.split(',') if v.strip()]
+    parser = argparse.ArgumentParser(description='Benchmark headless.py against a simulated Modbus slave')
+    parser.add_argument('--out', default=None, help='result JSON (default: bench-<time>.json)')
+    parser.add_argument('--baseline', default=None, help='earlier result JSON to compare with')
+    parser.add_argument('--phases', default='rate,fanout,soak', help='comma separated: rate, fanout, soak')
+    parser.add_argument('--mode', choices=BENCH_MODES, default='TCP')
+    parser.add_argument('--backend', choices=('sqlite', 'columnar'), default='sqlite')
+    parser.add_argument('--intervals', type=_int_list, default=list(BENCH_INTERVALS_MS), help='acquisition intervals in ms, slowest first')
+    parser.add_argument('--step', type=float, default=BENCH_STEP_S, help='seconds measured per step')
+    parser.add_argument('--clients', type=_int_list, default=list(BENCH_FANOUT_CLIENTS), help='WebSocket client counts')
+    parser.add_argument('--fanout-interval', type=int, default=BENCH_FANOUT_INTERVAL_MS, help='acquisition and publish interval of fan-out and soak in ms')
+    parser.add_argument('--soak', type=float, default=BENCH_SOAK_S, help='soak duration in seconds, 0 to skip')
+    args = parser.parse_args()
+    args.phases = [p.strip() for p in args.phases.split(',')]
+
+    _result = asyncio.run(run(args))
+    _out = args.out or 'bench-%s.json'%datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    with open(_out, 'w') as f:
+        json.dump(_result, f, indent=1)
+    print('Bench: result: %s'%_out)
+    if _result.get('max_sustained_hz') is not None:
+        print('Bench: max sustained rate: %.0f Hz'%_result['max_sustained_hz'])
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            for _line in compare(json.load(f), _result):
+                print(_line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import asyncio, threading
+
+class Subscriber():
+    # Bounded per-client queue. When the client falls behind, pending messages are
+    # dropped and only the latest one is kept.
+    def __init__(self, fmt:str, queue_size:int):
+        self.format = fmt
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(2, queue_size))
+        self.last_seq = -1
+        self.meta_version = -1
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+
+    def drop_pending(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.dropped += 1
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.drop_pending()
+        self.queue.put_nowait(None)
+
+class BroadcastHub():
+    # Serializes each new frame once per format in use and fans the same message
+    # out to every subscriber. Lives on the web server's event loop; other threads
+    # only call request_publish().
+    #
+    # json subscribers get self-contained messages. binary and delta subscribers get
+    # the metadata message once and again whenever its version changes, followed by
+    # packed frames; a delta subscriber that missed a frame gets a full one.
+    #
+    # HTTP pollers share the json message through latest(), and long-polls wait in
+    # wait_newer() until the acquisition thread calls request_wake().
+    def __init__(self, source, json_serializer, codec=None, meta_source=None, queue_size:int=4):
+        self._source = source
+        self._json_serializer = json_serializer
+        self._codec = codec
+        self._meta_source = meta_source
+        self._queue_size = queue_size
+        self._subscribers: set[Subscriber] = set()
+        self._loop = None
+        self._publish_pending = False
+        self._pending_lock = threading.Lock()
+        self._cache: dict[str, tuple] = {}
+        self._prev_frame = None
+        self._latest = None # ((seq, meta version), etag, body)
+        self._waiters: list[tuple[int, asyncio.Future]] = []
+        self._wake_pending = False
+        self.published = 0
+        self.serialized = 0
+        self.dropped = 0
+
+    def bind(self, loop:asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    @property
+    def formats(self) -> tuple[str, ...]:
+        return ('json', 'binary', 'delta') if self._codec and self._meta_source else ('json',)
+
+    @property
+    def num_subscribers(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def pending(self) -> int:
+        # messages waiting in all client queues, call from the loop thread
+        return sum(sub.queue.qsize() for sub in self._subscribers)
+
+    def subscribe(self, fmt:str='json') -> Subscriber:
+        if fmt not in self.formats:
+            raise ValueError('Invalid format: %s'%fmt)
+        _sub = Subscriber(fmt, self._queue_size)
+        self._subscribers.add(_sub)
+        self._deliver(_sub, self._source(), self._meta_source() if self._meta_source else None)
+        return _sub
+
+    def unsubscribe(self, sub:Subscriber):
+        self._subscribers.discard(sub)
+        sub.close()
+
+    @property
+    def num_waiters(self) -> int:
+        return len(self._waiters)
+
+    def latest(self) -> tuple[int, str, bytes]:
+        # (frame seq, etag, json body) of the current frame, call from the loop
+        # thread; serialized once per frame and metadata version for all pollers
+        _frame = self._source()
+        _meta_version = self._meta_source()[0] if self._meta_source else 0
+        _key = (_frame.seq, _meta_version)
+        if self._latest is None or self._latest[0] != _key:
+            self._latest = (_key, '"%d-%d"'%_key, self._message('json', _frame, _meta_version).encode())
+        return _frame.seq, self._latest[1], self._latest[2]
+
+    async def wait_newer(self, seq:int, timeout:float) -> bool:
+        # until there is a frame after seq; False on timeout
+        _future = asyncio.get_running_loop().create_future()
+        # registered before looking, a frame in between then wakes it
+        self._waiters.append((seq, _future))
+        try:
+            if self._source().seq > seq:
+                return True
+            await asyncio.wait_for(_future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if not _future.done():
+                _future.cancel()
+            self._waiters = [w for w in self._waiters if w[1] is not _future]
+
+    def request_wake(self):
+        # thread-safe, after each new frame; nothing to do unless a long-poll waits
+        if self._loop is None or not self._waiters:
+            return
+        with self._pending_lock:
+            if self._wake_pending:
+                return
+            self._wake_pending = True
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        with self._pending_lock:
+            self._wake_pending = False
+        _seq = self._source().seq
+        for seq, _future in self._waiters:
+            if seq < _seq and not _future.done():
+                _future.set_result(None)
+
+    def _message(self, fmt:str, frame, meta_version:int):
+        _key = (frame.seq, meta_version)
+        _cached = self._cache.get(fmt)
+        if _cached is not None and _cached[0] == _key:
+            return _cached[1]
+        if fmt == 'json':
+            _msg = self._json_serializer(frame)
+        elif fmt == 'binary':
+            _msg = self._codec.encode(frame, meta_version)
+        else:
+            _msg = self._codec.encode_delta(frame, self._prev_frame, meta_version)
+        self._cache[fmt] = (_key, _msg)
+        self.serialized += 1
+        return _msg
+
+    def _deliver(self, sub:Subscriber, frame, meta):
+        if sub.closed or sub.last_seq == frame.seq:
+            return
+        if sub.queue.qsize() + 2 > sub.queue.maxsize:
+            self.dropped += sub.queue.qsize()
+            sub.drop_pending()
+            # the client may have lost metadata or the base of the next delta
+            sub.meta_version = -1
+            sub.last_seq = -1
+        if sub.format == 'json':
+            # same key as latest(), so pollers and json clients share one message
+            sub.queue.put_nowait(self._message('json', frame, meta[0] if meta else 0))
+            sub.last_seq = frame.seq
+            return
+        _meta_version, _meta_msg = meta
+        if sub.meta_version != _meta_version:
+            sub.queue.put_nowait(_meta_msg)
+            sub.meta_version = _meta_version
+        _fmt = sub.format
+        if _fmt == 'delta' and (self._prev_frame is None or sub.last_seq != self._prev_frame.seq):
+            _fmt = 'binary'
+        sub.queue.put_nowait(self._message(_fmt, frame, _meta_version))
+        sub.last_seq = frame.seq
+
+    def request_publish(self):
+        # thread-safe, coalesces requests until the loop has run the publish
+        if self._loop is None or not self._subscribers:
+            return
+        with self._pending_lock:
+            if self._publish_pending:
+                return
+            self._publish_pending = True
+        self._loop.call_soon_threadsafe(self._publish)
+
+    def _publish(self):
+        with self._pending_lock:
+            self._publish_pending = False
+        _frame = self._source()
+        if self._prev_frame is not None and self._prev_frame.seq == _frame.seq:
+            return
+        _meta = self._meta_source() if self._meta_source else None
+        for _sub in list(self._subscribers):
+            self._deliver(_sub, _frame, _meta)
+        self._prev_frame = _frame
+        self.published += 1
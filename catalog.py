@@ -0,0 +1,216 @@
+import os, re, json, sqlite3, datetime, argparse
+
+from storage import SQL_TIME_FORMAT
+from archive import ArchiveReader, ARCHIVE_EXT
+
+CATALOG_NAME = 'catalog.db' # not .sqlite3, so it is never taken for a session
+CATALOG_TIMEOUT_S = 5.0
+SESSION_FILE_PATTERN = re.compile(r'^(?P<session>\d{14})(?:\.(?P<segment>\d{3}))?(?P<ext>\.sqlite3|\.msl|\.msa)$')
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS sessions (name TEXT PRIMARY KEY, backend TEXT, closed INTEGER, meta TEXT)',
+    'CREATE TABLE IF NOT EXISTS segments (session TEXT, segment INTEGER, file TEXT, start_time TEXT, end_time TEXT, rows INTEGER, first_seq INTEGER, last_seq INTEGER, bytes INTEGER, closed INTEGER, archive TEXT, archive_bytes INTEGER, PRIMARY KEY (session, segment))',
+)
+_MIGRATIONS = (('segments', 'archive', 'TEXT'), ('segments', 'archive_bytes', 'INTEGER')) # columns added since the first version
+
+def _time_str(time_ns:int|None) -> str|None:
+    return None if time_ns is None else datetime.datetime.fromtimestamp(time_ns/1E9).strftime(SQL_TIME_FORMAT)
+
+def overlapping(segments:list[dict], start:str|None=None, end:str|None=None) -> list[dict]:
+    # a segment without rows yet has no time range, it may be the one being written
+    return [s for s in segments if s['start'] is None or not ((start is not None and s['end'] < start) or (end is not None and s['start'] >= end))]
+
+class SessionCatalog():
+    # Index of the recorded sessions next to them: time range, rows and size of
+    # every segment file, plus the channel labels and calibration at the start.
+    # The writer thread updates its segment after each flush, so listing and
+    # locating data never opens the session files. A connection per call keeps
+    # it usable from any thread.
+    def __init__(self, directory:str):
+        self._directory = directory
+        self._path = os.path.join(directory, CATALOG_NAME)
+        def _create(conn):
+            conn.execute('PRAGMA journal_mode=WAL')
+            for _sql in _SCHEMA:
+                conn.execute(_sql)
+            for _table, _column, _type in _MIGRATIONS:
+                if _column not in [r[1] for r in conn.execute('PRAGMA table_info(%s)'%_table).fetchall()]:
+                    conn.execute('ALTER TABLE %s ADD COLUMN %s %s'%(_table, _column, _type))
+        self._run(_create)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._path, timeout=CATALOG_TIMEOUT_S)
+
+    def _run(self, fn):
+        _conn = self._connect()
+        try:
+            with _conn:
+                return fn(_conn)
+        finally:
+            _conn.close()
+
+    def open_session(self, name:str, backend:str, meta:dict|None=None):
+        self._run(lambda conn: conn.execute('INSERT OR REPLACE INTO sessions (name, backend, closed, meta) VALUES (?, ?, 0, ?)', (name, backend, json.dumps(meta or {}))))
+
+    def update_segment(self, session:str, info:dict):
+        # info: FrameWriter.segment_info()
+        _row = (session, info['segment'], os.path.basename(info['path']), _time_str(info['start_ns']), _time_str(info['end_ns']), info['rows'], info['first_seq'], info['last_seq'], info['bytes'], int(info['closed']))
+        self._run(lambda conn: conn.execute('INSERT OR REPLACE INTO segments (session, segment, file, start_time, end_time, rows, first_seq, last_seq, bytes, closed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', _row))
+
+    def set_archive(self, session:str, segment:int, path:str|None, size:int|None=None, source_removed:bool=False):
+        # archive file of a closed segment, see archive.py
+        _sql = 'UPDATE segments SET archive = ?, archive_bytes = ?%s WHERE session = ? AND segment = ?'%(', bytes = 0' if source_removed else '')
+        self._run(lambda conn: conn.execute(_sql, (path and os.path.basename(path), size, session, segment)))
+
+    def unarchived(self) -> list[dict]:
+        # closed segments with rows, still only in their session file
+        _sql = 'SELECT session, segment, file FROM segments WHERE closed = 1 AND rows > 0 AND archive IS NULL ORDER BY session, segment'
+        return [{'session': r[0], 'segment': r[1], 'path': os.path.join(self._directory, r[2])} for r in self._run(lambda conn: conn.execute(_sql).fetchall())]
+
+    def close_session(self, name:str):
+        def _close(conn):
+            conn.execute('UPDATE sessions SET closed = 1 WHERE name = ?', (name,))
+            conn.execute('UPDATE segments SET closed = 1 WHERE session = ?', (name,))
+        self._run(_close)
+
+    def update_calib(self, name:str, ai:dict[int, tuple], ao:dict[int, tuple]) -> bool:
+        # the session's calibration after recalib.py rewrote its phy columns; False
+        # when the catalog does not know the session
+        def _update(conn):
+            _row = conn.execute('SELECT meta FROM sessions WHERE name = ?', (name,)).fetchone()
+            if _row is None:
+                return False
+            _meta = json.loads(_row[0] or '{}')
+            _calib = _meta.setdefault('calib', {})
+            for _kind, _values in (('ai', ai), ('ao', ao)):
+                _list = _calib.setdefault(_kind, [])
+                for ch, coef in _values.items():
+                    _list.extend([None]*(ch + 1 - len(_list)))
+                    _list[ch] = list(coef)
+            conn.execute('UPDATE sessions SET meta = ? WHERE name = ?', (json.dumps(_meta), name))
+            return True
+        return self._run(_update)
+
+    def sessions(self) -> list[dict]:
+        # oldest first, without meta
+        _sql = ('SELECT s.name, s.backend, s.closed, MIN(g.start_time), MAX(g.end_time), COALESCE(SUM(g.rows), 0), COUNT(g.segment), COALESCE(SUM(g.bytes), 0), COALESCE(SUM(g.archive_bytes), 0) '
+                'FROM sessions s LEFT JOIN segments g ON g.session = s.name GROUP BY s.name ORDER BY s.name')
+        _rows = self._run(lambda conn: conn.execute(_sql).fetchall())
+        return [{'name': r[0], 'backend': r[1], 'closed': bool(r[2]), 'start': r[3], 'end': r[4], 'rows': r[5], 'segments': r[6], 'bytes': r[7], 'archive_bytes': r[8]} for r in _rows]
+
+    def session(self, name:str) -> dict|None:
+        _row = self._run(lambda conn: conn.execute('SELECT name, backend, closed, meta FROM sessions WHERE name = ?', (name,)).fetchone())
+        if _row is None:
+            return None
+        return {'name': _row[0], 'backend': _row[1], 'closed': bool(_row[2]), 'meta': json.loads(_row[3] or '{}'), 'segments': self.segments(name)}
+
+    def segments(self, session:str, start:str|None=None, end:str|None=None) -> list[dict]:
+        # segments overlapping [start, end) in order. base is the number of rows
+        # before the segment, so base + row id numbers the rows across segments.
+        _rows = self._run(lambda conn: conn.execute('SELECT segment, file, start_time, end_time, rows, first_seq, last_seq, bytes, closed, archive, archive_bytes FROM segments WHERE session = ? ORDER BY segment', (session,)).fetchall())
+        ret = []
+        _base = 0
+        for r in _rows:
+            _segment = {'segment': r[0], 'path': os.path.join(self._directory, r[1]), 'start': r[2], 'end': r[3], 'rows': r[4], 'first_seq': r[5], 'last_seq': r[6], 'bytes': r[7], 'closed': bool(r[8]),
+                        'archive': r[9] and os.path.join(self._directory, r[9]), 'archive_bytes': r[10], 'base': _base}
+            _base += r[4] or 0
+            ret.append(_segment)
+        return overlapping(ret, start, end)
+
+    def scan(self) -> int:
+        # adds session files and archives the catalog does not know (recorded
+        # before it, or copied in) and drops entries whose files are all gone;
+        # returns files added
+        _known = {(r[0], r[1]): (r[2], r[3]) for r in self._run(lambda conn: conn.execute('SELECT session, segment, file, archive FROM segments').fetchall())}
+        _added = 0
+        # session files first, an archive only fills in what they leave out
+        for _file in sorted(os.listdir(self._directory), key=lambda f: (f.endswith(ARCHIVE_EXT), f)):
+            _match = SESSION_FILE_PATTERN.match(_file)
+            if not _match:
+                continue
+            _key = (_match['session'], int(_match['segment'] or 0))
+            if _match['ext'] == ARCHIVE_EXT and _key in _known and _known[_key][1] is None:
+                self.set_archive(_key[0], _key[1], _file, os.path.getsize(os.path.join(self._directory, _file)))
+                _known[_key] = (_known[_key][0], _file)
+                continue
+            if _key in _known:
+                continue
+            try:
+                _info = _file_info(os.path.join(self._directory, _file))
+            except Exception as e:
+                print('Catalog: Failed to read %s'%_file)
+                print(e)
+                continue
+            _archive = (_file, _info['bytes']) if _match['ext'] == ARCHIVE_EXT else (None, None)
+            _source = _info.pop('source', _file)
+            def _add(conn):
+                conn.execute('INSERT OR IGNORE INTO sessions (name, backend, closed, meta) VALUES (?, ?, 1, ?)', (_key[0], 'columnar' if _source.endswith('.msl') else 'sqlite', _info.pop('meta')))
+                conn.execute('INSERT OR REPLACE INTO segments (session, segment, file, start_time, end_time, rows, first_seq, last_seq, bytes, closed, archive, archive_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?)',
+                             (_key[0], _key[1], _source, _info['start'], _info['end'], _info['rows'], _info['first_seq'], _info['last_seq'], None if _archive[0] else _info['bytes'], *_archive))
+            self._run(_add)
+            _known[_key] = (_source, _archive[0])
+            _added += 1
+        _exists = lambda f: f is not None and os.path.exists(os.path.join(self._directory, f))
+        _missing = [k for k, (f, a) in _known.items() if not _exists(f) and not _exists(a)]
+        if _missing:
+            def _drop(conn):
+                conn.executemany('DELETE FROM segments WHERE session = ? AND segment = ?', _missing)
+                conn.execute('DELETE FROM sessions WHERE name NOT IN (SELECT session FROM segments)')
+            self._run(_drop)
+        return _added
+
+def _file_info(path:str) -> dict:
+    # time range and rows of a session file, from its index and manifest only
+    if path.endswith(ARCHIVE_EXT):
+        with ArchiveReader(path) as _reader:
+            _blocks = _reader.blocks
+            _ends = _reader.read(['seq'], 0, 1)['seq'].tolist() + _reader.read(['seq'], max(0, len(_reader) - 1))['seq'].tolist() if 'seq' in _reader.fields and _blocks else [None, None]
+            return {'start': _time_str(_blocks[0]['first_ns']) if _blocks else None, 'end': _time_str(_blocks[-1]['last_ns']) if _blocks else None, 'rows': len(_reader),
+                    'first_seq': _ends[0], 'last_seq': _ends[-1], 'bytes': os.path.getsize(path), 'meta': json.dumps(_reader.meta), 'source': _reader.source}
+    if path.endswith('.msl'):
+        from columnar import ColumnarReader
+        with ColumnarReader(path) as _reader:
+            _n = len(_reader)
+            _ends = _reader.read(['time_ns', 'seq'], 0, 1), _reader.read(['time_ns', 'seq'], max(0, _n - 1))
+            _bytes = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            return {'start': _time_str(int(_ends[0]['time_ns'][0])) if _n else None, 'end': _time_str(int(_ends[1]['time_ns'][0])) if _n else None, 'rows': _n,
+                    'first_seq': int(_ends[0]['seq'][0]) if _n else None, 'last_seq': int(_ends[1]['seq'][0]) if _n else None, 'bytes': _bytes, 'meta': json.dumps(_reader.meta)}
+    _conn = sqlite3.connect('file:%s?mode=ro'%path, uri=True)
+    try:
+        _start, _end = _conn.execute('SELECT MIN(time), MAX(time) FROM data').fetchone()
+        _rows = _conn.execute('SELECT MAX(id) FROM data').fetchone()[0] or 0
+        _columns = [r[1] for r in _conn.execute('PRAGMA table_info(data)').fetchall()]
+        _seqs = _conn.execute('SELECT (SELECT seq FROM data ORDER BY id LIMIT 1), (SELECT seq FROM data ORDER BY id DESC LIMIT 1)').fetchone() if 'seq' in _columns else (None, None)
+    finally:
+        _conn.close()
+    _bytes = sum(os.path.getsize(p) for p in (path, path+'-wal') if os.path.exists(p))
+    return {'start': _start, 'end': _end, 'rows': _rows, 'first_seq': _seqs[0], 'last_seq': _seqs[1], 'bytes': _bytes, 'meta': '{}'}
+
+def main():
+    parser = argparse.ArgumentParser(description='List the sessions of a data directory')
+    parser.add_argument('directory', help='session directory, e.g. %%TEMP%%/ModbusSimpleLogger')
+    parser.add_argument('--session', default=None, help='show the segments of one session')
+    args = parser.parse_args()
+
+    _catalog = SessionCatalog(args.directory)
+    _added = _catalog.scan()
+    if _added:
+        print('Catalog: Added %d files'%_added)
+    if args.session:
+        _session = _catalog.session(args.session)
+        if _session is None:
+            raise SystemExit('No such session: %s'%args.session)
+        for s in _session['segments']:
+            _archive = '  archived %.1f MB'%(s['archive_bytes']/1E6) if s['archive'] else ''
+            print('%3d %s  %s .. %s  %10d rows  %8.1f MB%s%s'%(s['segment'], os.path.basename(s['path']), s['start'], s['end'], s['rows'], (s['bytes'] or 0)/1E6, _archive, '' if s['closed'] else '  recording'))
+        return
+    for s in _catalog.sessions():
+        _archive = '  archived %.1f MB'%(s['archive_bytes']/1E6) if s['archive_bytes'] else ''
+        print('%s  %-8s %s .. %s  %10d rows  %3d segments  %8.1f MB%s%s'%(s['name'], s['backend'], s['start'], s['end'], s['rows'], s['segments'], s['bytes']/1E6, _archive, '' if s['closed'] else '  recording'))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+import numpy as np
+
+NUM_CH_AI = 16
+NUM_CH_AI_LIMIT = 16
+NUM_CH_AO = 8
+NUM_CH_AO_LIMIT = 8
+NUM_CH_PARAM = 16
+
+def calc_phy(raw, a, b, c) -> np.ndarray:
+    # Phy = A*Raw^2 + B*Raw + C
+    _x = np.asarray(raw, dtype=np.float64)
+    return (a*_x*_x + b*_x + c).astype(np.float32)
@@ -0,0 +1,314 @@
+import os, csv, json, time, datetime, argparse
+
+import numpy as np
+
+from channels import NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM
+from ringbuffer import frame_dtype
+from storage import FrameWriter, FrameGap, AioDataTable, create_sqlite_engine, SQL_TIME_FORMAT
+
+COLUMNAR_FORMAT = 'msl-columnar'
+COLUMNAR_VERSION = 1
+COLUMNAR_CHUNK_FRAMES = 1 << 16
+COLUMNAR_MANIFEST_NAME = 'manifest.json'
+COLUMNAR_CONVERT_ROWS = 10000
+
+def _chunk_file(path:str, name:str, chunk:int) -> str:
+    return os.path.join(path, '%s.%06d.bin'%(name, chunk))
+
+def _write_manifest(path:str, manifest:dict):
+    # readers may open the manifest at any time, never leave it half written
+    _tmp = os.path.join(path, COLUMNAR_MANIFEST_NAME+'.tmp')
+    with open(_tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(_tmp, os.path.join(path, COLUMNAR_MANIFEST_NAME))
+
+class ColumnarWriter(FrameWriter):
+    # A session is a directory with manifest.json and one file per field and chunk
+    # of COLUMNAR_CHUNK_FRAMES frames, each a plain array of the in-memory dtype
+    # (see ringbuffer.frame_dtype). Chunk files are preallocated and written through
+    # memmap; the manifest's frame count is only advanced after the data is in place.
+    # The last chunk keeps its preallocated size when closed, readers may have it
+    # mapped (truncating a mapped file fails on Windows); 'frames' says what is used.
+    def __init__(self, path:str, num_ai:int, num_ao:int, num_param:int, meta:dict|None=None, chunk_frames:int=COLUMNAR_CHUNK_FRAMES, flush_interval_ms:int=1000, flush_rows:int=1000, queue_size:int=60000):
+        super().__init__(path, flush_interval_ms, flush_rows, queue_size)
+        if chunk_frames <= 0:
+            raise ValueError('Invalid chunk frames')
+        self._dtype = frame_dtype(num_ai, num_ao, num_param)
+        self._chunk_frames = chunk_frames
+        self._meta = meta or {}
+        self._frames = 0
+        self._chunk = -1
+        self._maps: dict[str, np.memmap] = {}
+        self._manifest = {}
+
+    def _open(self):
+        # per segment directory
+        self._frames = 0
+        self._chunk = -1
+        self._manifest = {
+            'format': COLUMNAR_FORMAT,
+            'version': COLUMNAR_VERSION,
+            'created': datetime.datetime.now().isoformat(),
+            'segment': self._segment,
+            'chunk_frames': self._chunk_frames,
+            'fields': [{'name': name, 'dtype': self._dtype[name].base.str, 'shape': list(self._dtype[name].shape)} for name in self._dtype.names],
+            'frames': 0,
+            'gaps': [], # [seq, frames, time_ns, mono_ns, end_time_ns] per run of failed reads
+            'closed': False,
+            'meta': self._meta,
+        }
+        os.makedirs(self._path)
+        _write_manifest(self._path, self._manifest)
+
+    def _size(self) -> int:
+        return self._frames * self._dtype.itemsize
+
+    def _open_chunk(self, chunk:int):
+        self._close_chunk()
+        for name in self._dtype.names:
+            _field = self._dtype[name]
+            self._maps[name] = np.memmap(_chunk_file(self._path, name, chunk), dtype=_field.base, mode='w+', shape=(self._chunk_frames,)+_field.shape)
+        self._chunk = chunk
+
+    def _close_chunk(self):
+        for _map in self._maps.values():
+            _map.flush()
+        self._maps = {}
+
+    def _write(self, batch:list):
+        _columns = {name: np.array([getattr(frame, name) for frame in batch], dtype=self._dtype[name].base) for name in self._dtype.names}
+        _done = 0
+        while _done < len(batch):
+            _chunk, _offset = divmod(self._frames, self._chunk_frames)
+            if _chunk != self._chunk:
+                self._open_chunk(_chunk)
+            _n = min(len(batch) - _done, self._chunk_frames - _offset)
+            for name, _column in _columns.items():
+                self._maps[name][_offset:_offset+_n] = _column[_done:_done+_n]
+            self._frames += _n
+            _done += _n
+        self._manifest['frames'] = self._frames
+        _write_manifest(self._path, self._manifest)
+
+    def _write_gaps(self, gaps:list[FrameGap]):
+        _gaps = self._manifest['gaps']
+        if _gaps and _gaps[-1][0] == gaps[0].seq:
+            _gaps.pop()
+        _gaps.extend(list(g) for g in gaps)
+        _write_manifest(self._path, self._manifest)
+
+    def _close(self):
+        self._close_chunk()
+        self._manifest['frames'] = self._frames
+        self._manifest['closed'] = True
+        _write_manifest(self._path, self._manifest)
+
+class ColumnarReader():
+    # Read side of ColumnarWriter. Slices are numpy.memmap views, no copy as long
+    # as they stay within one chunk. Call refresh() to see frames appended since.
+    def __init__(self, path:str):
+        if not os.path.exists(os.path.join(path, COLUMNAR_MANIFEST_NAME)):
+            raise FileNotFoundError(path)
+        self._path = path
+        self._maps: dict[tuple[str, int], np.memmap] = {}
+        self.refresh()
+        if self._manifest.get('format') != COLUMNAR_FORMAT:
+            raise ValueError('Not a columnar session: %s'%path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._frames
+
+    def close(self):
+        self._maps = {}
+
+    def refresh(self):
+        with open(os.path.join(self._path, COLUMNAR_MANIFEST_NAME), 'r') as f:
+            self._manifest = json.load(f)
+        self._frames = int(self._manifest['frames'])
+        self._chunk_frames = int(self._manifest['chunk_frames'])
+        self._fields = {f['name']: (np.dtype(f['dtype']), tuple(f['shape'])) for f in self._manifest['fields']}
+        # chunks never shrink or move, the maps stay valid
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def closed(self) -> bool:
+        return bool(self._manifest.get('closed'))
+
+    @property
+    def meta(self) -> dict:
+        return self._manifest.get('meta', {})
+
+    @property
+    def fields(self) -> list[str]:
+        return list(self._fields)
+
+    @property
+    def gaps(self) -> list[FrameGap]:
+        return [FrameGap(*g) for g in self._manifest.get('gaps', [])]
+
+    def _map(self, name:str, chunk:int) -> np.memmap:
+        _key = (name, chunk)
+        if _key not in self._maps:
+            _dtype, _shape = self._fields[name]
+            _file = _chunk_file(self._path, name, chunk)
+            # full size; the last chunk of sessions closed by older versions was cut to the frames used
+            _rows = min(self._chunk_frames, os.path.getsize(_file) // (_dtype.itemsize * int(np.prod(_shape, dtype=np.int64))))
+            self._maps[_key] = np.memmap(_file, dtype=_dtype, mode='r', shape=(_rows,)+_shape)
+        return self._maps[_key]
+
+    def _check(self, fields:list[str]|None) -> list[str]:
+        _fields = list(self._fields) if fields is None else fields
+        for name in _fields:
+            if name not in self._fields:
+                raise ValueError('Invalid field: %s'%name)
+        return _fields
+
+    def iter_chunks(self, fields:list[str]|None=None, start:int=0, stop:int|None=None):
+        # yields (first frame index, {field: view}) chunk by chunk
+        _fields = self._check(fields)
+        _stop = self._frames if stop is None else min(stop, self._frames)
+        _index = max(0, start)
+        while _index < _stop:
+            _chunk, _offset = divmod(_index, self._chunk_frames)
+            _n = min(_stop - _index, self._chunk_frames - _offset)
+            yield _index, {name: self._map(name, _chunk)[_offset:_offset+_n] for name in _fields}
+            _index += _n
+
+    def read(self, fields:list[str]|None=None, start:int=0, stop:int|None=None) -> dict[str, np.ndarray]:
+        _parts = [views for _, views in self.iter_chunks(fields, start, stop)]
+        _fields = self._check(fields)
+        if len(_parts) == 1:
+            return _parts[0]
+        if not _parts:
+            return {name: np.empty((0,)+self._fields[name][1], dtype=self._fields[name][0]) for name in _fields}
+        return {name: np.concatenate([p[name] for p in _parts]) for name in _fields}
+
+    def index_at(self, time_ns:int) -> int:
+        # first frame with time_ns >= the given time, frames are in time order
+        for _first, _views in self.iter_chunks(['time_ns']):
+            _times = _views['time_ns']
+            if len(_times) and _times[-1] >= time_ns:
+                return _first + int(np.searchsorted(_times, time_ns, side='left'))
+        return self._frames
+
+    def window_by_time(self, fields:list[str]|None=None, start_ns:int|None=None, stop_ns:int|None=None) -> dict[str, np.ndarray]:
+        _start = 0 if start_ns is None else self.index_at(start_ns)
+        _stop = None if stop_ns is None else self.index_at(stop_ns)
+        return self.read(fields, _start, _stop)
+
+def _sql_columns() -> list[str]:
+    return [c.name for c in AioDataTable.__table__.columns if c.name != 'id']
+
+def _format_times(time_ns:np.ndarray) -> list[str]:
+    return [datetime.datetime.fromtimestamp(t/1E9).strftime(SQL_TIME_FORMAT) for t in time_ns.tolist()]
+
+# array fields in session column order and their number of columns, see storage.AioDataTable
+_SQL_GROUPS = (('ai_raw', NUM_CH_AI), ('ai_phy', NUM_CH_AI), ('ao_raw', NUM_CH_AO), ('ao_phy', NUM_CH_AO), ('param', NUM_CH_PARAM))
+_SQL_FIELDS = ['time_ns', 'seq', 'mono_ns'] + [name for name, _ in _SQL_GROUPS]
+
+def _flat_rows(views:dict[str, np.ndarray]) -> list[tuple]:
+    # fields the source does not have (seq and mono_ns of sessions recorded before
+    # they were logged) and missing channels are written as NULL
+    _rows = len(views['time_ns'])
+    _columns = [_format_times(views['time_ns'])]
+    for name in ('seq', 'mono_ns'):
+        _columns.append(views[name].tolist() if name in views else [None]*_rows)
+    for name, _width in _SQL_GROUPS:
+        _channels = views[name].T.tolist() if name in views else []
+        _columns += _channels[:_width] + [[None]*_rows]*(_width - len(_channels))
+    return list(zip(*_columns))
+
+def _remove_sqlite(path:str):
+    for _file in (path, path+'-wal', path+'-shm'):
+        if os.path.exists(_file):
+            os.remove(_file)
+
+def convert_to_sqlite(reader, out_path:str, rows:int=COLUMNAR_CONVERT_ROWS, progress=None) -> int:
+    # reader: ColumnarReader or archive.ArchiveReader. The file is built under a
+    # temporary name and renamed when complete, a failed conversion leaves nothing behind.
+    if os.path.exists(out_path):
+        raise FileExistsError(out_path)
+    _tmp = out_path + '.tmp'
+    _remove_sqlite(_tmp)
+    _fields = [name for name in _SQL_FIELDS if name in reader.fields]
+    _columns = _sql_columns()
+    _sql = 'INSERT INTO data (%s) VALUES (%s)'%(', '.join(_columns), ', '.join(['?']*len(_columns)))
+    _count = 0
+    _engine = create_sqlite_engine(_tmp)
+    try:
+        AioDataTable.metadata.create_all(_engine)
+        for _start in range(0, len(reader), rows):
+            _views = reader.read(_fields, _start, _start+rows)
+            with _engine.begin() as conn:
+                conn.exec_driver_sql(_sql, _flat_rows(_views))
+            _count += len(_views['time_ns'])
+            if progress:
+                progress(_count)
+        _gaps = reader.gaps
+        if _gaps:
+            _times = lambda ns: _format_times(np.array(ns, dtype=np.int64))
+            with _engine.begin() as conn:
+                conn.exec_driver_sql('INSERT INTO gaps (seq, frames, time, end_time, mono_ns) VALUES (?, ?, ?, ?, ?)', list(zip([g.seq for g in _gaps], [g.frames for g in _gaps], _times([g.time_ns for g in _gaps]), _times([g.end_time_ns for g in _gaps]), [g.mono_ns for g in _gaps])))
+        _engine.dispose()
+        os.replace(_tmp, out_path)
+    except BaseException:
+        _engine.dispose()
+        _remove_sqlite(_tmp)
+        raise
+    return _count
+
+def convert_to_csv(reader, out_path:str, rows:int=COLUMNAR_CONVERT_ROWS, progress=None) -> int:
+    if os.path.exists(out_path):
+        raise FileExistsError(out_path)
+    _fields = [name for name in _SQL_FIELDS + ['stale'] if name in reader.fields]
+    _count = 0
+    with open(out_path, 'w', newline='') as f:
+        _writer = csv.writer(f)
+        _writer.writerow(_sql_columns() + ['stale'])
+        for _start in range(0, len(reader), rows):
+            _views = reader.read(_fields, _start, _start+rows)
+            _stale = _views['stale'].tolist() if 'stale' in _views else [None]*len(_views['time_ns'])
+            _writer.writerows(r + (s,) for r, s in zip(_flat_rows(_views), _stale))
+            _count += len(_views['time_ns'])
+            if progress:
+                progress(_count)
+    return _count
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or convert a columnar (.msl) session')
+    parser.add_argument('session', help='session directory')
+    parser.add_argument('--to', choices=('sqlite', 'csv'), default=None, help='convert the session')
+    parser.add_argument('--out', default=None, help='output file (default: next to the session)')
+    args = parser.parse_args()
+
+    _reader = ColumnarReader(args.session)
+    if args.to is None:
+        _times = _reader.read(['time_ns'], 0, 1)['time_ns'].tolist() + _reader.read(['time_ns'], len(_reader)-1)['time_ns'].tolist()
+        print('%s: %d frames, %s'%(args.session, len(_reader), 'closed' if _reader.closed else 'recording'))
+        if _reader.gaps:
+            print('%d frames missing in %d gaps'%(sum(g.frames for g in _reader.gaps), len(_reader.gaps)))
+        if _times:
+            print('from %s to %s'%tuple(_format_times(np.array([_times[0], _times[-1]]))))
+        return
+
+    _out = args.out or os.path.splitext(args.session.rstrip('/\\'))[0] + ('.sqlite3' if args.to == 'sqlite' else '.csv')
+    _started = time.perf_counter()
+    def _progress(rows):
+        _elapsed = time.perf_counter() - _started
+        print('\r%d rows, %.0f rows/s'%(rows, rows/_elapsed if _elapsed > 0 else 0.0), end='', flush=True)
+    _convert = convert_to_sqlite if args.to == 'sqlite' else convert_to_csv
+    _count = _convert(_reader, _out, progress=_progress)
+    print()
+    print('Converted %d rows to %s in %.2f s'%(_count, _out, time.perf_counter() - _started))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1435 @@
+import os, time, json, platform, psutil, datetime, asyncio, tempfile
+import threading, queue, shutil, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import numpy as np
+
+import uvicorn
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Header
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, Response
+
+from channels import NUM_CH_AI, NUM_CH_AI_LIMIT, NUM_CH_AO, NUM_CH_AO_LIMIT, NUM_CH_PARAM, calc_phy
+from storage import SqlWriter, SessionReader, SQL_TIME_FORMAT, SQL_FRAME_COLUMNS, FRAME_DECIMATE_METHODS
+from columnar import ColumnarWriter, COLUMNAR_CHUNK_FRAMES
+from export import iter_csv, write_npz, session_columns, EXPORT_FORMATS
+from decimate import decimate, DECIMATE_METHODS
+from rollup import RollupWriter, RollupReader, rollup_columns, parse_time_keys, merge_reads, ROLLUP_STATS
+from catalog import SessionCatalog, overlapping
+from archive import archive_session, ARCHIVE_CODECS
+from params import ParamEngine, exprs_from_config
+from ringbuffer import FrameRingBuffer, frame_column
+from scheduler import TickScheduler, CommandQueue
+from fieldbus import FieldBus
+from broadcast import BroadcastHub
+from metrics import MetricsRegistry
+from wsproto import FrameCodec, WS_FORMATS, WS_SUBPROTOCOLS
+
+DEBUG = True
+
+MODBUS_COM_PORT = 'COM11'
+MODBUS_MODE = 'RTU'
+MODBUS_BAUDRATE = 38400
+MODBUS_SLAVE_ADDRESS = 1
+MODBUS_POLL_BUDGET = 0.8 # fraction of the interval to wait for the slowest bus
+
+WEB_PORT = 60080
+WEB_HOST = 'localhost' if DEBUG else '0.0.0.0'
+WS_PUBLISH_INTERVAL_MS = 1000 # clamped to the acquisition interval
+WS_CLIENT_QUEUE_SIZE = 4
+LATEST_WAIT_S = 30.0 # default and
+LATEST_MAX_WAIT_S = 120.0 # longest wait of a /latest long-poll
+
+APP_DATA_DIR_PATH = os.path.join(os.environ.get('APPDATA') or os.path.join(os.path.expanduser('~'), '.config'), 'ModbusSimpleLogger')
+TEMP_DATA_DIR_PATH = os.path.join(os.environ.get('TEMP') or tempfile.gettempdir(), 'ModbusSimpleLogger')
+DEFALUT_CONFIG_JSON_NAME = 'config.json'
+
+LOG_BACKENDS = ('sqlite', 'columnar')
+LOG_BACKEND = 'sqlite' # 'columnar' for high rate recording, see columnar.py
+LOG_ROTATE_MB = 1024 # continue the session in a new segment file above this size, 0: never
+LOG_ROTATE_HOURS = 24.0 # and after this long, 0: never
+LOG_ARCHIVE_CODEC = 'zlib' # compress closed segments in the background (archive.py), 'lzma' or None
+LOG_ARCHIVE_REMOVE_SOURCE = False # delete the session file once archived; /history and /trend then skip it
+LOG_ARCHIVE_WORKERS = 1
+LOG_SAVE_MODES = ('frames', 'timer')
+LOG_SAVE_MODE = 'frames' # every acquired frame once; 'timer' samples the latest values on its own timer
+LOG_DECIMATE = 'every' # or 'mean', frames mode when saving slower than acquiring, see storage.FrameDecimator
+
+SQL_SYNCHRONOUS = 'NORMAL'
+SQL_FLUSH_INTERVAL_MS = 1000
+SQL_FLUSH_ROWS = 1000
+SQL_QUEUE_SIZE = 60000
+SQL_ROLLUP = True # keep 1 s / 1 min / 1 h aggregates next to the raw rows, see rollup.py
+
+RING_BUFFER_CAPACITY = 6000 # frames, 10 min at 100 ms; see set_ring_buffer
+
+SCHEDULER_FINE_WAIT_MS = 2
+
+PARAM_TIME_BUDGET_MS = 1.0 # per tick, see params.py
+
+HISTORY_CHUNK_ROWS = 1000
+HISTORY_MAX_PAGE_ROWS = 100000
+HISTORY_MAX_POINTS = 20000 # per channel, decimated history
+HISTORY_DECIMATE_CHUNK_ROWS = 100000
+
+METRICS_STAGES = ('modbus_poll', 'param_calc', 'acquire', 'sql_enqueue', 'sql_flush', 'json_serialize', 'ao_write', 'command_wait')
+
+class AioFrame(NamedTuple):
+    seq: int
+    time_ns: int
+    mono_ns: int
+    ai_raw: np.ndarray
+    ai_phy: np.ndarray
+    ao_raw: np.ndarray
+    ao_phy: np.ndarray
+    param: np.ndarray
+    stale: int # bit n set: device n was not read in this frame
+
+def _readonly(arr:np.ndarray) -> np.ndarray:
+    arr.flags.writeable = False
+    return arr
+
+class ThreadSafeAioData():
+    # Arrays are never modified in place, setters swap in new read-only arrays,
+    # so a snapshot can hand out references without copying.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._calib_version = 0
+        self._time_ns = time.time_ns()
+        self._mono_ns = time.perf_counter_ns()
+        self._stale = 0
+        self._ai = _readonly(np.zeros(NUM_CH_AI, dtype=np.int16))
+        self._ao = _readonly(np.zeros(NUM_CH_AO, dtype=np.uint16))
+        self._ai_calib_a = _readonly(np.zeros(NUM_CH_AI, dtype=np.float32))
+        self._ai_calib_b = _readonly(np.ones(NUM_CH_AI, dtype=np.float32))
+        self._ai_calib_c = _readonly(np.zeros(NUM_CH_AI, dtype=np.float32))
+        self._ao_calib_a = _readonly(np.zeros(NUM_CH_AO, dtype=np.float32))
+        self._ao_calib_b = _readonly(np.ones(NUM_CH_AO, dtype=np.float32))
+        self._ao_calib_c = _readonly(np.zeros(NUM_CH_AO, dtype=np.float32))
+        self._param = _readonly(np.zeros(NUM_CH_PARAM, dtype=np.float32))
+        self._ai_phy = _readonly(calc_phy(self._ai, self._ai_calib_a, self._ai_calib_b, self._ai_calib_c))
+        self._ao_phy = _readonly(calc_phy(self._ao, self._ao_calib_a, self._ao_calib_b, self._ao_calib_c))
+        self._frame = None
+
+    def _touch(self):
+        self._seq += 1
+        self._frame = None
+
+    def _update_ai_phy(self):
+        self._ai_phy = _readonly(calc_phy(self._ai, self._ai_calib_a, self._ai_calib_b, self._ai_calib_c))
+
+    def _update_ao_phy(self):
+        self._ao_phy = _readonly(calc_phy(self._ao, self._ao_calib_a, self._ao_calib_b, self._ao_calib_c))
+
+    @property
+    def seq(self) -> int:
+        with self._lock:
+            return self._seq
+
+    @property
+    def calib_version(self) -> int:
+        with self._lock:
+            return self._calib_version
+
+    def snapshot(self) -> AioFrame:
+        with self._lock:
+            if self._frame is None:
+                self._frame = AioFrame(self._seq, self._time_ns, self._mono_ns, self._ai, self._ai_phy, self._ao, self._ao_phy, self._param, self._stale)
+            return self._frame
+
+    def get_param_phy(self, ch:int) -> float:
+        if ch < 0 or ch >= NUM_CH_PARAM:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            return float(self._param[ch])
+
+    def set_param_phy(self, value:float, ch:int):
+        if ch < 0 or ch >= NUM_CH_PARAM:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            _param = self._param.copy()
+            _param[ch] = np.float32(value)
+            self._param = _readonly(_param)
+            self._touch()
+
+    def get_param_phy_all(self) -> list[float]:
+        with self._lock:
+            return self._param.tolist()
+
+    def set_param_phy_all(self, data:list[float]):
+        if len(data) != NUM_CH_PARAM:
+            raise ValueError('Invalid data shape')
+        with self._lock:
+            self._param = _readonly(np.array(data, dtype=np.float32))
+            self._touch()
+
+    def get_ai_calib(self, ch:int) -> tuple[float, float, float]:
+        if ch < 0 or ch >= NUM_CH_AI:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            return (float(self._ai_calib_a[ch]), float(self._ai_calib_b[ch]), float(self._ai_calib_c[ch]))
+
+    def set_ai_calib(self, a:float, b:float, c:float, ch:int):
+        if ch < 0 or ch >= NUM_CH_AI:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            _a, _b, _c = self._ai_calib_a.copy(), self._ai_calib_b.copy(), self._ai_calib_c.copy()
+            _a[ch], _b[ch], _c[ch] = np.float32(a), np.float32(b), np.float32(c)
+            self._ai_calib_a, self._ai_calib_b, self._ai_calib_c = _readonly(_a), _readonly(_b), _readonly(_c)
+            self._update_ai_phy()
+            self._calib_version += 1
+            self._touch()
+
+    def get_ao_calib(self, ch:int) -> tuple[float, float, float]:
+        if ch < 0 or ch >= NUM_CH_AO:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            return (float(self._ao_calib_a[ch]), float(self._ao_calib_b[ch]), float(self._ao_calib_c[ch]))
+
+    def set_ao_calib(self, a:float, b:float, c:float, ch:int):
+        if ch < 0 or ch >= NUM_CH_AO:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            _a, _b, _c = self._ao_calib_a.copy(), self._ao_calib_b.copy(), self._ao_calib_c.copy()
+            _a[ch], _b[ch], _c[ch] = np.float32(a), np.float32(b), np.float32(c)
+            self._ao_calib_a, self._ao_calib_b, self._ao_calib_c = _readonly(_a), _readonly(_b), _readonly(_c)
+            self._update_ao_phy()
+            self._calib_version += 1
+            self._touch()
+
+    def get_ai_phy(self, ch:int) -> float:
+        if ch < 0 or ch >= NUM_CH_AI:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            return float(self._ai_phy[ch])
+
+    def get_ai_phy_all(self) -> list[float]:
+        with self._lock:
+            return self._ai_phy.tolist()
+
+    def get_ao_phy(self, ch:int) -> float:
+        if ch < 0 or ch >= NUM_CH_AO:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            return float(self._ao_phy[ch])
+
+    def get_ao_phy_all(self) -> list[float]:
+        with self._lock:
+            return self._ao_phy.tolist()
+
+    def get_ai_raw(self, ch:int) -> int:
+        if ch < 0 or ch >= NUM_CH_AI:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            return int(self._ai[ch])
+
+    def get_ai_raw_all(self) -> list[int]:
+        with self._lock:
+            return self._ai.tolist()
+
+    def set_ai_raw(self, data:int, ch:int):
+        if ch < 0 or ch >= NUM_CH_AI:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            _ai = self._ai.copy()
+            _ai[ch] = np.int16(data)
+            self._ai = _readonly(_ai)
+            self._update_ai_phy()
+            self._touch()
+
+    def calc_ai_phy(self, data:list[int]) -> np.ndarray:
+        # ai_phy of the given raw values with the current calibration, nothing is stored
+        with self._lock:
+            _a, _b, _c = self._ai_calib_a, self._ai_calib_b, self._ai_calib_c
+        return calc_phy(np.array(data, dtype=np.int16), _a, _b, _c)
+
+    def set_ai_raw_all(self, data:list[int], time_ns:int|None=None, mono_ns:int|None=None, stale:int=0, param:list[float]|None=None):
+        # param: computed from these values, published with them as one frame
+        if len(data) != NUM_CH_AI or (param is not None and len(param) != NUM_CH_PARAM):
+            raise ValueError('Invalid data shape')
+        _ai = _readonly(np.array(data, dtype=np.int16))
+        _param = None if param is None else _readonly(np.array(param, dtype=np.float32))
+        with self._lock:
+            self._ai = _ai
+            self._update_ai_phy()
+            if _param is not None:
+                self._param = _param
+            self._time_ns = time.time_ns() if time_ns is None else time_ns
+            self._mono_ns = time.perf_counter_ns() if mono_ns is None else mono_ns
+            self._stale = stale
+            self._touch()
+
+    def get_ao_raw(self, ch:int):
+        if ch < 0 or ch >= NUM_CH_AO:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            return int(self._ao[ch])
+
+    def get_ao_raw_all(self) -> list[int]:
+        with self._lock:
+            return self._ao.tolist()
+
+    def set_ao_raw(self, data:int, ch:int):
+        if ch < 0 or ch >= NUM_CH_AO:
+            raise ValueError('Invalid channel')
+        with self._lock:
+            _ao = self._ao.copy()
+            _ao[ch] = np.uint16(data)
+            self._ao = _readonly(_ao)
+            self._update_ao_phy()
+            self._touch()
+
+    def set_ao_raw_all(self, data:list[int]):
+        if len(data) != NUM_CH_AO:
+            raise ValueError('Invalid data shape')
+        with self._lock:
+            self._ao = _readonly(np.array(data, dtype=np.uint16))
+            self._update_ao_phy()
+            self._touch()
+
+class ChannelMeta():
+    # Labels and units of every channel as plain data, so other threads never
+    # touch the Tk entries. version is bumped on every change.
+    KINDS = {'ai': NUM_CH_AI, 'ao': NUM_CH_AO, 'param': NUM_CH_PARAM}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        self._label = {k: tuple("%s CH %d LABEL"%('Param' if k == 'param' else k.upper(), ch) for ch in range(n)) for k, n in self.KINDS.items()}
+        self._unit = {k: ('nan',)*n for k, n in self.KINDS.items()}
+
+    @property
+    def version(self) -> int:
+        with self._lock:
+            return self._version
+
+    def get(self, kind:str) -> tuple[tuple[str, ...], tuple[str, ...]]:
+        with self._lock:
+            return self._label[kind], self._unit[kind]
+
+    def load_config(self, config:dict):
+        for _kind in self.KINDS:
+            if _kind in config:
+                self.update(_kind, [c['label'] for c in config[_kind]], [c['unit'] for c in config[_kind]])
+
+    def update(self, kind:str, labels:list[str], units:list[str]):
+        if len(labels) != self.KINDS[kind] or len(units) != self.KINDS[kind]:
+            raise ValueError('Invalid data shape')
+        _labels, _units = tuple(labels), tuple(units)
+        with self._lock:
+            if _labels == self._label[kind] and _units == self._unit[kind]:
+                return
+            self._label[kind], self._unit[kind] = _labels, _units
+            self._version += 1
+
+def convert_hx711_raw2vlt(raw:int):
+    return float(raw)/32768.0/128.0/2*1E3
+
+def convert_hx711_raw2ust(raw:int):
+    return float(raw)/32768.0/128.0/2*1E3*2E3
+
+def convert_ads1115_raw2vlt(raw:int):
+    return float(raw)/32768.0*6.144
+
+def convert_gp8403_raw2vlt(raw:int):
+    return float(raw)/1000.0
+
+# the converters are linear, per channel factors convert whole frames at once
+AI_VLT_SCALE = np.array([convert_hx711_raw2vlt(1) if ch < int(NUM_CH_AI/2) else convert_ads1115_raw2vlt(1) for ch in range(NUM_CH_AI)])
+AI_UST_SCALE = np.array([convert_hx711_raw2ust(1) for ch in range(int(NUM_CH_AI/2))])
+AO_VLT_SCALE = np.array([convert_gp8403_raw2vlt(1) for ch in range(NUM_CH_AO)])
+
+def create_key_labels(meta:ChannelMeta) -> tuple[dict, dict]:
+    # label and unit of every data key, see data_json.md
+    json_label = {"time": "Time"}
+    json_unit = {"time": None }
+    _labels, _units = meta.get('ai')
+    for ch in range(NUM_CH_AI):
+        json_label['ai_raw_%d'%ch] = _labels[ch]
+        json_unit['ai_raw_%d'%ch] = 'i16'
+        json_label['ai_phy_%d'%ch] = _labels[ch]
+        json_unit['ai_phy_%d'%ch] = _units[ch]
+        json_label['ai_vlt_%d'%ch] = _labels[ch]
+        json_unit['ai_vlt_%d'%ch] = 'mV/V' if ch < int(NUM_CH_AI/2) else 'V'
+    _labels, _units = meta.get('ao')
+    for ch in range(NUM_CH_AO):
+        json_label['ao_raw_%d'%ch] = _labels[ch]
+        json_unit['ao_raw_%d'%ch] = 'i16'
+        json_label['ao_phy_%d'%ch] = _labels[ch]
+        json_unit['ao_phy_%d'%ch] = _units[ch]
+        json_label['ao_vlt_%d'%ch] = _labels[ch]
+        json_unit['ao_vlt_%d'%ch] = 'V'
+    _labels, _units = meta.get('param')
+    for ch in range(NUM_CH_PARAM):
+        json_label['param_phy_%d'%ch] = _labels[ch]
+        json_unit['param_phy_%d'%ch] = _units[ch]
+    return json_label, json_unit
+
+def _archive_worker_init():
+    # archive workers must never compete with acquisition for the CPU
+    if platform.system() == 'Windows':
+        psutil.Process(os.getpid()).nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+    else:
+        os.nice(10)
+
+def prepare_process():
+    if not os.path.exists(TEMP_DATA_DIR_PATH):
+        os.makedirs(TEMP_DATA_DIR_PATH)
+    if not os.path.exists(APP_DATA_DIR_PATH):
+        os.makedirs(APP_DATA_DIR_PATH)
+
+    if platform.system() == 'Windows':
+        proc = psutil.Process(os.getpid())
+        proc.nice(psutil.REALTIME_PRIORITY_CLASS)
+
+class LoggerCore():
+    # Acquisition, storage and the web API without any UI. The Tk application and
+    # the headless entry point are both thin clients of this class.
+    BG_CMD_MODBUS_START = 'modbus_start'
+    BG_CMD_MODBUS_STOP = 'modbus_stop'
+    BG_CMD_SQL_SAVE_START = 'sql_save_start'
+    BG_CMD_SQL_SAVE_STOP = 'sql_save_stop'
+    BG_CMD_TERMINATE = 'terminate'
+    BG_CMD_AO_SEND = 'ao_send'
+    BG_CMD_AI_RECEIVE = 'ai_receive'
+    BG_CMD_CHANGE_INTERVAL = 'change_interval'
+
+    JOB_AI_RECEIVE = 'ai_receive'
+    JOB_SQL_SAVE = 'sql_save'
+    JOB_WS_PUBLISH = 'ws_publish'
+
+    _aio = ThreadSafeAioData()
+    _channel_meta = ChannelMeta()
+    _ring_buffer = FrameRingBuffer(RING_BUFFER_CAPACITY, NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM)
+    
+    _log_writer = None
+    _log_path = ""
+    _log_session = ""
+    _log_rotate_mb = LOG_ROTATE_MB
+    _log_rotate_hours = LOG_ROTATE_HOURS
+    _catalog = None
+    _archive_pool = None
+    _archive_codec = LOG_ARCHIVE_CODEC
+    _archive_remove_source = LOG_ARCHIVE_REMOVE_SOURCE
+    _archive_lock: threading.Lock
+    _archive_pending: int
+    _archive_counts: dict
+    _sql_save_interval_ms = 100
+    _log_decimate = LOG_DECIMATE
+    _frame_seq = 0 # acquisition frames of the current session, gaps included
+
+    _webserver_thread = None
+    _ws_hub = None
+    _ws_codec = FrameCodec(NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM)
+    _ws_meta_cache = None
+    _json_meta_cache = None
+    _fastapi_app = FastAPI()
+
+    _modbus_thread = None
+    # AO first; commands that only sync state are not queued twice
+    _modbus_msg_queue = CommandQueue({BG_CMD_AO_SEND: 0}, (BG_CMD_AO_SEND, BG_CMD_AI_RECEIVE, BG_CMD_CHANGE_INTERVAL))
+    _fieldbus = None
+    _modbus_interval_ms = 100
+    _ws_publish_interval_ms = WS_PUBLISH_INTERVAL_MS
+    _modbus_scheduler = TickScheduler()
+
+    _param_exprs: list[str] = [''] * NUM_CH_PARAM
+    _param_engine: ParamEngine
+
+    _metrics: MetricsRegistry
+    _metric_stage: dict
+    _log_rows_closed: list[int]
+    _started_at: float
+
+    def __init__(self, config_path:str|None=None, web_host:str=WEB_HOST, web_port:int=WEB_PORT, log_backend:str=LOG_BACKEND, log_mode:str=LOG_SAVE_MODE):
+        if log_backend not in LOG_BACKENDS:
+            raise ValueError('Invalid log backend: %s'%log_backend)
+        if log_mode not in LOG_SAVE_MODES:
+            raise ValueError('Invalid log mode: %s'%log_mode)
+        self._config_path = config_path or os.path.join(APP_DATA_DIR_PATH, DEFALUT_CONFIG_JSON_NAME)
+        self._log_backend = log_backend
+        self._log_mode = log_mode
+        self._web_host = web_host
+        self._web_port = web_port
+        self._webserver_url = "ws://%s:%d"%(web_host, web_port)
+
+        # per instance, a second core in the same process starts from zero
+        self._metrics = MetricsRegistry()
+        self._metric_stage = {}
+        self._log_rows_closed = [0, 0, 0, 0] # written, dropped, missed, writer errors by sessions already closed
+        self._started_at = time.time()
+        # submit runs on the writer thread, done callbacks on the pool's result thread
+        self._archive_lock = threading.Lock()
+        self._archive_pending = 0
+        self._archive_counts = {'done': 0, 'failed': 0}
+
+        self._config_json = {}
+        self._config_load_json()
+
+        # restore calib values to AIO
+        for ch in range(NUM_CH_AI):
+            _a, _b, _c = self._config_json['ai'][ch]['calib']
+            self._aio.set_ai_calib(_a, _b, _c, ch)
+        for ch in range(NUM_CH_AO):
+            _a, _b, _c = self._config_json['ao'][ch]['calib']
+            self._aio.set_ao_calib(_a, _b, _c, ch)
+        self._channel_meta.load_config(self._config_json)
+        _exprs = (exprs_from_config(self._config_json) + [''] * NUM_CH_PARAM)[:NUM_CH_PARAM]
+        try:
+            self.set_param_exprs(_exprs)
+        except ValueError:
+            # run the channels that compile, keep every text for the saved config
+            _valid = []
+            for ch, _expr in enumerate(_exprs):
+                try:
+                    ParamEngine([_expr if i == ch else '' for i in range(NUM_CH_PARAM)], NUM_CH_AI, NUM_CH_AO)
+                    _valid.append(_expr)
+                except ValueError as e:
+                    print('Failed to compile param expression')
+                    print(e)
+                    _valid.append('')
+            self._param_engine = ParamEngine(_valid, NUM_CH_AI, NUM_CH_AO, PARAM_TIME_BUDGET_MS)
+            self._param_exprs = _exprs
+        self._util_metrics_create()
+
+    @property
+    def aio(self) -> ThreadSafeAioData:
+        return self._aio
+
+    @property
+    def channel_meta(self) -> ChannelMeta:
+        return self._channel_meta
+
+    @property
+    def config_json(self) -> dict:
+        return self._config_json
+
+    @property
+    def webserver_url(self) -> str:
+        return self._webserver_url
+
+    @property
+    def metrics(self) -> MetricsRegistry:
+        return self._metrics
+
+    def stage_histogram(self, stage:str):
+        # also used by the UI for stages outside the core, e.g. the display update
+        return self._metrics.histogram('stage_seconds', 'Latency of one hot path stage', {'stage': stage})
+
+    def start(self):
+        if not self._catalog:
+            self._catalog = SessionCatalog(TEMP_DATA_DIR_PATH)
+            _added = self._catalog.scan()
+            if _added:
+                print('Catalog: Added %d session files'%_added)
+            # segments closed while no archive worker was around, e.g. before a restart
+            for _segment in self._catalog.unarchived() if self._archive_codec else []:
+                self._bg_archive_submit(_segment['session'], _segment['segment'], _segment['path'])
+
+        if not self._ws_hub:
+            self._bg_webserver_create_hub()
+
+        if not self._modbus_thread:
+            self._modbus_thread = threading.Thread(target=self._bg_modbus_thread, daemon=True)
+            self._modbus_thread.name = 'ModbusThread'
+            self._modbus_thread.start()
+            self._modbus_msg_queue.put(self.BG_CMD_MODBUS_START)
+            self._modbus_msg_queue.put(self.BG_CMD_AO_SEND)
+            self._modbus_msg_queue.put(self.BG_CMD_AI_RECEIVE)
+
+        if not self._webserver_thread:
+            self._webserver_thread = threading.Thread(target=self._bg_webserver_thread, daemon=True)
+            self._webserver_thread.name = 'WebServerThread'
+            self._webserver_thread.start()
+
+    def stop(self):
+        if self._modbus_thread:
+            self._modbus_msg_queue.put(self.BG_CMD_MODBUS_STOP)
+            self._modbus_msg_queue.put(self.BG_CMD_TERMINATE)
+            self._modbus_thread.join()
+            self._modbus_thread = None
+        if self._archive_pool:
+            # the running archive is finished, the queued ones are picked up at the next start
+            if self._archive_pending:
+                print('Background: Waiting for the running archive')
+            self._archive_pool.shutdown(wait=True, cancel_futures=True)
+            self._archive_pool = None
+
+    def send_command(self, cmd:str):
+        _fieldbus = self._fieldbus
+        if cmd == self.BG_CMD_AO_SEND and _fieldbus:
+            # AO values are shared state and the lanes take writes from any thread,
+            # so a setpoint does not wait for the worker, which may sit in a poll
+            _fieldbus.write_ao(self._aio.get_ao_raw_all())
+            return
+        self._modbus_msg_queue.put(cmd)
+
+    def set_sql_save_interval(self, interval_ms:int, decimate:str|None=None):
+        # in frames mode: keep every Nth acquired frame, N = interval / acquisition interval
+        if interval_ms <= 0 or (decimate is not None and decimate not in FRAME_DECIMATE_METHODS):
+            raise ValueError('Invalid interval')
+        self._sql_save_interval_ms = interval_ms
+        if decimate is not None:
+            self._log_decimate = decimate
+        self._modbus_msg_queue.put(self.BG_CMD_CHANGE_INTERVAL)
+
+    def set_log_rotation(self, max_mb:float, max_hours:float):
+        # from the next session on, 0 for no limit
+        if max_mb < 0 or max_hours < 0:
+            raise ValueError('Invalid rotation')
+        self._log_rotate_mb = max_mb
+        self._log_rotate_hours = max_hours
+
+    def set_log_archive(self, codec:str|None, remove_source:bool=False):
+        # for segments closed from now on, None to keep only the session files
+        if codec is not None and codec not in ARCHIVE_CODECS:
+            raise ValueError('Invalid archive codec: %s'%codec)
+        self._archive_codec = codec
+        self._archive_remove_source = remove_source
+
+    def set_ring_buffer(self, capacity:int):
+        # frames kept in memory for /history?source=memory, the ones held so far are dropped
+        self._ring_buffer = FrameRingBuffer(capacity, NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM)
+
+    def set_modbus_interval(self, interval_ms:int, publish_interval_ms:int|None=None):
+        # acquisition period, and the WebSocket publish period (never faster than acquisition)
+        if interval_ms <= 0 or (publish_interval_ms is not None and publish_interval_ms <= 0):
+            raise ValueError('Invalid interval')
+        self._modbus_interval_ms = interval_ms
+        if publish_interval_ms is not None:
+            self._ws_publish_interval_ms = publish_interval_ms
+        self._modbus_msg_queue.put(self.BG_CMD_CHANGE_INTERVAL)
+
+    def save_config(self):
+        self._config_save_json()
+
+    def set_param_exprs(self, exprs:list[str]):
+        # compiled here, the worker picks the new plan up at its next tick
+        if len(exprs) != NUM_CH_PARAM:
+            raise ValueError('Invalid data shape')
+        self._param_engine = ParamEngine(exprs, NUM_CH_AI, NUM_CH_AO, PARAM_TIME_BUDGET_MS)
+        self._param_exprs = list(exprs)
+
+    def _util_metrics_create(self):
+        _m = self._metrics
+        self._metric_stage = {stage: self.stage_histogram(stage) for stage in METRICS_STAGES}
+        self._modbus_msg_queue.wait_latency = self._metric_stage['command_wait']
+        self._metric_frames = _m.counter('frames_acquired_total', 'Polls that returned fresh AI values')
+        self._metric_frames_failed = _m.counter('frames_failed_total', 'Polls without any fresh AI value')
+        self._metric_frames_stale = _m.counter('frames_stale_total', 'Frames with at least one stale device')
+        self._metric_latest = {_status: _m.counter('latest_responses_total', 'Responses of /latest', {'status': str(_status)}) for _status in (200, 304)}
+        self._metric_ws_sent = _m.counter('ws_messages_sent_total', 'WebSocket messages sent')
+        _m.counter('ws_messages_dropped_total', 'WebSocket messages dropped for slow clients', source=lambda: self._ws_hub.dropped if self._ws_hub else 0)
+        _m.counter('ws_frames_serialized_total', 'Frames serialized for WebSocket clients', source=lambda: self._ws_hub.serialized if self._ws_hub else 0)
+        _m.counter('rows_written_total', 'Rows written to session files', source=lambda: self._log_rows_closed[0] + (self._log_writer.rows_written if self._log_writer else 0))
+        _m.counter('rows_dropped_total', 'Rows dropped by the session writer', source=lambda: self._log_rows_closed[1] + (self._log_writer.rows_dropped if self._log_writer else 0))
+        _m.counter('frames_missed_total', 'Acquisition frames recorded as gaps', source=lambda: self._log_rows_closed[2] + (self._log_writer.frames_missed if self._log_writer else 0))
+        _m.counter('writer_errors_total', 'Failed writes, rotations and closes of the session writer', source=lambda: self._log_rows_closed[3] + (self._log_writer.errors if self._log_writer else 0))
+        _m.counter('param_overruns_total', 'Param calculations over PARAM_TIME_BUDGET_MS', source=lambda: self._param_engine.overruns)
+        for _kind in ('read_errors', 'write_errors', 'disconnects', 'busy_skips'):
+            _m.counter('modbus_errors_total', 'Modbus errors of the current connection set', {'kind': _kind}, source=lambda k=_kind: self._fieldbus.error_counts()[k] if self._fieldbus else 0)
+        for _kind in ('requested', 'written'):
+            _m.counter('ao_writes_total', 'AO setpoints requested and bus writes made for them', {'kind': _kind}, source=lambda k=_kind: self._fieldbus.ao_counts()[k] if self._fieldbus else 0)
+        _m.counter('commands_collapsed_total', 'Worker commands merged into one already waiting', source=lambda: self._modbus_msg_queue.collapsed)
+        for _job in (self.JOB_AI_RECEIVE, self.JOB_SQL_SAVE, self.JOB_WS_PUBLISH):
+            for _key in ('ticks', 'missed', 'overruns'):
+                _m.counter('scheduler_%s_total'%_key, 'Scheduler job %s'%_key, {'job': _job}, source=lambda j=_job, k=_key: self._util_job_stat(j, k))
+            _m.gauge('scheduler_jitter_max_seconds', 'Largest start delay of a job', lambda j=_job: self._util_job_stat(j, 'jitter_max_us')/1E6, {'job': _job})
+        for _result in self._archive_counts:
+            _m.counter('archives_total', 'Closed segments compressed into archives', {'result': _result}, source=lambda r=_result: self._archive_counts[r])
+        _m.gauge('archive_queue_depth', 'Closed segments waiting for or being archived', lambda: self._archive_pending)
+        _m.gauge('sql_queue_depth', 'Frames waiting for the session writer', lambda: self._log_writer.pending if self._log_writer else 0)
+        _m.gauge('command_queue_depth', 'Commands waiting for the Modbus thread', self._modbus_msg_queue.qsize)
+        _m.gauge('ws_queue_depth', 'Messages waiting in WebSocket client queues', lambda: self._ws_hub.pending if self._ws_hub else 0)
+        _m.gauge('latest_waiters', 'Long-polls waiting on /latest', lambda: self._ws_hub.num_waiters if self._ws_hub else 0)
+        _m.gauge('ws_subscribers', 'Connected WebSocket clients', lambda: self._ws_hub.num_subscribers if self._ws_hub else 0)
+        _m.gauge('ring_buffer_frames', 'Frames held in memory for /history?source=memory', lambda: len(self._ring_buffer))
+
+    def _util_save_decimation(self) -> int:
+        return max(1, round(self._sql_save_interval_ms / self._modbus_interval_ms))
+
+    def _util_job_stat(self, job:str, key:str) -> float:
+        return self._modbus_scheduler.stats().get(job, {}).get(key, 0)
+
+    def _util_archive_stats(self) -> dict:
+        # one snapshot, pending and the counts move together when an archive finishes
+        with self._archive_lock:
+            return {'pending': self._archive_pending, **self._archive_counts}
+
+    def _config_create_json(self):
+        ret = {}
+        _labels, _units = self._channel_meta.get('ai')
+        ret['ai'] = [{'label': _labels[ch], 'unit': _units[ch], 'calib': self._aio.get_ai_calib(ch)} for ch in range(NUM_CH_AI)]
+        _labels, _units = self._channel_meta.get('ao')
+        ret['ao'] = [{'label': _labels[ch], 'unit': _units[ch], 'calib': self._aio.get_ao_calib(ch)} for ch in range(NUM_CH_AO)]
+        _labels, _units = self._channel_meta.get('param')
+        ret['param'] = [{'label': _labels[ch], 'unit': _units[ch], 'expr': self._param_exprs[ch]} for ch in range(NUM_CH_PARAM)]
+
+        ret['devices'] = self._config_json.get('devices') or self._config_default_devices()
+        
+        return ret
+
+    def _config_default_devices(self) -> list[dict]:
+        return [{
+            'name': 'dev0',
+            'port': MODBUS_COM_PORT,
+            'mode': MODBUS_MODE,
+            'baudrate': MODBUS_BAUDRATE,
+            'slave': MODBUS_SLAVE_ADDRESS,
+            'ai': [0, NUM_CH_AI_LIMIT],
+            'ao': [0, NUM_CH_AO_LIMIT],
+        }]
+
+    def _config_save_json(self):
+        self._config_json = self._config_create_json()
+        with open(self._config_path, 'w') as f:
+            json.dump(self._config_json, f)
+
+    def _config_load_json(self):
+        if not os.path.exists(self._config_path):
+            self._config_json = self._config_create_json()
+            return
+        try:
+            with open(self._config_path, 'r') as f:
+                self._config_json = json.load(f)
+            # a hand written config may only list devices, fill in the rest
+            for _key, _value in self._config_create_json().items():
+                if not self._config_json.get(_key):
+                    self._config_json[_key] = _value
+        except Exception as e:
+            print('Failed to load %s'%self._config_path)
+            print(e)
+            self._config_json = self._config_create_json()
+
+    def _bg_sql_save_stop(self):
+        if not self._log_writer:
+            return
+
+        try:
+            self._log_writer.stop()
+        except Exception as e:
+            print('Background: Failed to stop the session writer')
+            print(e)
+        try:
+            self._catalog.close_session(self._log_session)
+        except Exception as e:
+            print('Background: Failed to update catalog')
+            print(e)
+        self._log_rows_closed[0] += self._log_writer.rows_written
+        self._log_rows_closed[1] += self._log_writer.rows_dropped
+        self._log_rows_closed[2] += self._log_writer.frames_missed
+        self._log_rows_closed[3] += self._log_writer.errors
+        print('Background: Database closed: %s, rows: %d, dropped: %d, missed frames: %d'%(self._log_path, self._log_writer.rows_written, self._log_writer.rows_dropped, self._log_writer.frames_missed))
+        self._log_writer = None
+        self._log_path = ""
+        self._log_session = ""
+
+    def _bg_sql_save_start(self):
+        if self._log_writer:
+            self._bg_sql_save_stop()
+        _name = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        if self._log_backend == 'columnar':
+            self._log_path = os.path.join(TEMP_DATA_DIR_PATH, '%s.msl'%_name)
+            self._log_writer = ColumnarWriter(self._log_path, NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM, meta=self._bg_create_channel_info(), chunk_frames=COLUMNAR_CHUNK_FRAMES, flush_interval_ms=SQL_FLUSH_INTERVAL_MS, flush_rows=SQL_FLUSH_ROWS, queue_size=SQL_QUEUE_SIZE)
+        else:
+            self._log_path = os.path.join(TEMP_DATA_DIR_PATH, '%s.sqlite3'%_name)
+            _writer = RollupWriter if SQL_ROLLUP else SqlWriter
+            self._log_writer = _writer(self._log_path, synchronous=SQL_SYNCHRONOUS, flush_interval_ms=SQL_FLUSH_INTERVAL_MS, flush_rows=SQL_FLUSH_ROWS, queue_size=SQL_QUEUE_SIZE)
+        self._log_writer.flush_latency = self._metric_stage['sql_flush']
+        self._log_writer.set_rotation(int(self._log_rotate_mb*1E6), self._log_rotate_hours*3600.0)
+        self._log_writer.on_segment = lambda info, name=_name: self._bg_catalog_update(name, info)
+        self._log_session = _name
+        try:
+            self._catalog.open_session(_name, self._log_backend, self._bg_create_channel_info())
+        except Exception as e:
+            print('Background: Failed to update catalog')
+            print(e)
+        if self._log_mode == 'frames':
+            self._log_writer.set_decimation(self._util_save_decimation(), self._log_decimate)
+        self._frame_seq = 0
+        self._log_writer.start()
+        print('Background: Database created')
+        print('Background: Database path: %s'%self._log_path)
+
+    def _bg_catalog_update(self, name:str, info:dict):
+        # writer thread, after each flush and when a segment is closed
+        try:
+            self._catalog.update_segment(name, info)
+        except Exception as e:
+            print('Background: Failed to update catalog')
+            print(e)
+        if info['closed'] and info['rows'] and self._archive_codec:
+            self._bg_archive_submit(name, info['segment'], info['path'])
+
+    def _bg_archive_submit(self, name:str, segment:int, path:str):
+        # spawned worker processes: no GIL shared with acquisition, nothing forked from its threads
+        if not self._archive_pool:
+            self._archive_pool = ProcessPoolExecutor(max_workers=LOG_ARCHIVE_WORKERS, mp_context=multiprocessing.get_context('spawn'), initializer=_archive_worker_init)
+        try:
+            _meta = (self._catalog.session(name) or {}).get('meta')
+            _future = self._archive_pool.submit(archive_session, path, None, _meta, self._archive_codec)
+        except Exception as e:
+            print('Background: Failed to start archive of %s'%path)
+            print(e)
+            return
+        with self._archive_lock:
+            self._archive_pending += 1
+        _future.add_done_callback(lambda f, remove=self._archive_remove_source: self._bg_archive_done(name, segment, path, remove, f))
+
+    def _bg_archive_done(self, name:str, segment:int, path:str, remove_source:bool, future):
+        with self._archive_lock:
+            self._archive_pending -= 1
+        if future.cancelled():
+            return
+        try:
+            _result = future.result()
+            self._catalog.set_archive(name, segment, _result['path'], _result['bytes'], remove_source)
+        except Exception as e:
+            with self._archive_lock:
+                self._archive_counts['failed'] += 1
+            print('Background: Failed to archive %s'%path)
+            print(e)
+            return
+        with self._archive_lock:
+            self._archive_counts['done'] += 1
+        print('Background: Archived %s, %.1f MB -> %.1f MB'%(path, _result['source_bytes']/1E6, _result['bytes']/1E6))
+        if not remove_source:
+            return
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                for _path in (path, path+'-wal', path+'-shm'):
+                    if os.path.exists(_path):
+                        os.remove(_path)
+        except Exception as e:
+            print('Background: Failed to remove %s'%path)
+            print(e)
+
+    def _bg_sql_save(self, frame:AioFrame|None=None):
+        # frame: the one just acquired in frames mode; the timer samples the latest values
+        if not self._log_writer:
+            return
+        _started = time.perf_counter()
+        if frame is None:
+            frame = self._aio.snapshot()._replace(seq=max(0, self._frame_seq - 1))
+        _ok = self._log_writer.put(frame)
+        self._metric_stage['sql_enqueue'].observe(time.perf_counter() - _started)
+        if not _ok and DEBUG:
+            print('Background: Save queue full, row dropped')
+
+    def _bg_modbus_calc_param(self, ai_raw:list[int], mono_ns:int) -> list[float]|None:
+        # params of the AI values just read, before they are published; None keeps the last ones
+        _engine = self._param_engine
+        if not _engine.channels:
+            return None
+        try:
+            _started = time.perf_counter()
+            _frame = self._aio.snapshot()
+            _overruns = _engine.overruns
+            ret = _engine.step(self._aio.calc_ai_phy(ai_raw), _frame.ao_phy, _frame.param, mono_ns/1E9)
+            self._metric_stage['param_calc'].observe(time.perf_counter() - _started)
+            # 1st, 2nd, 4th, 8th... overrun
+            if _engine.overruns != _overruns and _engine.overruns & (_engine.overruns - 1) == 0:
+                print('Background: Param calculation over budget, %.2f ms (%d times)'%(_engine.last_ms, _engine.overruns))
+            return ret
+        except Exception as e:
+            print('Background: Failed to calc param')
+            print(e)
+            return None
+
+    def _bg_modbus_acquire(self):
+        _started = time.perf_counter()
+        _ok = self._bg_modbus_sync_ai_all()
+        _seq = self._frame_seq
+        _save = self._log_mode == 'frames' and self._log_writer
+        if _ok:
+            _frame = self._aio.snapshot()
+            self._ring_buffer.append(_frame)
+            self._metric_frames.inc()
+            if _frame.stale:
+                self._metric_frames_stale.inc()
+            if _save:
+                self._bg_sql_save(_frame._replace(seq=_seq))
+            self._ws_hub.request_wake()
+        elif self._fieldbus:
+            self._metric_frames_failed.inc()
+            if _save:
+                self._log_writer.put_gap(_seq, time.time_ns(), time.perf_counter_ns())
+        if self._fieldbus:
+            self._frame_seq += 1
+        self._metric_stage['acquire'].observe(time.perf_counter() - _started)
+
+    def _bg_modbus_thread(self):
+        _scheduler = self._modbus_scheduler
+        _scheduler.add_job(self.JOB_AI_RECEIVE, self._modbus_interval_ms, self._bg_modbus_acquire)
+        _scheduler.add_job(self.JOB_SQL_SAVE, self._sql_save_interval_ms, self._bg_sql_save)
+        _scheduler.add_job(self.JOB_WS_PUBLISH, max(self._ws_publish_interval_ms, self._modbus_interval_ms), self._ws_hub.request_publish)
+        _scheduler.start_job(self.JOB_WS_PUBLISH)
+
+        while True:
+            _timeout = _scheduler.timeout()
+            try:
+                if _timeout is not None and _timeout <= SCHEDULER_FINE_WAIT_MS/1000.0:
+                    # lock timeouts are coarse on some platforms, sleep out the last few ms;
+                    # at intervals this short commands are only picked up between ticks
+                    time.sleep(_timeout)
+                    _scheduler.run_due()
+                    msg = self._modbus_msg_queue.get_nowait()
+                else:
+                    msg = self._modbus_msg_queue.get(timeout=None if _timeout is None else _timeout - SCHEDULER_FINE_WAIT_MS/1000.0)
+            except queue.Empty:
+                continue
+            match msg:
+                case self.BG_CMD_TERMINATE:
+                    self._bg_sql_save_stop()
+                    if DEBUG:
+                        print('Background: Scheduler stats: %s'%_scheduler.stats())
+                    break
+                case self.BG_CMD_MODBUS_START:
+                    try:
+                        self._fieldbus = FieldBus(self._config_json['devices'], NUM_CH_AI, NUM_CH_AO, self._metric_stage['ao_write'])
+                        self._fieldbus.start()
+                        # held by the lanes until connected; AO_SEND may have run before this
+                        self._bg_modbus_sync_ao_all()
+                    except (KeyError, ValueError) as e:
+                        print('Background: Invalid modbus devices')
+                        print(e)
+                case self.BG_CMD_MODBUS_STOP:
+                    _scheduler.stop_job(self.JOB_AI_RECEIVE)
+                    if self._fieldbus:
+                        self._fieldbus.stop()
+                        self._fieldbus = None
+                case self.BG_CMD_SQL_SAVE_START:
+                    self._bg_sql_save_start()
+                    if self._log_mode == 'timer':
+                        _scheduler.start_job(self.JOB_SQL_SAVE)
+                case self.BG_CMD_SQL_SAVE_STOP:
+                    _scheduler.stop_job(self.JOB_SQL_SAVE)
+                    self._bg_sql_save_stop()
+                case self.BG_CMD_AO_SEND:
+                    self._bg_modbus_sync_ao_all()
+                case self.BG_CMD_AI_RECEIVE:
+                    _scheduler.start_job(self.JOB_AI_RECEIVE)
+                case self.BG_CMD_CHANGE_INTERVAL:
+                    _scheduler.set_interval(self.JOB_SQL_SAVE, self._sql_save_interval_ms)
+                    _scheduler.set_interval(self.JOB_AI_RECEIVE, self._modbus_interval_ms)
+                    _scheduler.set_interval(self.JOB_WS_PUBLISH, max(self._ws_publish_interval_ms, self._modbus_interval_ms))
+                    if self._log_mode == 'frames' and self._log_writer:
+                        self._log_writer.set_decimation(self._util_save_decimation(), self._log_decimate)
+                case _:
+                    print('Background: Unknown message')
+            _scheduler.run_due()
+
+    def _bg_modbus_sync_ai_all(self) -> bool:
+        if not self._fieldbus:
+            return False
+        _started = time.perf_counter()
+        _result = self._fieldbus.poll(self._modbus_interval_ms/1000.0*MODBUS_POLL_BUDGET)
+        self._metric_stage['modbus_poll'].observe(time.perf_counter() - _started)
+        if _result.ok:
+            # stateful params (integ, deriv, mavg, prev_N) only see acquired frames, as in batch mode;
+            # AI and params go out in one update, so no snapshot pairs new AI with old params
+            _param = self._bg_modbus_calc_param(_result.ai_raw, _result.mono_ns)
+            self._aio.set_ai_raw_all(_result.ai_raw, _result.time_ns, _result.mono_ns, _result.stale, _param)
+        return _result.ok
+
+    def _bg_modbus_sync_ao_all(self):
+        if self._fieldbus:
+            self._fieldbus.write_ao(self._aio.get_ao_raw_all())
+
+    def _bg_webserver_create_json_meta(self):
+        _version = self._channel_meta.version
+        if self._json_meta_cache and self._json_meta_cache[0] == _version:
+            json_env, json_label, json_unit = self._json_meta_cache[1]
+            return dict(json_env), dict(json_label), dict(json_unit)
+        json_env = {
+            "version": "1.0",
+            'num_ch_ai': NUM_CH_AI,
+            'num_ch_ao': NUM_CH_AO,
+            'num_ch_param': NUM_CH_PARAM,
+            'modbus_com_port': MODBUS_COM_PORT,
+            'modbus_mode': MODBUS_MODE,
+            'modbus_baudrate': MODBUS_BAUDRATE,
+            'modbus_slave_address': MODBUS_SLAVE_ADDRESS,
+            'modbus_devices': [_dev.get('name', 'dev%d'%i) for i, _dev in enumerate(self._config_json['devices'])],
+        }
+        json_label, json_unit = create_key_labels(self._channel_meta)
+        self._json_meta_cache = (_version, (json_env, json_label, json_unit))
+        return dict(json_env), dict(json_label), dict(json_unit)
+
+    def _bg_create_channel_info(self) -> dict:
+        json_env, json_label, json_unit = self._bg_webserver_create_json_meta()
+        return {
+            'env': json_env,
+            'label': json_label,
+            'unit': json_unit,
+            'calib': {
+                'ai': [self._aio.get_ai_calib(ch) for ch in range(NUM_CH_AI)],
+                'ao': [self._aio.get_ao_calib(ch) for ch in range(NUM_CH_AO)],
+            },
+            'vlt_scale': {
+                'ai': AI_VLT_SCALE.tolist(),
+                'ao': AO_VLT_SCALE.tolist(),
+            },
+        }
+
+    def _bg_webserver_create_ws_meta(self) -> tuple[int, str]:
+        # metadata message of the binary/delta protocols, rebuilt only when labels,
+        # units or calibration change
+        _version = self._channel_meta.version + self._aio.calib_version
+        if self._ws_meta_cache and self._ws_meta_cache[0] == _version:
+            return self._ws_meta_cache
+        ret = {'type': 'meta', 'meta_version': _version}
+        ret.update(self._bg_create_channel_info())
+        ret['layout'] = self._ws_codec.layout()
+        self._ws_meta_cache = (_version, json.dumps(ret))
+        return self._ws_meta_cache
+
+    def _bg_webserver_create_json_response(self, frame:AioFrame|None=None):
+        _started = time.perf_counter()
+        _frame = frame or self._aio.snapshot()
+        json_env, json_label, json_unit = self._bg_webserver_create_json_meta()
+        json_key =  ["index", "time"] + \
+                    ["ai_raw_%d"%i for i in range(NUM_CH_AI)] + \
+                    ["ai_phy_%d"%i for i in range(NUM_CH_AI)] + \
+                    ["ao_raw_%d"%i for i in range(NUM_CH_AO)] + \
+                    ["ao_phy_%d"%i for i in range(NUM_CH_AO)] + \
+                    ["ao_vlt_%d"%i for i in range(NUM_CH_AO)] + \
+                    ["param_phy_%d"%i for i in range(NUM_CH_PARAM)] + \
+                    ["stale"]
+        json_data = {
+            'index': -1, 
+            'time': datetime.datetime.fromtimestamp(_frame.time_ns/1E9).strftime('%Y-%m-%d %H:%M:%S.%f'),
+            'stale': _frame.stale,
+        }
+        _ai_raw = _frame.ai_raw.tolist()
+        _ai_phy = _frame.ai_phy.tolist()
+        _ai_vlt = (_frame.ai_raw * AI_VLT_SCALE).tolist()
+        _ao_raw = _frame.ao_raw.tolist()
+        _ao_phy = _frame.ao_phy.tolist()
+        _ao_vlt = (_frame.ao_raw * AO_VLT_SCALE).tolist()
+        _param = _frame.param.tolist()
+        for ch in range(NUM_CH_AI):
+            json_data['ai_raw_%d'%ch] = _ai_raw[ch]
+            json_data['ai_phy_%d'%ch] = _ai_phy[ch]
+            json_data['ai_vlt_%d'%ch] = _ai_vlt[ch]
+        for ch in range(NUM_CH_AO):
+            json_data['ao_raw_%d'%ch] = _ao_raw[ch]
+            json_data['ao_phy_%d'%ch] = _ao_phy[ch]
+            json_data['ao_vlt_%d'%ch] = _ao_vlt[ch]
+        for ch in range(NUM_CH_PARAM):
+            json_data['param_phy_%d'%ch] = _param[ch]
+        
+        ret = {
+            'env': json_env,
+            'key': json_key,
+            'label': json_label,
+            'unit': json_unit,
+            'data': [json_data],
+        }
+        ret = json.dumps(ret)
+        self._metric_stage['json_serialize'].observe(time.perf_counter() - _started)
+        return ret
+    
+    async def _bg_webserver_websocket_receiver(self, websocket: WebSocket, subscriber):
+        try:
+            while True:
+                msg = await websocket.receive()
+                if msg['type'] == 'websocket.disconnect':
+                    break
+        except Exception as e:
+            print(e)
+        finally:
+            self._ws_hub.unsubscribe(subscriber)
+
+    async def _bg_webserver_websocket_handler(self, websocket: WebSocket):
+        # format from ?format= or from a Sec-WebSocket-Protocol entry, json by default
+        _format = websocket.query_params.get('format')
+        _subprotocol = None
+        for _proto in websocket.scope.get('subprotocols', []):
+            if _proto in WS_SUBPROTOCOLS and _format in (None, WS_SUBPROTOCOLS[_proto]):
+                _format, _subprotocol = WS_SUBPROTOCOLS[_proto], _proto
+                break
+        _format = _format or 'json'
+        if _format not in WS_FORMATS:
+            await websocket.close(code=1003)
+            return
+        await websocket.accept(subprotocol=_subprotocol)
+        _sub = self._ws_hub.subscribe(_format)
+        _receiver = asyncio.create_task(self._bg_webserver_websocket_receiver(websocket, _sub))
+        try:
+            while True:
+                msg = await _sub.queue.get()
+                if msg is None:
+                    break
+                if isinstance(msg, bytes):
+                    await websocket.send_bytes(msg)
+                else:
+                    await websocket.send_text(msg)
+                _sub.sent += 1
+                self._metric_ws_sent.inc()
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            print(e)
+        finally:
+            self._ws_hub.unsubscribe(_sub)
+            _receiver.cancel()
+
+    async def _bg_webserver_latest(self, wait_for_seq:int|None=None, timeout:float=LATEST_WAIT_S, if_none_match:str|None=Header(default=None)):
+        # async on purpose: the cached message lives on the loop thread with the broadcast hub
+        if wait_for_seq is not None:
+            await self._ws_hub.wait_newer(wait_for_seq, min(max(0.0, timeout), LATEST_MAX_WAIT_S))
+        _seq, _etag, _body = self._ws_hub.latest()
+        _headers = {'ETag': _etag, 'Cache-Control': 'no-cache', 'X-Frame-Seq': str(_seq)}
+        if if_none_match is not None and (if_none_match.strip() == '*' or _etag in [t.strip().removeprefix('W/') for t in if_none_match.split(',')]):
+            self._metric_latest[304].inc()
+            return Response(status_code=304, headers=_headers)
+        self._metric_latest[200].inc()
+        return Response(content=_body, media_type='application/json', headers=_headers)
+
+    def _bg_webserver_on_startup(self):
+        self._ws_hub.bind(asyncio.get_running_loop())
+
+    async def _bg_webserver_metrics(self):
+        # async on purpose: runs on the loop thread that owns the broadcast hub
+        return PlainTextResponse(self._metrics.prometheus(), media_type='text/plain; version=0.0.4')
+
+    async def _bg_webserver_stats(self, reset:bool=False):
+        _engine = self._param_engine
+        ret = {
+            'uptime_s': time.time() - self._started_at,
+            'interval_ms': {'acquire': self._modbus_interval_ms, 'sql_save': self._sql_save_interval_ms},
+            'save': {'mode': self._log_mode, 'decimation': self._util_save_decimation() if self._log_mode == 'frames' else None, 'method': self._log_decimate},
+            'metrics': self._metrics.stats(),
+            'scheduler': self._modbus_scheduler.stats(),
+            'param': {'channels': len(_engine.channels), 'last_ms': _engine.last_ms, 'max_ms': _engine.max_ms, 'overruns': _engine.overruns},
+            'session': self._log_path,
+            'writer_error': self._log_writer.last_error if self._log_writer else None,
+            'segment': self._log_writer.segment if self._log_writer else None,
+            'archive': {'codec': self._archive_codec, 'remove_source': self._archive_remove_source, **self._util_archive_stats()},
+        }
+        if reset:
+            self._metrics.reset_histograms()
+        return ret
+
+    def _bg_webserver_hello_world(self):
+        return {"Hello": "World"}
+
+    def _bg_webserver_session_segments(self, session:str|None) -> tuple[str, list[dict]]:
+        # (name, segment files in order, see SessionCatalog.segments) of a SQLite
+        # session; a file the catalog does not know is served as one segment
+        if session is None:
+            if not self._log_path.endswith('.sqlite3'):
+                raise HTTPException(status_code=404, detail='No active SQLite session')
+            session = self._log_session
+        if os.path.basename(session) != session:
+            raise HTTPException(status_code=400, detail='Invalid session')
+        _name = session[:-len('.sqlite3')] if session.endswith('.sqlite3') else session
+        _segments = self._catalog.segments(_name)
+        if _segments and any(not s['path'].endswith('.sqlite3') for s in _segments):
+            raise HTTPException(status_code=404, detail='Not a SQLite session')
+        if any(s['archive'] and not os.path.exists(s['path']) for s in _segments):
+            raise HTTPException(status_code=404, detail='Session only archived, see archive.py')
+        if _segments:
+            return _name, _segments
+        _path = os.path.join(TEMP_DATA_DIR_PATH, _name+'.sqlite3')
+        if not os.path.exists(_path):
+            raise HTTPException(status_code=404, detail='Session not found')
+        return _name, [{'segment': 0, 'path': _path, 'start': None, 'end': None, 'rows': None, 'closed': False, 'base': 0}]
+
+    def _bg_webserver_sessions(self):
+        _catalog = self._catalog.sessions()
+        _names = [s['name'] for s in _catalog if s['backend'] == 'sqlite']
+        _active = self._log_session if self._log_path.endswith('.sqlite3') else None
+        return {'active': _active, 'sessions': _names, 'catalog': _catalog}
+
+    def _bg_webserver_session_info(self, name:str):
+        _session = self._catalog.session(name)
+        if _session is None:
+            raise HTTPException(status_code=404, detail='Session not found')
+        for _segment in _session['segments']:
+            _segment['file'] = os.path.basename(_segment.pop('path'))
+        return _session
+
+    def _bg_webserver_history_columns(self, all_columns:list[str], channels:str|None) -> list[str]:
+        # time first; seq / mono_ns only when asked for
+        _columns = [c for c in all_columns if c not in SQL_FRAME_COLUMNS]
+        if channels:
+            _selected = [c.strip() for c in channels.split(',') if c.strip()]
+            if any(c == 'time' or c not in all_columns for c in _selected):
+                raise HTTPException(status_code=400, detail='Invalid channels')
+            _columns = _selected
+        return ['time'] + _columns
+
+    def _bg_webserver_history(self, session:str|None=None, since_index:int=0, start:str|None=None, end:str|None=None, channels:str|None=None, limit:int=HISTORY_CHUNK_ROWS, max_points:int|None=None, method:str='minmax', source:str='session'):
+        if source not in ('session', 'memory'):
+            raise HTTPException(status_code=400, detail='Invalid source')
+        if max_points is not None and (max_points < 4 or method not in DECIMATE_METHODS):
+            raise HTTPException(status_code=400, detail='Invalid decimation')
+        try:
+            _start = None if start is None else datetime.datetime.fromisoformat(start).strftime(SQL_TIME_FORMAT)
+            _end = None if end is None else datetime.datetime.fromisoformat(end).strftime(SQL_TIME_FORMAT)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid time')
+        _limit = min(max(1, limit), HISTORY_MAX_PAGE_ROWS)
+        if source == 'memory':
+            return self._bg_webserver_history_memory(since_index, start, end, channels, _limit, None if max_points is None else min(max_points, HISTORY_MAX_POINTS), method)
+
+        _name, _segments = self._bg_webserver_session_segments(session)
+        with SessionReader(_segments[0]['path']) as _reader:
+            _all_columns = _reader.columns
+        _columns = self._bg_webserver_history_columns(_all_columns, channels)
+        _keys = ['index'] + _columns
+        # index runs on across segments, older ones are skipped by the catalog's counts
+        _segments = [s for s in overlapping(_segments, _start, _end) if not (s['closed'] and s['rows'] is not None and since_index >= s['base'] + s['rows'])]
+
+        json_env, json_label, json_unit = self._bg_webserver_create_json_meta()
+        json_env['session'] = _name
+        json_label = {k: v for k, v in json_label.items() if k in _columns}
+        json_unit = {k: v for k, v in json_unit.items() if k in _columns}
+        if max_points is not None:
+            return self._bg_webserver_history_decimated(_segments, _columns[1:], since_index, _start, _end, min(max_points, HISTORY_MAX_POINTS), method, json_env, json_label, json_unit)
+
+        def _stream():
+            yield '{"env": %s, "key": %s, "label": %s, "unit": %s, "data": ['%(json.dumps(json_env), json.dumps(_keys), json.dumps(json_label), json.dumps(json_unit))
+            _next = since_index
+            _count = 0
+            _sep = '\n'
+            try:
+                for _segment in _segments:
+                    if _count >= _limit:
+                        break
+                    _base = _segment['base']
+                    with SessionReader(_segment['path']) as _reader:
+                        for _rows in _reader.iter_rows(_columns, max(0, since_index - _base), _start, _end, _limit - _count, HISTORY_CHUNK_ROWS):
+                            yield _sep + ',\n'.join(json.dumps(dict(zip(_keys, (_row[0] + _base,) + tuple(_row[1:])))) for _row in _rows)
+                            _sep = ',\n'
+                            _next = _rows[-1][0] + _base
+                            _count += len(_rows)
+            except Exception as e:
+                print('WebServer: Failed to read history')
+                print(e)
+            yield '\n], "next_index": %d, "more": %s}'%(_next, 'true' if _count >= _limit else 'false')
+
+        return StreamingResponse(_stream(), media_type='application/json')
+
+    def _bg_webserver_history_memory(self, since_index:int, start:str|None, end:str|None, channels:str|None, limit:int, max_points:int|None, method:str) -> JSONResponse:
+        # recent frames from the acquisition ring buffer, saving or not; the index is
+        # the frame seq, as in the X-Frame-Seq header of /latest
+        _columns = self._bg_webserver_history_columns(['time', 'seq', 'mono_ns'] + rollup_columns(), channels)
+        _keys = ['index'] + _columns
+        _ns = lambda t: None if t is None else int(datetime.datetime.fromisoformat(t).timestamp()*1E6)*1000
+        _rows = self._ring_buffer.copy_window_by_time(_ns(start), _ns(end))
+        _rows = _rows[_rows['seq'] > since_index]
+        _time = lambda ns: [datetime.datetime.fromtimestamp(t/1E9).strftime(SQL_TIME_FORMAT) for t in ns.tolist()]
+
+        json_env, json_label, json_unit = self._bg_webserver_create_json_meta()
+        json_env['session'] = None
+        json_label = {k: v for k, v in json_label.items() if k in _columns}
+        json_unit = {k: v for k, v in json_unit.items() if k in _columns}
+        if max_points is not None:
+            _x, _y = np.empty((0, len(_columns) - 1), dtype=np.int64), np.empty((0, len(_columns) - 1))
+            _points = {}
+            if len(_rows):
+                _values = np.stack([frame_column(_rows, c) for c in _columns[1:]], axis=1)
+                _x, _y, _ = decimate([(_rows['seq'], _values)], int(_rows['seq'][0]), int(_rows['seq'][-1]), len(_columns) - 1, max_points, method)
+                _picked = np.isin(_rows['seq'], np.unique(_x))
+                _points = {i: (i, t) for i, t in zip(_rows['seq'][_picked].tolist(), _time(_rows['time_ns'][_picked]))}
+            return self._bg_webserver_series_response(_columns[1:], _x, _y, _points, len(_rows), 0, max_points, method, json_env, json_label, json_unit)
+
+        _more = len(_rows) > limit
+        _rows = _rows[:limit]
+        _values = [_rows['seq'].tolist(), _time(_rows['time_ns'])] + [frame_column(_rows, c).tolist() for c in _columns[1:]]
+        _next = int(_rows['seq'][-1]) if len(_rows) else since_index
+        return JSONResponse({'env': json_env, 'key': _keys, 'label': json_label, 'unit': json_unit, 'data': [dict(zip(_keys, r)) for r in zip(*_values)], 'next_index': _next, 'more': _more})
+
+    def _bg_webserver_rollup_read(self, segments:list[dict], columns:list[str], start:str|None, end:str|None, stats:tuple, level_for) -> tuple|None:
+        # (level, buckets) of all segments with their ids offset, level_for(readers,
+        # start key, end key) picks the level; None when a segment has no rollups
+        _readers = [RollupReader(s['path']) for s in segments]
+        try:
+            _ranges = [r.key_range() for r in _readers]
+            if not _readers or None in _ranges:
+                return None
+            _start_key = min(r[0] for r in _ranges) if start is None else int(parse_time_keys([start])[0])
+            _end_key = max(r[1] for r in _ranges) if end is None else int(parse_time_keys([end])[0])
+            _level = level_for(_readers[0], _start_key, _end_key)
+            if _level is None:
+                return None
+            _parts = []
+            for _rollup, _segment in zip(_readers, segments):
+                _part = _rollup.read(_level, columns, _start_key, _end_key, stats)
+                _part['first_id'] += _segment['base']
+                _part['last_id'] += _segment['base']
+                _parts.append(_part)
+            return _level, merge_reads(_parts)
+        finally:
+            for _rollup in _readers:
+                _rollup.close()
+
+    def _bg_webserver_history_rollup(self, segments:list[dict], columns:list[str], start:str|None, end:str|None, max_points:int, method:str):
+        # Long ranges are served from the coarsest rollup level that still yields
+        # max_points; None when the session has no rollups or the range is too short.
+        if any(c not in rollup_columns() for c in columns):
+            return None
+        _read = self._bg_webserver_rollup_read(segments, columns, start, end, ('min', 'max'), lambda rollup, lo, hi: rollup.level_for((hi - lo) / (max_points // 2)))
+        if _read is None:
+            return None
+        _level, _buckets = _read
+        _points = {k: (i, t) for k, i, t in zip(_buckets['bucket'].tolist(), _buckets['first_id'].tolist(), _buckets['time'])}
+        if not _points:
+            return _level, np.empty((0, len(columns)), dtype=np.int64), np.empty((0, len(columns))), 0, _points
+        # every bucket contributes its min and its max at the bucket time
+        _keys = np.repeat(_buckets['bucket'], 2)
+        _values = np.stack([_buckets['min'], _buckets['max']], axis=1).reshape(-1, len(columns))
+        _x, _y, _ = decimate([(_keys, _values)], int(_keys[0]), int(_keys[-1]), len(columns), max_points, method)
+        return _level, _x, _y, int(_buckets['count'].sum()), _points
+
+    def _bg_webserver_history_decimated(self, segments:list[dict], columns:list[str], since_index:int, start:str|None, end:str|None, max_points:int, method:str, json_env:dict, json_label:dict, json_unit:dict) -> JSONResponse:
+        # per channel series of at most max_points, the segments are read once in
+        # numpy chunks and only the bucket state is kept
+        _routed = self._bg_webserver_history_rollup(segments, columns, start, end, max_points, method) if since_index == 0 and segments else None
+        if _routed is not None:
+            _resolution, _x, _y, _rows, _points = _routed
+        else:
+            _resolution, _rows, _points = 0, 0, {}
+            _x, _y = np.empty((0, len(columns)), dtype=np.int64), np.empty((0, len(columns)))
+            _readers = [SessionReader(s['path']) for s in segments]
+            try:
+                # (reader, base, lo, last) in local ids
+                _spans = []
+                for _reader, _segment in zip(_readers, segments):
+                    _lo, _hi = _reader.id_range(start, end)
+                    _lo = max(_lo, since_index - _segment['base'])
+                    _last = _reader.last_id() if _hi is None else min(_reader.last_id(), _hi - 1)
+                    if _last > _lo:
+                        _spans.append((_reader, _segment['base'], _lo, _last))
+                if _spans:
+                    def _chunks():
+                        for _reader, _base, _lo, _ in _spans:
+                            for _ids, _values in _reader.iter_arrays(columns, _lo, start, end, chunk_rows=HISTORY_DECIMATE_CHUNK_ROWS):
+                                yield _ids + _base, _values
+                    _x, _y, _rows = decimate(_chunks(), _spans[0][1] + _spans[0][2] + 1, _spans[-1][1] + _spans[-1][3], len(columns), max_points, method)
+                    _picked = np.unique(_x)
+                    for _reader, _base, _lo, _last in _spans:
+                        _local = _picked[(_picked > _base + _lo) & (_picked <= _base + _last)] - _base
+                        _points.update({i + _base: (i + _base, t) for i, t in _reader.times(_local.tolist()).items()})
+            finally:
+                for _reader in _readers:
+                    _reader.close()
+        return self._bg_webserver_series_response(columns, _x, _y, _points, _rows, _resolution, max_points, method, json_env, json_label, json_unit)
+
+    def _bg_webserver_series_response(self, columns:list[str], x:np.ndarray, y:np.ndarray, points:dict, rows:int, resolution:int, max_points:int, method:str, json_env:dict, json_label:dict, json_unit:dict) -> JSONResponse:
+        # points: picked x -> (index, time)
+        _y = np.where(np.isfinite(y), y, None)
+        _series = {}
+        for ch, c in enumerate(columns):
+            _picked = [points[k] for k in x[:, ch].tolist()]
+            _series[c] = {'index': [p[0] for p in _picked], 'time': [p[1] for p in _picked], 'value': _y[:, ch].tolist()}
+        # JSONResponse skips the generic encoder walk, which dominates for large payloads
+        return JSONResponse({'env': json_env, 'key': columns, 'label': json_label, 'unit': json_unit, 'method': method, 'max_points': max_points, 'resolution': resolution, 'rows': rows, 'series': _series})
+
+    def _bg_webserver_trend(self, session:str|None=None, start:str|None=None, end:str|None=None, channels:str|None=None, resolution:float=60.0):
+        # per bucket count/min/max/mean/last from the rollup tables
+        try:
+            _start = None if start is None else datetime.datetime.fromisoformat(start).strftime(SQL_TIME_FORMAT)
+            _end = None if end is None else datetime.datetime.fromisoformat(end).strftime(SQL_TIME_FORMAT)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid time')
+        _name, _segments = self._bg_webserver_session_segments(session)
+        _columns = rollup_columns()
+        if channels:
+            _selected = [c.strip() for c in channels.split(',') if c.strip()]
+            if any(c not in _columns for c in _selected):
+                raise HTTPException(status_code=400, detail='Invalid channels')
+            _columns = _selected
+        def _level_for(rollup, lo, hi):
+            # never hand out more than a page worth of buckets
+            _levels = [s for s in rollup.levels if s >= (rollup.level_for(resolution) or rollup.levels[0])]
+            return next((s for s in _levels if (hi - lo) / s <= HISTORY_MAX_PAGE_ROWS), _levels[-1])
+        _read = self._bg_webserver_rollup_read(overlapping(_segments, _start, _end) or _segments[-1:], _columns, _start, _end, ROLLUP_STATS, _level_for)
+        if _read is None:
+            raise HTTPException(status_code=404, detail='No rollup in this session, run rollup.py')
+        _level, _buckets = _read
+
+        json_env, json_label, json_unit = self._bg_webserver_create_json_meta()
+        json_env['session'] = _name
+        _stats = {s: np.where(np.isfinite(_buckets[s]), _buckets[s], None).tolist() for s in ROLLUP_STATS}
+        _data = []
+        for i, (_index, _time, _count) in enumerate(zip(_buckets['first_id'].tolist(), _buckets['time'], _buckets['count'].tolist())):
+            _row = {'index': _index, 'time': _time, 'count': _count}
+            for ch, c in enumerate(_columns):
+                _row[c] = {s: _stats[s][i][ch] for s in ROLLUP_STATS}
+            _data.append(_row)
+        return JSONResponse({
+            'env': json_env,
+            'key': ['index', 'time', 'count'] + _columns,
+            'label': {k: v for k, v in json_label.items() if k in _columns},
+            'unit': {k: v for k, v in json_unit.items() if k in _columns},
+            'resolution': _level,
+            'data': _data,
+        })
+
+    def _bg_webserver_export(self, session:str|None=None, format:str='csv', start:str|None=None, end:str|None=None, channels:str|None=None, labels:bool=False):
+        if format not in EXPORT_FORMATS:
+            raise HTTPException(status_code=400, detail='Invalid format')
+        try:
+            _start = None if start is None else datetime.datetime.fromisoformat(start).strftime(SQL_TIME_FORMAT)
+            _end = None if end is None else datetime.datetime.fromisoformat(end).strftime(SQL_TIME_FORMAT)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid time')
+        _name, _segments = self._bg_webserver_session_segments(session)
+        _path = [(s['path'], s['base']) for s in overlapping(_segments, _start, _end) or _segments[:1]]
+        _channels = [c.strip() for c in channels.split(',') if c.strip()] if channels else None
+        try:
+            session_columns(_path, _channels)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid channels')
+        _labels = _units = None
+        if labels:
+            _labels, _units = create_key_labels(self._channel_meta)
+        _headers = {'Content-Disposition': 'attachment; filename="%s.%s"'%(_name, format)}
+
+        if format == 'csv':
+            return StreamingResponse(iter_csv(_path, _channels, _start, _end, _labels, _units), media_type='text/csv', headers=_headers)
+
+        # a zip member needs its size up front, build the file first then stream it
+        _tmp = tempfile.NamedTemporaryFile(suffix='.npz', dir=TEMP_DATA_DIR_PATH, delete=False)
+        try:
+            with _tmp:
+                write_npz(_path, _tmp, _channels, _start, _end, _labels, _units)
+        except Exception:
+            os.remove(_tmp.name)
+            raise
+        def _stream():
+            try:
+                with open(_tmp.name, 'rb') as f:
+                    while _block := f.read(1 << 20):
+                        yield _block
+            finally:
+                os.remove(_tmp.name)
+        _headers['Content-Length'] = str(os.path.getsize(_tmp.name))
+        return StreamingResponse(_stream(), media_type='application/octet-stream', headers=_headers)
+
+    def _bg_webserver_create_hub(self):
+        self._ws_hub = BroadcastHub(self._aio.snapshot, self._bg_webserver_create_json_response, self._ws_codec, self._bg_webserver_create_ws_meta, WS_CLIENT_QUEUE_SIZE)
+
+    def _bg_webserver_add_routes(self, app:FastAPI):
+        app.add_api_route('/hello', self._bg_webserver_hello_world)
+        app.add_api_route('/latest', self._bg_webserver_latest)
+        app.add_api_route('/sessions', self._bg_webserver_sessions)
+        app.add_api_route('/sessions/{name}', self._bg_webserver_session_info)
+        app.add_api_route('/history', self._bg_webserver_history)
+        app.add_api_route('/export', self._bg_webserver_export)
+        app.add_api_route('/trend', self._bg_webserver_trend)
+        app.add_api_route('/metrics', self._bg_webserver_metrics)
+        app.add_api_route('/stats', self._bg_webserver_stats)
+        app.add_websocket_route('/ws', self._bg_webserver_websocket_handler)
+        app.add_event_handler('startup', self._bg_webserver_on_startup)
+
+    def _bg_webserver_thread(self):
+        self._bg_webserver_add_routes(self._fastapi_app)
+        uvicorn.run(self._fastapi_app, host=self._web_host, port=self._web_port)
@@ -0,0 +1,119 @@
+import numpy as np
+
+DECIMATE_METHODS = ('minmax', 'lttb')
+DECIMATE_LTTB_OVERSAMPLE = 4 # min/max points per LTTB output point
+
+class MinMaxAccumulator():
+    # Min/max envelope of every channel over equal width x buckets. Chunks are
+    # folded in as they are read (x ascending across chunks), so only the
+    # per-bucket state is kept, never the source rows.
+    def __init__(self, x_first:int, x_last:int, buckets:int, num_ch:int):
+        if buckets <= 0:
+            raise ValueError('Invalid buckets')
+        if x_last < x_first:
+            raise ValueError('Invalid range')
+        self._x_first = x_first
+        self._span = x_last - x_first + 1
+        self._buckets = min(buckets, self._span)
+        self._count = np.zeros(self._buckets, dtype=np.int64)
+        self._min_v = np.full((self._buckets, num_ch), np.nan)
+        self._max_v = np.full((self._buckets, num_ch), np.nan)
+        self._min_x = np.full((self._buckets, num_ch), -1, dtype=np.int64)
+        self._max_x = np.full((self._buckets, num_ch), -1, dtype=np.int64)
+
+    @property
+    def rows(self) -> int:
+        return int(self._count.sum())
+
+    def _arg(self, values:np.ndarray, extreme:np.ndarray, seg:np.ndarray, starts:np.ndarray) -> np.ndarray:
+        # row of the first occurrence of the extreme in each segment, segment start if none (all NaN)
+        _n = len(values)
+        _rows = np.where(values == extreme[seg], np.arange(_n)[:, None], _n)
+        _first = np.minimum.reduceat(_rows, starts, axis=0)
+        return np.where(_first < _n, _first, starts[:, None])
+
+    def add(self, x:np.ndarray, values:np.ndarray):
+        if len(x) == 0:
+            return
+        _x = np.asarray(x, dtype=np.int64)
+        _v = np.asarray(values, dtype=np.float64).reshape(len(_x), -1)
+        _bucket = ((_x - self._x_first) * self._buckets) // self._span
+        if _bucket[0] < 0 or _bucket[-1] >= self._buckets:
+            raise ValueError('x out of range')
+        _starts = np.flatnonzero(np.r_[True, _bucket[1:] != _bucket[:-1]])
+        _seg = np.repeat(np.arange(len(_starts)), np.diff(np.r_[_starts, len(_x)]))
+        _ub = _bucket[_starts]
+        self._count[_ub] += np.diff(np.r_[_starts, len(_x)])
+
+        with np.errstate(invalid='ignore'):
+            _mins = np.fmin.reduceat(_v, _starts, axis=0)
+            _maxs = np.fmax.reduceat(_v, _starts, axis=0)
+            _min_x = _x[self._arg(_v, _mins, _seg, _starts)]
+            _max_x = _x[self._arg(_v, _maxs, _seg, _starts)]
+            # ties keep the earlier point, the state is always from older chunks;
+            # a state that is still NaN (all NaN so far) gives way to any real value
+            _new = self._min_x[_ub] < 0
+            _take = _new | (_mins < self._min_v[_ub]) | (np.isnan(self._min_v[_ub]) & ~np.isnan(_mins))
+            self._min_v[_ub] = np.where(_take, _mins, self._min_v[_ub])
+            self._min_x[_ub] = np.where(_take, _min_x, self._min_x[_ub])
+            _take = _new | (_maxs > self._max_v[_ub]) | (np.isnan(self._max_v[_ub]) & ~np.isnan(_maxs))
+            self._max_v[_ub] = np.where(_take, _maxs, self._max_v[_ub])
+            self._max_x[_ub] = np.where(_take, _max_x, self._max_x[_ub])
+
+    def result(self) -> tuple[np.ndarray, np.ndarray]:
+        # (x, y) of shape [points, channels]: min and max of every non-empty bucket
+        # in x order, one point for single-row buckets
+        _used = self._count > 0
+        _single = self._count[_used] == 1
+        _min_x, _max_x = self._min_x[_used], self._max_x[_used]
+        _min_v, _max_v = self._min_v[_used], self._max_v[_used]
+        _first = _min_x <= _max_x
+        _x = np.stack([np.where(_first, _min_x, _max_x), np.where(_first, _max_x, _min_x)], axis=1)
+        _y = np.stack([np.where(_first, _min_v, _max_v), np.where(_first, _max_v, _min_v)], axis=1)
+        _keep = np.stack([np.ones_like(_single), ~_single], axis=1).reshape(-1)
+        _num_ch = _x.shape[-1]
+        return _x.reshape(-1, _num_ch)[_keep], _y.reshape(-1, _num_ch)[_keep]
+
+def lttb(x:np.ndarray, y:np.ndarray, points:int) -> tuple[np.ndarray, np.ndarray]:
+    # Largest-Triangle-Three-Buckets on [rows, channels] arrays. Buckets are shared,
+    # the point picked in each is per channel; the loop runs over buckets only.
+    _rows = len(x)
+    if points >= _rows or _rows <= 2:
+        return x, y
+    if points < 3:
+        raise ValueError('Invalid points')
+    _xf = x.astype(np.float64)
+    _edges = np.linspace(1, _rows - 1, points - 1).astype(np.int64)
+    _cols = np.arange(x.shape[1])
+    _picked = np.zeros((points, x.shape[1]), dtype=np.int64)
+    _picked[-1] = _rows - 1
+    _prev = np.zeros(x.shape[1], dtype=np.int64)
+    for i in range(points - 2):
+        _lo, _hi = _edges[i], max(_edges[i+1], _edges[i]+1)
+        _next_lo, _next_hi = _hi, _edges[i+2] if i + 2 < len(_edges) else _rows
+        _next_hi = max(_next_hi, _next_lo + 1)
+        _avg_x = _xf[_next_lo:_next_hi].mean(axis=0)
+        _avg_y = y[_next_lo:_next_hi].mean(axis=0)
+        _px, _py = _xf[_prev, _cols], y[_prev, _cols]
+        _area = np.abs((_px - _avg_x) * (y[_lo:_hi] - _py) - (_px - _xf[_lo:_hi]) * (_avg_y - _py))
+        # NaN samples lose against any real one
+        _prev = _lo + np.argmax(np.nan_to_num(_area, nan=-1.0), axis=0)
+        _picked[i+1] = _prev
+    return x[_picked, _cols], y[_picked, _cols]
+
+def decimate(chunks, x_first:int, x_last:int, num_ch:int, max_points:int, method:str='minmax') -> tuple[np.ndarray, np.ndarray, int]:
+    # chunks yields (x, values[rows, channels]) in x order, e.g. SessionReader.iter_arrays
+    # or ring buffer windows; returns (x, y, source rows) with at most max_points per channel
+    if method not in DECIMATE_METHODS:
+        raise ValueError('Invalid method: %s'%method)
+    if max_points < 4:
+        raise ValueError('Invalid max points')
+    # LTTB runs on a min/max pre-selection so the source is still read in one vectorized pass
+    _buckets = max_points // 2 if method == 'minmax' else max_points * DECIMATE_LTTB_OVERSAMPLE // 2
+    _acc = MinMaxAccumulator(x_first, x_last, _buckets, num_ch)
+    for _x, _values in chunks:
+        _acc.add(_x, _values)
+    _x, _y = _acc.result()
+    if method == 'lttb':
+        _x, _y = lttb(_x, _y, max_points)
+    return _x, _y, _acc.rows
@@ -0,0 +1,74 @@
+import numpy as np
+
+from core import NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM, AI_VLT_SCALE, AI_UST_SCALE, AO_VLT_SCALE
+
+DISPLAY_FLOAT_FORMAT = '%.3f'
+DISPLAY_INTERVAL_MIN_MS = 100
+DISPLAY_INTERVAL_MAX_MS = 1000
+DISPLAY_BUSY_RATIO = 0.2 # share of the interval the UI pass plus callback lag may use
+DISPLAY_CPU_BUSY = 85.0 # percent, machine wide
+
+class FrameRenderer():
+    # Label texts of a whole frame: every conversion in one numpy pass, formatted
+    # in one go, and compared with what is on screen so only changed labels
+    # are handed back as (key, ch, text).
+    LAYOUT = (
+        ('ai_raw', NUM_CH_AI),
+        ('ai_vlt', NUM_CH_AI),
+        ('ai_ust', len(AI_UST_SCALE)),
+        ('ai_phy', NUM_CH_AI),
+        ('ao_raw', NUM_CH_AO),
+        ('ao_vlt', NUM_CH_AO),
+        ('ao_phy', NUM_CH_AO),
+        ('param_phy', NUM_CH_PARAM),
+    )
+
+    def __init__(self, float_format:str=DISPLAY_FLOAT_FORMAT):
+        self._slots = [(key, ch) for key, num in self.LAYOUT for ch in range(num)]
+        self._formats = ['%d' if key.endswith('_raw') else float_format for key, _ in self._slots]
+        self._texts: list[str|None] = [None] * len(self._slots)
+
+    def reset(self):
+        self._texts = [None] * len(self._slots)
+
+    def values(self, frame) -> np.ndarray:
+        _ai_raw = frame.ai_raw.astype(np.float64)
+        _ao_raw = frame.ao_raw.astype(np.float64)
+        return np.concatenate([
+            _ai_raw,
+            _ai_raw * AI_VLT_SCALE,
+            _ai_raw[:len(AI_UST_SCALE)] * AI_UST_SCALE,
+            frame.ai_phy,
+            _ao_raw,
+            _ao_raw * AO_VLT_SCALE,
+            frame.ao_phy,
+            frame.param,
+        ])
+
+    def render(self, frame) -> list[tuple[str, int, str]]:
+        _texts = [f%v for f, v in zip(self._formats, self.values(frame).tolist())]
+        ret = [self._slots[i] + (t,) for i, (t, p) in enumerate(zip(_texts, self._texts)) if t != p]
+        self._texts = _texts
+        return ret
+
+class RefreshPacer():
+    # Display interval that backs off quickly while the UI thread or the machine
+    # is busy and creeps back down once things are quiet again.
+    def __init__(self, min_ms:int=DISPLAY_INTERVAL_MIN_MS, max_ms:int=DISPLAY_INTERVAL_MAX_MS):
+        if min_ms <= 0 or max_ms < min_ms:
+            raise ValueError('Invalid interval')
+        self._min_ms = min_ms
+        self._max_ms = max_ms
+        self._interval_ms = min_ms
+
+    @property
+    def interval_ms(self) -> int:
+        return self._interval_ms
+
+    def update(self, work_s:float, late_s:float, cpu_percent:float) -> int:
+        _busy = (work_s + max(0.0, late_s)) * 1000.0 / self._interval_ms
+        if _busy > DISPLAY_BUSY_RATIO or cpu_percent >= DISPLAY_CPU_BUSY:
+            self._interval_ms = min(self._max_ms, int(self._interval_ms * 1.5))
+        elif _busy < DISPLAY_BUSY_RATIO / 4 and cpu_percent < DISPLAY_CPU_BUSY * 0.7:
+            self._interval_ms = max(self._min_ms, self._interval_ms - 10)
+        return self._interval_ms
@@ -0,0 +1,223 @@
+import os, json, time, sqlite3, zipfile, datetime, argparse, tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from storage import SessionReader
+
+EXPORT_FORMATS = ('csv', 'npz')
+EXPORT_CHUNK_ROWS = 20000
+EXPORT_FLOAT_FORMAT = '%.7g' # float32 precision
+EXPORT_COPY_BLOCK = 1 << 20
+
+def _fetch(db_path:str, sql:str, params:tuple=()) -> list[tuple]:
+    # plain read-only connection per block: cheap next to a chunk, safe in any
+    # thread or worker process, and never keeps the session file open
+    _conn = sqlite3.connect('file:%s?mode=ro'%db_path, uri=True)
+    try:
+        return _conn.execute(sql, params).fetchall()
+    finally:
+        _conn.close()
+
+def _select_sql(columns:list[str], base:int=0) -> str:
+    # base: rows of the earlier segments, see catalog.SessionCatalog.segments
+    return 'SELECT id%s%s FROM data WHERE id > ? AND id <= ? ORDER BY id'%(' + %d'%base if base else '', ''.join(', '+c for c in columns))
+
+def _csv_formats(columns:list[str]) -> list[str]:
+    _formats = ['%d']
+    for c in columns:
+        _formats.append('%s' if c == 'time' else '%d' if '_raw_' in c or c in ('seq', 'mono_ns') else EXPORT_FLOAT_FORMAT)
+    return _formats
+
+def _csv_line(formats:list[str], row:tuple) -> str:
+    # cell by cell; NULL (SQLite stores NaN as NULL) is an empty field
+    return ','.join(['' if v is None else f%v for f, v in zip(formats, row)])
+
+def _csv_block(db_path:str, columns:list[str], lo:int, hi:int, base:int=0) -> str:
+    # ids in (lo, hi] as CSV lines, runs in worker processes as well
+    _formats = _csv_formats(columns)
+    _template = ','.join(_formats)
+    _lines = []
+    for r in _fetch(db_path, _select_sql(columns, base), (lo, hi)):
+        try:
+            _lines.append(_template%r + '\n')
+        except TypeError:
+            _lines.append(_csv_line(_formats, r) + '\n')
+    return ''.join(_lines)
+
+def _npz_dtype(column:str) -> np.dtype:
+    if column == 'time':
+        return np.dtype('datetime64[us]')
+    if column in ('seq', 'mono_ns'):
+        return np.dtype(np.int64)
+    if column.startswith('ai_raw_'):
+        return np.dtype(np.int16)
+    if column.startswith('ao_raw_'):
+        return np.dtype(np.uint16)
+    if '_phy_' in column:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+def _npz_column(values:tuple, dtype:np.dtype) -> np.ndarray:
+    # NULL is NaN / NaT (numpy converts None itself); integer columns have no such
+    # value and are never NULL in recorded sessions, 0 keeps the export going if one is
+    try:
+        return np.array(values, dtype=dtype)
+    except TypeError:
+        return np.array(tuple(0 if v is None else v for v in values), dtype=dtype)
+
+def _npz_block(db_path:str, columns:list[str], dtypes:list[np.dtype], lo:int, hi:int, base:int=0) -> list[np.ndarray]:
+    # ids in (lo, hi] as one array per key, runs in worker processes as well
+    _chunk = _fetch(db_path, _select_sql(columns, base), (lo, hi))
+    if not _chunk:
+        return []
+    return [_npz_column(_values, dtypes[i]) for i, _values in enumerate(zip(*_chunk))]
+
+def _segments(db_path) -> list[tuple[str, int]]:
+    # a session file, or the (path, base) of consecutive segment files
+    return [(db_path, 0)] if isinstance(db_path, str) else list(db_path)
+
+def session_columns(db_path, channels:list[str]|None=None) -> list[str]:
+    with SessionReader(_segments(db_path)[0][0]) as _reader:
+        _columns = [c for c in _reader.columns if c != 'time']
+    if channels:
+        for c in channels:
+            if c not in _columns:
+                raise ValueError('Invalid channel: %s'%c)
+        _columns = list(channels)
+    return ['time'] + _columns
+
+def id_chunks(db_path:str, start:str|None=None, end:str|None=None, chunk_rows:int=EXPORT_CHUNK_ROWS) -> list[tuple[int, int]]:
+    # (lo, hi] id ranges covering [start, end), independent of each other
+    if chunk_rows <= 0:
+        raise ValueError('Invalid chunk rows')
+    with SessionReader(db_path) as _reader:
+        _lo, _hi = _reader.id_range(start, end)
+    _last = _fetch(db_path, 'SELECT MAX(id) FROM data')[0][0] or 0
+    _last = _last if _hi is None else min(_last, _hi - 1)
+    return [(lo, min(lo + chunk_rows, _last)) for lo in range(_lo, _last, chunk_rows)]
+
+def segment_chunks(db_path, start:str|None=None, end:str|None=None, chunk_rows:int=EXPORT_CHUNK_ROWS) -> list[tuple[str, int, int, int]]:
+    # (path, lo, hi, base) over all segments
+    return [(path, lo, hi, base) for path, base in _segments(db_path) for lo, hi in id_chunks(path, start, end, chunk_rows)]
+
+def iter_csv(db_path, channels:list[str]|None=None, start:str|None=None, end:str|None=None, labels:dict|None=None, units:dict|None=None, chunk_rows:int=EXPORT_CHUNK_ROWS, jobs:int=1):
+    # CSV text block by block; memory is bounded by chunk_rows (times jobs)
+    _columns = session_columns(db_path, channels)
+    yield ','.join(['index'] + _columns) + '\n'
+    if labels is not None:
+        yield ','.join(['#label'] + [json.dumps(labels.get(c) or '') for c in _columns]) + '\n'
+    if units is not None:
+        yield ','.join(['#unit'] + [json.dumps(units.get(c) or '') for c in _columns]) + '\n'
+    _chunks = segment_chunks(db_path, start, end, chunk_rows)
+    if jobs <= 1:
+        for path, lo, hi, base in _chunks:
+            yield _csv_block(path, _columns, lo, hi, base)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as _pool:
+        # keep a few blocks in flight, in order
+        _pending = []
+        for path, lo, hi, base in _chunks:
+            _pending.append(_pool.submit(_csv_block, path, _columns, lo, hi, base))
+            if len(_pending) >= jobs * 2:
+                yield _pending.pop(0).result()
+        for _future in _pending:
+            yield _future.result()
+
+def _npz_blocks(db_path, columns:list[str], dtypes:list[np.dtype], start:str|None, end:str|None, chunk_rows:int, jobs:int):
+    _chunks = segment_chunks(db_path, start, end, chunk_rows)
+    if jobs <= 1:
+        for path, lo, hi, base in _chunks:
+            yield _npz_block(path, columns, dtypes, lo, hi, base)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as _pool:
+        # keep a few blocks in flight, in order
+        _pending = []
+        for path, lo, hi, base in _chunks:
+            _pending.append(_pool.submit(_npz_block, path, columns, dtypes, lo, hi, base))
+            if len(_pending) >= jobs * 2:
+                yield _pending.pop(0).result()
+        for _future in _pending:
+            yield _future.result()
+
+def write_npz(db_path, out, channels:list[str]|None=None, start:str|None=None, end:str|None=None, labels:dict|None=None, units:dict|None=None, chunk_rows:int=EXPORT_CHUNK_ROWS, jobs:int=1) -> int:
+    # One .npy per key. Chunks are appended to per-column temp files first, since
+    # a zip member has to be written in one go; memory stays at one chunk (times jobs).
+    _columns = session_columns(db_path, channels)
+    _keys = ['index'] + _columns
+    _dtypes = [np.dtype(np.int64)] + [_npz_dtype(c) for c in _columns]
+    _rows = 0
+    with tempfile.TemporaryDirectory() as _tmp:
+        _files = [open(os.path.join(_tmp, '%d.bin'%i), 'wb') for i in range(len(_keys))]
+        try:
+            for _block in _npz_blocks(db_path, _columns, _dtypes, start, end, chunk_rows, jobs):
+                if not _block:
+                    continue
+                for f, _array in zip(_files, _block):
+                    _array.tofile(f)
+                _rows += len(_block[0])
+        finally:
+            for f in _files:
+                f.close()
+
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED, allowZip64=True) as _zip:
+            for i, _key in enumerate(_keys):
+                with _zip.open(_key+'.npy', 'w', force_zip64=True) as _member, open(os.path.join(_tmp, '%d.bin'%i), 'rb') as _src:
+                    np.lib.format.write_array_header_1_0(_member, {'descr': np.lib.format.dtype_to_descr(_dtypes[i]), 'fortran_order': False, 'shape': (_rows,)})
+                    while _block := _src.read(EXPORT_COPY_BLOCK):
+                        _member.write(_block)
+            _extra = {'key': np.array(_keys)}
+            if labels is not None:
+                _extra['label'] = np.array([labels.get(c) or '' for c in _keys])
+            if units is not None:
+                _extra['unit'] = np.array([units.get(c) or '' for c in _keys])
+            for _key, _array in _extra.items():
+                with _zip.open(_key+'.npy', 'w') as _member:
+                    np.lib.format.write_array(_member, _array)
+    return _rows
+
+def export_session(db_path, out_path:str, fmt:str='csv', channels:list[str]|None=None, start:str|None=None, end:str|None=None, labels:dict|None=None, units:dict|None=None, chunk_rows:int=EXPORT_CHUNK_ROWS, jobs:int=1) -> int:
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError('Invalid format: %s'%fmt)
+    if fmt == 'npz':
+        with open(out_path, 'wb') as f:
+            return write_npz(db_path, f, channels, start, end, labels, units, chunk_rows, jobs)
+    _rows = 0
+    with open(out_path, 'w', newline='') as f:
+        for _block in iter_csv(db_path, channels, start, end, labels, units, chunk_rows, jobs):
+            f.write(_block)
+            _rows += _block.count('\n')
+    return _rows - 1 - (labels is not None) - (units is not None)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a recorded session to CSV or NumPy .npz')
+    parser.add_argument('session', help='session .sqlite3 file')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--out', default=None, help='output file (default: next to the session)')
+    parser.add_argument('--channels', default=None, help='comma separated keys, e.g. ai_phy_0,ai_phy_1')
+    parser.add_argument('--start', default=None, help='ISO time, inclusive')
+    parser.add_argument('--end', default=None, help='ISO time, exclusive')
+    parser.add_argument('--labels', default=None, metavar='CONFIG', help='add labels and units from a config.json')
+    parser.add_argument('--chunk-rows', type=int, default=EXPORT_CHUNK_ROWS)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='worker processes reading and converting blocks')
+    args = parser.parse_args()
+
+    _labels = _units = None
+    if args.labels:
+        # core serves /export from this module, import it only when run as a tool
+        from core import ChannelMeta, create_key_labels
+        _meta = ChannelMeta()
+        with open(args.labels, 'r') as f:
+            _meta.load_config(json.load(f))
+        _labels, _units = create_key_labels(_meta)
+    _parse = lambda t: None if t is None else datetime.datetime.fromisoformat(t).strftime('%Y-%m-%d %H:%M:%S.%f')
+    _channels = [c.strip() for c in args.channels.split(',') if c.strip()] if args.channels else None
+    _out = args.out or os.path.splitext(args.session)[0] + '.' + args.format
+
+    _started = time.perf_counter()
+    _rows = export_session(args.session, _out, args.format, _channels, _parse(args.start), _parse(args.end), _labels, _units, args.chunk_rows, args.jobs)
+    _elapsed = time.perf_counter() - _started
+    print('Exported %d rows to %s in %.2f s (%.0f rows/s)'%(_rows, _out, _elapsed, _rows/_elapsed if _elapsed > 0 else 0.0))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+import time, queue, threading
+from typing import NamedTuple
+from concurrent.futures import Future, wait
+
+import numpy as np
+
+from pymodbus import FramerType
+from pymodbus.exceptions import ConnectionException
+import pymodbus.client as ModbusClient
+
+from regmap import device_entries, plan_reads, plan_writes, max_gap_registers, REGMAP_MAX_READ_BITS
+
+MODBUS_SERIAL_MODES = ('RTU', 'ASCII')
+MODBUS_TCP_MODES = ('TCP', 'RTU_OVER_TCP')
+MODBUS_RECONNECT_INTERVAL = 1.0
+MODBUS_ILLEGAL_ADDRESS = 2 # exception code
+
+class ModbusDevice():
+    def __init__(self, index:int, config:dict):
+        self.index = index
+        self.name = config.get('name', 'dev%d'%index)
+        self.mode = config.get('mode', 'RTU').upper()
+        if self.mode in MODBUS_SERIAL_MODES:
+            self.host = None
+            self.port = config['port']
+            self.pool_size = 1
+        elif self.mode in MODBUS_TCP_MODES:
+            self.host = config['host']
+            self.port = int(config.get('port', 502))
+            self.pool_size = max(1, int(config.get('pool_size', 2)))
+        else:
+            raise ValueError('Invalid modbus mode: %s'%self.mode)
+        self.baudrate = int(config.get('baudrate', 38400))
+        self.slave = int(config.get('slave', 1))
+        self.timeout = float(config.get('timeout', 0.5))
+        self.retries = int(config.get('retries', 0))
+        # registers read for nothing when that is cheaper than another request, see regmap.py
+        self.max_gap = int(config.get('max_gap', max_gap_registers(self.mode, self.baudrate)))
+        self.entries = device_entries(config)
+        self.reads = plan_reads(self.entries, self.max_gap)
+        self.writes = plan_writes(self.entries)
+        self.ai_channels = sorted(c for e in self.entries if e.kind == 'ai' for c in e.channels)
+        self.ao_channels = sorted(c for e in self.entries if e.kind == 'ao' for c in e.channels)
+
+    @property
+    def bus_key(self) -> str:
+        return self.port if self.host is None else '%s:%d'%(self.host, self.port)
+
+    @property
+    def connection(self) -> dict:
+        # settings of the client a bus shares, the same for every device on it
+        ret = {'mode': self.mode, 'timeout': self.timeout, 'retries': self.retries}
+        if self.host is None:
+            ret['baudrate'] = self.baudrate
+        else:
+            ret['pool_size'] = self.pool_size
+        return ret
+
+    def create_client(self):
+        if self.mode in MODBUS_SERIAL_MODES:
+            framer = FramerType.RTU if self.mode == 'RTU' else FramerType.ASCII
+            return ModbusClient.ModbusSerialClient(port=self.port, framer=framer, baudrate=self.baudrate, timeout=self.timeout, retries=self.retries, reconnect_delay=0)
+        framer = FramerType.SOCKET if self.mode == 'TCP' else FramerType.RTU
+        return ModbusClient.ModbusTcpClient(self.host, port=self.port, framer=framer, timeout=self.timeout, retries=self.retries, reconnect_delay=0)
+
+    def info(self) -> dict:
+        return {'name': self.name, 'bus': self.bus_key, 'mode': self.mode, 'baudrate': self.baudrate, 'slave': self.slave, 'reads': len(self.reads), 'writes': len(self.writes)}
+
+    def split_read(self, request):
+        # a merged read the slave refused (e.g. a gap it does not implement) is
+        # replaced by one read per entry for good
+        if len(request.parts) <= 1:
+            return
+        print('Background: Modbus read of %d registers at %d refused, reading its parts separately: %s'%(request.count, request.address, self.name))
+        _parts = plan_reads([e for e, _ in request.parts], -REGMAP_MAX_READ_BITS)
+        self.reads = [r for r in self.reads if r is not request] + _parts
+
+class PollResult(NamedTuple):
+    ai_raw: np.ndarray
+    stale: int
+    ok: bool
+    time_ns: int
+    mono_ns: int
+
+class ModbusLane():
+    # One connection with its own worker thread. Requests on a lane run back to
+    # back; lanes run concurrently. AO setpoints are not queued: the lane keeps the
+    # latest values and writes them at the next free slot, ahead of anything queued
+    # and between the reads of a poll, so bursts of changes become one write.
+    _STOP = object()
+    _WAKE = object()
+
+    def __init__(self, bus, name:str, ao_latency=None):
+        self.bus = bus
+        self.name = name
+        self.devices: list[ModbusDevice] = []
+        self.client = None
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = None
+        self._pending: Future|None = None
+        self.read_errors = 0
+        self.write_errors = 0
+        self.disconnects = 0
+        self.busy_skips = 0 # polls that found the previous read still running
+        self.read_done = None # (time_ns, perf_counter_ns) when the last read finished
+        self._ao_lock = threading.Lock()
+        self._ao_values = None
+        self._ao_dirty = False
+        self._ao_since = 0.0
+        self.ao_requests = 0
+        self.ao_writes = 0
+        self.ao_latency = ao_latency # LatencyHistogram of request -> written, see metrics.py
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.name = 'ModbusLane-%s'%self.name
+        self._thread.start()
+
+    def stop(self):
+        if not self._thread:
+            return
+        self.submit(self._close)
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, fn, *args) -> Future:
+        _future: Future = Future()
+        self._queue.put((_future, fn, args))
+        return _future
+
+    def _run(self):
+        while True:
+            _item = self._queue.get()
+            self._flush_ao()
+            if _item is self._STOP:
+                break
+            if _item is self._WAKE:
+                continue
+            _future, _fn, _args = _item
+            if not _future.set_running_or_notify_cancel():
+                continue
+            try:
+                _future.set_result(_fn(*_args))
+            except Exception as e:
+                _future.set_exception(e)
+
+    def _close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+
+    def _disconnected(self, e:Exception):
+        self.disconnects += 1
+        print('Background: Modbus connection lost: %s'%self.name)
+        print(e)
+        self._close()
+        self.bus.request_reconnect()
+
+    def _read(self, dev, request):
+        _client = self.client
+        if request.fc == 1:
+            rr = _client.read_coils(request.address, request.count, slave=dev.slave)
+        elif request.fc == 2:
+            rr = _client.read_discrete_inputs(request.address, request.count, slave=dev.slave)
+        elif request.fc == 3:
+            rr = _client.read_holding_registers(request.address, request.count, slave=dev.slave)
+        else:
+            rr = _client.read_input_registers(request.address, request.count, slave=dev.slave)
+        if rr.isError():
+            if getattr(rr, 'exception_code', None) == MODBUS_ILLEGAL_ADDRESS:
+                dev.split_read(request)
+            return None
+        return rr.bits if request.fc in (1, 2) else rr.registers
+
+    def _read_all(self) -> list:
+        # [(device, [(request, reply or None), ...]), ...]
+        if self.client is None:
+            return []
+        ret = []
+        for dev in self.devices:
+            if not dev.reads:
+                continue
+            _replies = []
+            for request in list(dev.reads):
+                self._flush_ao()
+                try:
+                    _data = self._read(dev, request)
+                except (ConnectionException, OSError) as e:
+                    self._disconnected(e)
+                    return ret
+                except Exception as e:
+                    print('Background: Modbus read failed: %s'%dev.name)
+                    print(e)
+                    _data = None
+                if _data is None:
+                    self.read_errors += 1
+                _replies.append((request, _data))
+            ret.append((dev, _replies))
+        return ret
+
+    def _read_stamped(self) -> list:
+        try:
+            return self._read_all()
+        finally:
+            self.read_done = (time.time_ns(), time.perf_counter_ns())
+
+    def _write_ao(self, ao_raw:list[int]):
+        _client = self.client
+        if _client is None:
+            return
+        for dev in self.devices:
+            for request in dev.writes:
+                try:
+                    if request.fc == 1:
+                        _client.write_coils(request.address, request.encode(ao_raw), slave=dev.slave)
+                    else:
+                        _client.write_registers(request.address, request.encode(ao_raw), slave=dev.slave)
+                except (ConnectionException, OSError) as e:
+                    self._disconnected(e)
+                    return
+                except Exception as e:
+                    self.write_errors += 1
+                    print('Background: Modbus write failed: %s'%dev.name)
+                    print(e)
+
+    def trigger_read(self) -> Future|None:
+        # at most one outstanding read per lane, a slow lane is not queued up
+        if self._pending is not None:
+            self.busy_skips += 1
+            return None
+        self._pending = self.submit(self._read_stamped)
+        return self._pending
+
+    def harvest(self) -> list:
+        if self._pending is None or not self._pending.done():
+            return []
+        _future, self._pending = self._pending, None
+        try:
+            return _future.result()
+        except Exception as e:
+            print('Background: Modbus lane %s failed'%self.name)
+            print(e)
+            return []
+
+    def _flush_ao(self):
+        with self._ao_lock:
+            if not self._ao_dirty or self.client is None:
+                # kept pending while disconnected, resync_ao() sends it
+                return
+            _values, _since = self._ao_values, self._ao_since
+            self._ao_dirty = False
+        self._write_ao(_values)
+        self.ao_writes += 1
+        if self.ao_latency is not None:
+            self.ao_latency.observe(time.perf_counter() - _since)
+
+    def write_ao(self, ao_raw:list[int]):
+        # any thread; merged into the pending write if there is one
+        with self._ao_lock:
+            self.ao_requests += 1
+            self._ao_values = list(ao_raw)
+            if self._ao_dirty:
+                return
+            self._ao_dirty = True
+            self._ao_since = time.perf_counter()
+        self._queue.put(self._WAKE)
+
+    def resync_ao(self):
+        # after (re)connecting, the outputs get the latest setpoints again
+        with self._ao_lock:
+            if self._ao_values is None:
+                return
+            if not self._ao_dirty:
+                self._ao_dirty = True
+                self._ao_since = time.perf_counter()
+        self._queue.put(self._WAKE)
+
+class ModbusBus():
+    # One serial port or TCP gateway. A gateway keeps a small pool of persistent
+    # connections and spreads its slaves over them round-robin, so requests to
+    # unit IDs on different connections are in flight at the same time; on one
+    # connection a request waits for the previous reply (no pipelining).
+    # Connections are (re)opened by a background thread; a lane without a
+    # connection just reports its devices stale.
+    def __init__(self, key:str, devices:list[ModbusDevice], ao_latency=None):
+        self.key = key
+        self.devices = devices
+        _pool_size = min(devices[0].pool_size, len(devices))
+        self.lanes = [ModbusLane(self, key if _pool_size == 1 else '%s#%d'%(key, i), ao_latency) for i in range(_pool_size)]
+        for i, dev in enumerate(devices):
+            self.lanes[i % _pool_size].devices.append(dev)
+        self._reconnect_event = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        for lane in self.lanes:
+            lane.start()
+        self._running = True
+        self._thread = threading.Thread(target=self._reconnect_thread, daemon=True)
+        self._thread.name = 'ModbusReconnect-%s'%self.key
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._reconnect_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        for lane in self.lanes:
+            lane.stop()
+
+    def request_reconnect(self):
+        self._reconnect_event.set()
+
+    def _reconnect_thread(self):
+        _reported = False
+        while self._running:
+            for lane in self.lanes:
+                if not self._running:
+                    break
+                if lane.client is not None:
+                    continue
+                _client = self.devices[0].create_client()
+                if _client.connect():
+                    lane.client = _client
+                    lane.resync_ao()
+                    print('Background: Modbus Connected: %s'%lane.name)
+                    _reported = False
+                elif not _reported:
+                    print('Background: Modbus Failed to connect: %s'%lane.name)
+                    _reported = True
+            self._reconnect_event.wait(MODBUS_RECONNECT_INTERVAL)
+            self._reconnect_event.clear()
+
+class FieldBus():
+    def __init__(self, devices:list[dict], num_ai:int, num_ao:int, ao_latency=None):
+        self.devices = [ModbusDevice(i, c) for i, c in enumerate(devices)]
+        if len(self.devices) > 63:
+            raise ValueError('Too many devices')
+        _mapped = set()
+        for dev in self.devices:
+            if dev.ai_channels and dev.ai_channels[-1] >= num_ai:
+                raise ValueError('Invalid ai channels: %s'%dev.name)
+            if dev.ao_channels and dev.ao_channels[-1] >= num_ao:
+                raise ValueError('Invalid ao channels: %s'%dev.name)
+            if _mapped.intersection(dev.ai_channels) or len(set(dev.ai_channels)) != len(dev.ai_channels):
+                raise ValueError('AI channel mapped twice: %s'%dev.name)
+            _mapped.update(dev.ai_channels)
+        _grouped: dict[str, list[ModbusDevice]] = {}
+        for dev in self.devices:
+            _grouped.setdefault(dev.bus_key, []).append(dev)
+        for key, devs in _grouped.items():
+            for dev in devs[1:]:
+                _diff = [k for k, v in dev.connection.items() if devs[0].connection[k] != v]
+                if _diff:
+                    raise ValueError('Devices on %s differ in %s: %s, %s'%(key, ', '.join(_diff), devs[0].name, dev.name))
+        self.buses = [ModbusBus(key, devs, ao_latency) for key, devs in _grouped.items()]
+        self.lanes = [lane for bus in self.buses for lane in bus.lanes]
+        self._ao_lanes = [lane for lane in self.lanes if any(dev.writes for dev in lane.devices)]
+        self._ai = np.zeros(num_ai, dtype=np.int16)
+        self._ai_mask = sum(1 << dev.index for dev in self.devices if dev.reads)
+
+    def start(self):
+        for bus in self.buses:
+            bus.start()
+
+    def stop(self):
+        for bus in self.buses:
+            bus.stop()
+
+    def _apply(self, results:list) -> int:
+        # a device is fresh when every one of its reads answered
+        _fresh = 0
+        for dev, replies in results:
+            _ok = True
+            for request, data in replies:
+                if data is None:
+                    _ok = False
+                    continue
+                self._ai[request.channels] = request.decode(data)
+            if _ok:
+                _fresh |= 1 << dev.index
+        return _fresh
+
+    def poll(self, timeout:float) -> PollResult:
+        # results that arrived after the previous poll gave up still update the values
+        for lane in self.lanes:
+            self._apply(lane.harvest())
+        _triggered = [(lane, lane.trigger_read()) for lane in self.lanes]
+        wait([f for _, f in _triggered if f is not None], timeout=timeout)
+        # the frame is as of its last reply, not of the request that started the reads
+        _done = [lane.read_done for lane, _future in _triggered if _future is not None and _future.done()]
+        _time_ns, _mono_ns = max(_done) if _done else (time.time_ns(), time.perf_counter_ns())
+        _fresh = 0
+        for lane, _future in _triggered:
+            _mask = self._apply(lane.harvest())
+            if _future is not None:
+                _fresh |= _mask
+        return PollResult(self._ai.copy(), self._ai_mask & ~_fresh, _fresh != 0, _time_ns, _mono_ns)
+
+    def error_counts(self) -> dict[str, int]:
+        return {
+            'read_errors': sum(lane.read_errors for lane in self.lanes),
+            'write_errors': sum(lane.write_errors for lane in self.lanes),
+            'disconnects': sum(lane.disconnects for lane in self.lanes),
+            'busy_skips': sum(lane.busy_skips for lane in self.lanes),
+        }
+
+    def ao_counts(self) -> dict[str, int]:
+        # requested - written = writes merged into a pending one
+        return {
+            'requested': sum(lane.ao_requests for lane in self._ao_lanes),
+            'written': sum(lane.ao_writes for lane in self._ao_lanes),
+        }
+
+    def write_ao(self, ao_raw:list[int]):
+        # thread-safe, returns at once
+        for lane in self._ao_lanes:
+            lane.write_ao(ao_raw)
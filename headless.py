@@ -0,0 +1,52 @@
+import signal, argparse, threading
+
+from core import LoggerCore, WEB_HOST, WEB_PORT, LOG_BACKEND, LOG_BACKENDS, LOG_SAVE_MODE, LOG_SAVE_MODES, LOG_DECIMATE, LOG_ROTATE_MB, LOG_ROTATE_HOURS, LOG_ARCHIVE_CODEC, LOG_ARCHIVE_REMOVE_SOURCE, RING_BUFFER_CAPACITY, prepare_process
+from storage import FRAME_DECIMATE_METHODS
+from archive import ARCHIVE_CODECS
+
+def main():
+    parser = argparse.ArgumentParser(description='Modbus Simple Logger without GUI')
+    parser.add_argument('--config', default=None, help='config.json path (default: the one saved by the GUI)')
+    parser.add_argument('--host', default=WEB_HOST, help='web server host')
+    parser.add_argument('--port', type=int, default=WEB_PORT, help='web server port')
+    parser.add_argument('--record', action='store_true', help='start recording immediately')
+    parser.add_argument('--backend', choices=LOG_BACKENDS, default=LOG_BACKEND, help='session storage format')
+    parser.add_argument('--save-mode', choices=LOG_SAVE_MODES, default=LOG_SAVE_MODE, help='frames: every acquired frame, timer: sample on the save interval')
+    parser.add_argument('--interval', type=int, default=None, help='save interval in ms (default: the acquisition interval)')
+    parser.add_argument('--decimate', choices=FRAME_DECIMATE_METHODS, default=LOG_DECIMATE, help='frames mode, saving slower than acquiring: keep every Nth frame or the block mean')
+    parser.add_argument('--rotate-mb', type=float, default=LOG_ROTATE_MB, help='continue in a new segment file above this size, 0: never')
+    parser.add_argument('--rotate-hours', type=float, default=LOG_ROTATE_HOURS, help='continue in a new segment file after this long, 0: never')
+    parser.add_argument('--archive', choices=ARCHIVE_CODECS+('none',), default=LOG_ARCHIVE_CODEC or 'none', help='compress closed segments in the background')
+    parser.add_argument('--archive-remove-source', action='store_true', default=LOG_ARCHIVE_REMOVE_SOURCE, help='delete session files once archived')
+    parser.add_argument('--ring-buffer', type=int, default=RING_BUFFER_CAPACITY, help='recent frames kept in memory for /history?source=memory')
+    parser.add_argument('--acquire-interval', type=int, default=None, help='modbus acquisition interval in ms')
+    parser.add_argument('--publish-interval', type=int, default=None, help='websocket publish interval in ms')
+    args = parser.parse_args()
+
+    prepare_process()
+
+    core = LoggerCore(args.config, args.host, args.port, args.backend, args.save_mode)
+    _stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: _stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: _stop.set())
+
+    core.set_log_rotation(args.rotate_mb, args.rotate_hours)
+    core.set_log_archive(None if args.archive == 'none' else args.archive, args.archive_remove_source)
+    core.set_ring_buffer(args.ring_buffer)
+    core.start()
+    _acquire_ms = args.acquire_interval or 100
+    if args.acquire_interval or args.publish_interval:
+        core.set_modbus_interval(_acquire_ms, args.publish_interval)
+    # every acquired frame unless --interval asks for fewer; saving faster than
+    # acquiring would only repeat rows
+    core.set_sql_save_interval(max(_acquire_ms, args.interval or _acquire_ms), args.decimate)
+    if args.record:
+        core.send_command(LoggerCore.BG_CMD_SQL_SAVE_START)
+    print('Headless: Websocket URL: %s'%core.webserver_url)
+
+    while not _stop.wait(1.0):
+        pass
+    core.stop()
+
+if __name__ == "__main__":
+    main()
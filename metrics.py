@@ -0,0 +1,148 @@
+import bisect, threading
+
+METRICS_PREFIX = 'msl_'
+# seconds, 10 us .. 10 s in 1-2.5-5 steps
+METRICS_LATENCY_BUCKETS = tuple(m * 10.0**e for e in range(-5, 1) for m in (1.0, 2.5, 5.0)) + (10.0,)
+METRICS_QUANTILES = (0.5, 0.9, 0.99)
+
+def _labels_text(labels:tuple) -> str:
+    if not labels:
+        return ''
+    return '{%s}'%','.join('%s="%s"'%(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+class LatencyHistogram():
+    # Fixed buckets, so an observation is one bisect and a few adds under a lock;
+    # nothing is allocated on the hot path.
+    def __init__(self, buckets:tuple=METRICS_LATENCY_BUCKETS):
+        if not buckets or list(buckets) != sorted(buckets):
+            raise ValueError('Invalid buckets')
+        self._bounds = tuple(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds:float):
+        _i = bisect.bisect_left(self._bounds, seconds)
+        with self._lock:
+            self._counts[_i] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self._bounds) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.max = 0.0
+
+    def cumulative(self) -> list[tuple[float, int]]:
+        # (upper bound, count <= bound) including +Inf, as Prometheus expects
+        with self._lock:
+            _counts = list(self._counts)
+        ret = []
+        _total = 0
+        for _bound, _count in zip(self._bounds + (float('inf'),), _counts):
+            _total += _count
+            ret.append((_bound, _total))
+        return ret
+
+    def quantile(self, q:float) -> float:
+        # upper bound of the bucket holding the q-th observation, the max for the last one
+        _cumulative = self.cumulative()
+        _total = _cumulative[-1][1]
+        if _total == 0:
+            return 0.0
+        _rank = q * _total
+        for _bound, _count in _cumulative:
+            if _count >= _rank:
+                return min(_bound, self.max)
+        return self.max
+
+    def stats(self) -> dict:
+        ret = {
+            'count': self.count,
+            'mean_us': self.sum/self.count*1E6 if self.count else 0.0,
+            'max_us': self.max*1E6,
+        }
+        for q in METRICS_QUANTILES:
+            ret['p%g_us'%(q*100)] = self.quantile(q)*1E6
+        return ret
+
+class Counter():
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n:int=1):
+        self.value += n
+
+class MetricsRegistry():
+    # Histograms are fed by the stages themselves; counters and gauges may instead
+    # be read from a callback at scrape time, so existing counters (writer rows,
+    # scheduler ticks...) cost nothing on the hot path.
+    def __init__(self, prefix:str=METRICS_PREFIX):
+        self._prefix = prefix
+        self._families: dict[str, tuple[str, str, dict]] = {}
+
+    def _add(self, kind:str, name:str, help:str, labels:dict|None, metric):
+        _family = self._families.setdefault(name, (kind, help, {}))
+        if _family[0] != kind:
+            raise ValueError('Metric %s is a %s'%(name, _family[0]))
+        _key = tuple(sorted((labels or {}).items()))
+        if _key in _family[2]:
+            return _family[2][_key]
+        _family[2][_key] = metric
+        return metric
+
+    def histogram(self, name:str, help:str='', labels:dict|None=None) -> LatencyHistogram:
+        return self._add('histogram', name, help, labels, LatencyHistogram())
+
+    def counter(self, name:str, help:str='', labels:dict|None=None, source=None) -> Counter:
+        # source: callable returning the current total instead of inc() calls
+        return self._add('counter', name, help, labels, source or Counter())
+
+    def gauge(self, name:str, help:str, source, labels:dict|None=None):
+        return self._add('gauge', name, help, labels, source)
+
+    def _value(self, metric) -> float:
+        return metric.value if isinstance(metric, Counter) else metric()
+
+    def prometheus(self) -> str:
+        # text exposition format 0.0.4
+        _lines = []
+        for name, (kind, help, metrics) in self._families.items():
+            _name = self._prefix + name
+            if help:
+                _lines.append('# HELP %s %s'%(_name, help))
+            _lines.append('# TYPE %s %s'%(_name, kind))
+            for labels, metric in metrics.items():
+                if kind != 'histogram':
+                    _lines.append('%s%s %s'%(_name, _labels_text(labels), repr(float(self._value(metric)))))
+                    continue
+                for _bound, _count in metric.cumulative():
+                    _le = '+Inf' if _bound == float('inf') else repr(_bound)
+                    _lines.append('%s_bucket%s %d'%(_name, _labels_text(labels + (('le', _le),)), _count))
+                _lines.append('%s_sum%s %s'%(_name, _labels_text(labels), repr(metric.sum)))
+                _lines.append('%s_count%s %d'%(_name, _labels_text(labels), metric.count))
+        return '\n'.join(_lines) + '\n'
+
+    def stats(self) -> dict:
+        # {name: value} or {name: {label value: value}} for labelled families
+        ret = {}
+        for name, (kind, _, metrics) in self._families.items():
+            for labels, metric in metrics.items():
+                _value = metric.stats() if kind == 'histogram' else self._value(metric)
+                if labels:
+                    ret.setdefault(name, {})[','.join(str(v) for _, v in labels)] = _value
+                else:
+                    ret[name] = _value
+        return ret
+
+    def reset_histograms(self):
+        for kind, _, metrics in self._families.values():
+            if kind == 'histogram':
+                for metric in metrics.values():
+                    metric.reset()
@@ -0,0 +1,318 @@
+import os, re, ast, json, time, sqlite3, argparse
+
+import numpy as np
+
+from storage import copy_session, create_sqlite_engine
+from rollup import RollupReader, rebuild_rollups
+
+PARAM_TIME_BUDGET_MS = 1.0
+PARAM_BATCH_ROWS = 50000
+
+# name in expressions -> numpy function, all element-wise
+PARAM_FUNCTIONS = {
+    'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'asin': 'arcsin', 'acos': 'arccos', 'atan': 'arctan', 'atan2': 'arctan2',
+    'sqrt': 'sqrt', 'exp': 'exp', 'log': 'log', 'log10': 'log10', 'abs': 'abs', 'sign': 'sign', 'floor': 'floor', 'round': 'round',
+    'min': 'minimum', 'max': 'maximum', 'clip': 'clip', 'where': 'where',
+}
+# (min, max) arguments, checked at compile time; unary unless listed
+PARAM_ARITY = {'atan2': (2, 2), 'round': (1, 2), 'min': (2, 2), 'max': (2, 2), 'clip': (3, 3), 'where': (3, 3)}
+PARAM_CONSTANTS = {'pi': np.pi, 'e': np.e}
+
+class _Integrate():
+    # trapezoidal integral over t
+    def __init__(self):
+        self._x = None
+        self._t = None
+        self._acc = 0.0
+
+    def __call__(self, x, t:np.ndarray) -> np.ndarray:
+        _x = np.broadcast_to(np.asarray(x, dtype=np.float64), t.shape)
+        _xs = np.r_[_x[0] if self._x is None else self._x, _x]
+        _ts = np.r_[t[0] if self._t is None else self._t, t]
+        ret = self._acc + np.cumsum((_xs[1:] + _xs[:-1]) * 0.5 * np.diff(_ts))
+        self._x, self._t, self._acc = _x[-1], t[-1], ret[-1]
+        return ret
+
+class _Differentiate():
+    # backward difference over t, 0 for the first sample
+    def __init__(self):
+        self._x = None
+        self._t = None
+
+    def __call__(self, x, t:np.ndarray) -> np.ndarray:
+        _x = np.broadcast_to(np.asarray(x, dtype=np.float64), t.shape)
+        _dx = np.diff(np.r_[_x[0] if self._x is None else self._x, _x])
+        _dt = np.diff(np.r_[t[0] if self._t is None else self._t, t])
+        self._x, self._t = _x[-1], t[-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(_dt > 0, _dx / _dt, 0.0)
+
+class _MovingAverage():
+    # mean of the last n samples (fewer at the start)
+    def __init__(self, n:int):
+        if n < 1:
+            raise ValueError('Invalid window: %d'%n)
+        self._n = n
+        self._tail = np.empty(0)
+
+    def __call__(self, x, t:np.ndarray) -> np.ndarray:
+        _x = np.broadcast_to(np.asarray(x, dtype=np.float64), t.shape)
+        _w = np.r_[self._tail, _x]
+        _sum = np.r_[0.0, np.cumsum(_w)]
+        _end = np.arange(len(self._tail), len(_w)) + 1
+        _start = np.maximum(0, _end - self._n)
+        self._tail = _w[len(_w) - min(len(_w), self._n - 1):]
+        return (_sum[_end] - _sum[_start]) / (_end - _start)
+
+PARAM_OPERATORS = {'integ': _Integrate, 'deriv': _Differentiate, 'mavg': _MovingAverage}
+
+class _Rewriter(ast.NodeTransformer):
+    # checks one expression against the whitelist and rewrites it onto the plan's arrays
+    _ALLOWED = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.IfExp, ast.Call, ast.Name, ast.Constant, ast.Load,
+                ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.FloorDiv, ast.USub, ast.UAdd,
+                ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+    def __init__(self, ch:int, num_ai:int, num_ao:int, num_param:int, operators:list):
+        self._limits = {'ai_phy': num_ai, 'ao_phy': num_ao, 'param': ch, 'prev': num_param}
+        self._operators = operators # factories, shared by all channels of a plan
+        self.uses_previous = False
+
+    def _load(self, source:str) -> ast.expr:
+        return ast.parse(source, mode='eval').body
+
+    def generic_visit(self, node):
+        if not isinstance(node, self._ALLOWED):
+            raise ValueError('Not allowed: %s'%type(node).__name__)
+        return super().generic_visit(node)
+
+    def visit_Constant(self, node):
+        if type(node.value) not in (int, float):
+            raise ValueError('Not a number: %r'%node.value)
+        return node
+
+    def visit_Name(self, node):
+        if node.id in ('t', 'dt'):
+            return self._load('_' + node.id)
+        if node.id in PARAM_CONSTANTS:
+            return ast.Constant(PARAM_CONSTANTS[node.id])
+        _m = re.fullmatch(r'(ai_phy|ao_phy|param|prev)_(\d+)', node.id)
+        if not _m or int(_m.group(2)) >= self._limits[_m.group(1)]:
+            raise ValueError('Unknown name: %s'%node.id)
+        _kind, _index = _m.group(1), int(_m.group(2))
+        if _kind == 'param':
+            # this tick's value of an earlier channel
+            return self._load('_out[%d]'%_index)
+        if _kind == 'prev':
+            self.uses_previous = True
+        return self._load('_%s[:, %d]'%({'ai_phy': 'ai', 'ao_phy': 'ao', 'prev': 'prev'}[_kind], _index))
+
+    def visit_IfExp(self, node):
+        _node = ast.Call(ast.Name('where', ast.Load()), [node.test, node.body, node.orelse], [])
+        return self.visit_Call(_node)
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.keywords:
+            raise ValueError('Invalid call')
+        _name = node.func.id
+        if _name in PARAM_OPERATORS:
+            _args = node.args
+            if _name == 'mavg':
+                if len(_args) != 2 or not isinstance(_args[1], ast.Constant) or type(_args[1].value) is not int:
+                    raise ValueError('mavg(x, n) needs a constant integer n')
+                if _args[1].value < 1:
+                    raise ValueError('Invalid window: %d'%_args[1].value)
+                self._operators.append(lambda n=_args[1].value: _MovingAverage(n))
+            else:
+                if len(_args) != 1:
+                    raise ValueError('%s(x) takes one argument'%_name)
+                self._operators.append(PARAM_OPERATORS[_name])
+            _call = self._load('_ops[%d](None, _t)'%(len(self._operators) - 1))
+            _call.args[0] = self.visit(_args[0])
+            return _call
+        if _name not in PARAM_FUNCTIONS:
+            raise ValueError('Unknown function: %s'%_name)
+        _min, _max = PARAM_ARITY.get(_name, (1, 1))
+        if not _min <= len(node.args) <= _max:
+            raise ValueError('%s() takes %s arguments, got %d'%(_name, _min if _min == _max else '%d to %d'%(_min, _max), len(node.args)))
+        if _name == 'round' and len(node.args) == 2 and not (isinstance(node.args[1], ast.Constant) and type(node.args[1].value) is int):
+            raise ValueError('round(x, n) needs a constant integer n')
+        _call = self._load('_np.%s()'%PARAM_FUNCTIONS[_name])
+        _call.args = [self.visit(a) for a in node.args]
+        return _call
+
+class ParamEngine():
+    # Param channels defined as expressions over ai_phy_N, ao_phy_N, param_N (this
+    # tick, earlier channels), prev_N (last tick), t (s since start), dt and the
+    # stateful integ(x), deriv(x), mavg(x, n). All expressions are compiled once
+    # into a single numpy function over arrays of rows: a live tick is one row,
+    # batch mode feeds whole chunks. Channels without an expression are passed through.
+    def __init__(self, exprs:list[str], num_ai:int, num_ao:int, budget_ms:float=PARAM_TIME_BUDGET_MS):
+        self._num_param = len(exprs)
+        self._budget_ms = budget_ms
+        self._factories: list = []
+        self._channels: list[int] = []
+        self._uses_previous = False
+        _lines = ['def _plan(_np, _ai, _ao, _prev, _param, _t, _dt, _ops):', '    _out = list(_param.T)']
+        for ch, _expr in enumerate(exprs):
+            if not _expr or not _expr.strip():
+                continue
+            _rewriter = _Rewriter(ch, num_ai, num_ao, self._num_param, self._factories)
+            try:
+                _tree = _rewriter.visit(ast.parse(_expr.strip(), mode='eval'))
+            except (SyntaxError, ValueError) as e:
+                raise ValueError('param_%d: %s: %s'%(ch, _expr, e))
+            self._uses_previous |= _rewriter.uses_previous
+            self._channels.append(ch)
+            _lines.append('    _out[%d] = _np.broadcast_to(_np.asarray(%s, dtype=_np.float64), _t.shape)'%(ch, ast.unparse(_tree)))
+        _lines.append('    return _out')
+        _namespace: dict = {}
+        exec(compile('\n'.join(_lines), '<param plan>', 'exec'), _namespace)
+        self._plan = _namespace['_plan']
+        self.reset()
+
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+        self.overruns = 0
+
+    @property
+    def channels(self) -> list[int]:
+        return list(self._channels)
+
+    @property
+    def uses_previous(self) -> bool:
+        return self._uses_previous
+
+    def reset(self):
+        # start over: fresh operator state and t = 0 at the next row
+        self._operators = [f() for f in self._factories]
+        self._t0 = None
+        self._t_last = None
+
+    def evaluate(self, ai_phy:np.ndarray, ao_phy:np.ndarray, t:np.ndarray, param:np.ndarray, previous:np.ndarray) -> np.ndarray:
+        # [rows, ...] inputs, t in seconds on any clock; param holds the values of
+        # channels without an expression, previous is the last output row
+        _t = np.asarray(t, dtype=np.float64)
+        if len(_t) == 0:
+            return np.empty((0, self._num_param))
+        if self._t0 is None:
+            self._t0 = _t[0]
+        _rel = _t - self._t0
+        _dt = np.diff(np.r_[_rel[0] if self._t_last is None else self._t_last, _rel])
+        self._t_last = _rel[-1]
+        _ai = np.asarray(ai_phy, dtype=np.float64)
+        _ao = np.asarray(ao_phy, dtype=np.float64)
+        _param = np.asarray(param, dtype=np.float64)
+        if not self._uses_previous:
+            return np.stack(self._plan(np, _ai, _ao, None, _param, _rel, _dt, self._operators), axis=1)
+        # prev_N makes every row depend on the one before it
+        ret = np.empty(_param.shape)
+        _prev = np.asarray(previous, dtype=np.float64).reshape(1, -1)
+        for i in range(len(_rel)):
+            _prev = np.stack(self._plan(np, _ai[i:i+1], _ao[i:i+1], _prev, _param[i:i+1], _rel[i:i+1], _dt[i:i+1], self._operators), axis=1)
+            ret[i] = _prev[0]
+        return ret
+
+    def step(self, ai_phy, ao_phy, param, t:float) -> list[float]:
+        # one live tick, timed against the budget
+        _started = time.perf_counter()
+        _param = np.asarray(param, dtype=np.float64)
+        ret = self.evaluate(np.asarray(ai_phy)[None], np.asarray(ao_phy)[None], np.array([t]), _param[None], _param)[0].tolist()
+        self.last_ms = (time.perf_counter() - _started) * 1000.0
+        self.max_ms = max(self.max_ms, self.last_ms)
+        if self.last_ms > self._budget_ms:
+            self.overruns += 1
+        return ret
+
+def exprs_from_config(config:dict) -> list[str]:
+    return [c.get('expr', '') for c in config['param']]
+
+def recompute_params(db_path:str, exprs:list[str], out_path:str|None=None, chunk_rows:int=PARAM_BATCH_ROWS, progress=None) -> dict:
+    # Batch mode: recompute the param_phy_* columns of a stored session from its
+    # ai_phy/ao_phy columns with the given expressions, chunk by chunk.
+    if chunk_rows <= 0:
+        raise ValueError('Invalid chunk rows')
+    _path = db_path
+    if out_path:
+        copy_session(db_path, out_path)
+        _path = out_path
+
+    with sqlite3.connect(_path) as _conn:
+        _columns = [r[1] for r in _conn.execute('PRAGMA table_info(data)').fetchall()]
+    _ai_cols = [c for c in _columns if c.startswith('ai_phy_')]
+    _ao_cols = [c for c in _columns if c.startswith('ao_phy_')]
+    _param_cols = [c for c in _columns if c.startswith('param_phy_')]
+    if len(exprs) != len(_param_cols):
+        raise ValueError('Expected %d expressions'%len(_param_cols))
+    _engine = ParamEngine(exprs, len(_ai_cols), len(_ao_cols), budget_ms=float('inf'))
+    if not _engine.channels:
+        raise ValueError('No expression given')
+    _select = 'SELECT id, time, %s FROM data WHERE id > ? ORDER BY id LIMIT ?'%', '.join(_ai_cols + _ao_cols + _param_cols)
+    _update = 'UPDATE data SET %s WHERE id = ?'%', '.join('%s = ?'%_param_cols[ch] for ch in _engine.channels)
+
+    _rows = 0
+    _last = 0
+    _previous = np.zeros(len(_param_cols))
+    _started = time.perf_counter()
+    _db = create_sqlite_engine(_path)
+    try:
+        while True:
+            with _db.begin() as conn:
+                _conn = conn.connection.driver_connection
+                _chunk = _conn.execute(_select, (_last, chunk_rows)).fetchall()
+                if not _chunk:
+                    break
+                _ids, _times, *_values = zip(*_chunk)
+                _values = np.array(_values, dtype=np.float64).T
+                _na, _no = len(_ai_cols), len(_ao_cols)
+                _t = np.array(_times, dtype='datetime64[us]').astype(np.int64) / 1E6
+                _param = _engine.evaluate(_values[:, :_na], _values[:, _na:_na+_no], _t, _values[:, _na+_no:], _previous)
+                _previous = _param[-1]
+                _out = _param[:, _engine.channels].astype(np.float32).astype(np.float64)
+                _conn.executemany(_update, [(*r, i) for r, i in zip(_out.tolist(), _ids)])
+            _last = _ids[-1]
+            _rows += len(_chunk)
+            if progress:
+                progress(_rows)
+    finally:
+        _db.dispose()
+    with RollupReader(_path) as _rollup:
+        _levels = _rollup.levels
+    if _levels:
+        rebuild_rollups(_path, _levels)
+    _elapsed = time.perf_counter() - _started
+    return {
+        'path': _path,
+        'rows': _rows,
+        'columns': [_param_cols[ch] for ch in _engine.channels],
+        'seconds': _elapsed,
+        'rows_per_sec': _rows/_elapsed if _elapsed > 0 else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute the param columns of a recorded session from expressions')
+    parser.add_argument('session', help='session .sqlite3 file')
+    parser.add_argument('--config', default=None, help='take the expressions from a config.json')
+    parser.add_argument('--expr', nargs=2, action='append', default=[], metavar=('CH', 'EXPR'), help='expression of a param channel, repeatable')
+    parser.add_argument('--out', default=None, help='write into a new file instead of updating the session')
+    parser.add_argument('--chunk-rows', type=int, default=PARAM_BATCH_ROWS)
+    args = parser.parse_args()
+
+    with sqlite3.connect('file:%s?mode=ro'%args.session, uri=True) as _conn:
+        _num_param = len([r for r in _conn.execute('PRAGMA table_info(data)').fetchall() if r[1].startswith('param_phy_')])
+    _exprs = [''] * _num_param
+    if args.config:
+        with open(args.config, 'r') as f:
+            _exprs = exprs_from_config(json.load(f))
+    for ch, _expr in args.expr:
+        _exprs[int(ch)] = _expr
+
+    _started = time.perf_counter()
+    def _progress(rows):
+        _elapsed = time.perf_counter() - _started
+        print('\r%d rows, %.0f rows/s'%(rows, rows/_elapsed if _elapsed > 0 else 0.0), end='', flush=True)
+    ret = recompute_params(args.session, _exprs, args.out, args.chunk_rows, _progress)
+    print()
+    print('Recomputed %s of %d rows in %s in %.2f s (%.0f rows/s)'%(', '.join(ret['columns']), ret['rows'], os.path.basename(ret['path']), ret['seconds'], ret['rows_per_sec']))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os, time, json, argparse
+
+import numpy as np
+
+from channels import calc_phy, NUM_CH_AI, NUM_CH_AO
+from storage import SessionReader, copy_session, create_sqlite_engine
+from rollup import RollupReader, rebuild_rollups
+from catalog import SessionCatalog, CATALOG_NAME, SESSION_FILE_PATTERN
+
+RECALIB_CHUNK_ROWS = 100000
+
+def _check_calib(calib:dict[int, tuple], num_ch:int) -> dict[int, tuple]:
+    ret = {}
+    for ch, coef in calib.items():
+        if ch < 0 or ch >= num_ch:
+            raise ValueError('Invalid channel: %d'%ch)
+        if len(coef) != 3:
+            raise ValueError('Invalid calib: %s'%(coef,))
+        ret[int(ch)] = tuple(float(v) for v in coef)
+    return ret
+
+def _update_catalog(db_path:str, ai_calib:dict[int, tuple], ao_calib:dict[int, tuple]) -> bool:
+    # the catalog next to the session keeps the calibration it was recorded with
+    _match = SESSION_FILE_PATTERN.match(os.path.basename(db_path))
+    _directory = os.path.dirname(os.path.abspath(db_path))
+    if not _match or not os.path.exists(os.path.join(_directory, CATALOG_NAME)):
+        return False
+    return SessionCatalog(_directory).update_calib(_match['session'], ai_calib, ao_calib)
+
+def recalibrate(db_path:str, ai_calib:dict[int, tuple]|None=None, ao_calib:dict[int, tuple]|None=None, out_path:str|None=None, chunk_rows:int=RECALIB_CHUNK_ROWS, progress=None) -> dict:
+    # Recompute ai_phy_*/ao_phy_* from the raw columns with new (A, B, C) per
+    # channel, chunk by chunk. With out_path the session is copied first and
+    # only the copy is changed, otherwise the catalog's calibration follows.
+    _ai = _check_calib(ai_calib or {}, NUM_CH_AI)
+    _ao = _check_calib(ao_calib or {}, NUM_CH_AO)
+    _targets = [('ai', ch, coef) for ch, coef in sorted(_ai.items())]
+    _targets += [('ao', ch, coef) for ch, coef in sorted(_ao.items())]
+    if not _targets:
+        raise ValueError('No calibration given')
+    if chunk_rows <= 0:
+        raise ValueError('Invalid chunk rows')
+
+    _path = db_path
+    if out_path:
+        copy_session(db_path, out_path)
+        _path = out_path
+
+    _raw_cols = ['%s_raw_%d'%(kind, ch) for kind, ch, _ in _targets]
+    _phy_cols = ['%s_phy_%d'%(kind, ch) for kind, ch, _ in _targets]
+    _coef = np.array([coef for _, _, coef in _targets], dtype=np.float64)
+    _update_sql = 'UPDATE data SET %s WHERE id = ?'%', '.join('%s = ?'%c for c in _phy_cols)
+
+    _rows = 0
+    _started = time.perf_counter()
+    _engine = create_sqlite_engine(_path)
+    try:
+        with SessionReader(_path) as _reader:
+            for _ids, _raw in _reader.iter_arrays(_raw_cols, chunk_rows=chunk_rows):
+                _phy = calc_phy(_raw, _coef[:, 0], _coef[:, 1], _coef[:, 2]).astype(np.float64)
+                _params = list(zip(*_phy.T.tolist(), _ids.tolist()))
+                with _engine.begin() as conn:
+                    conn.exec_driver_sql(_update_sql, _params)
+                _rows += len(_ids)
+                if progress:
+                    progress(_rows)
+    finally:
+        _engine.dispose()
+    # the aggregates were taken from the old phy values
+    with RollupReader(_path) as _rollup:
+        _levels = _rollup.levels
+    if _levels:
+        rebuild_rollups(_path, _levels)
+    _catalog = False
+    if not out_path:
+        try:
+            _catalog = _update_catalog(_path, _ai, _ao)
+        except Exception as e:
+            print('Recalib: Failed to update catalog')
+            print(e)
+    _elapsed = time.perf_counter() - _started
+    return {
+        'path': _path,
+        'rows': _rows,
+        'columns': _phy_cols,
+        'catalog': _catalog,
+        'seconds': _elapsed,
+        'rows_per_sec': _rows/_elapsed if _elapsed > 0 else 0.0,
+    }
+
+def _calib_from_config(path:str) -> tuple[dict[int, tuple], dict[int, tuple]]:
+    with open(path, 'r') as f:
+        _config = json.load(f)
+    _ai = {ch: tuple(c['calib']) for ch, c in enumerate(_config.get('ai', []))}
+    _ao = {ch: tuple(c['calib']) for ch, c in enumerate(_config.get('ao', []))}
+    return _ai, _ao
+
+def main():
+    parser = argparse.ArgumentParser(description='Recalculate phy columns of a recorded session with new calibration')
+    parser.add_argument('session', help='session .sqlite3 file')
+    parser.add_argument('--out', default=None, help='write into a new file instead of updating the session')
+    parser.add_argument('--config', default=None, help='take every channel calibration from a config.json')
+    parser.add_argument('--ai', nargs=4, action='append', default=[], metavar=('CH', 'A', 'B', 'C'), help='AI channel calibration, repeatable')
+    parser.add_argument('--ao', nargs=4, action='append', default=[], metavar=('CH', 'A', 'B', 'C'), help='AO channel calibration, repeatable')
+    parser.add_argument('--chunk-rows', type=int, default=RECALIB_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    _ai, _ao = _calib_from_config(args.config) if args.config else ({}, {})
+    for ch, a, b, c in args.ai:
+        _ai[int(ch)] = (float(a), float(b), float(c))
+    for ch, a, b, c in args.ao:
+        _ao[int(ch)] = (float(a), float(b), float(c))
+
+    _started = time.perf_counter()
+    def _progress(rows):
+        _elapsed = time.perf_counter() - _started
+        print('\r%d rows, %.0f rows/s'%(rows, rows/_elapsed if _elapsed > 0 else 0.0), end='', flush=True)
+
+    ret = recalibrate(args.session, _ai, _ao, args.out, args.chunk_rows, _progress)
+    print()
+    print('Recalibrated %d rows of %s in %.2f s (%.0f rows/s)'%(ret['rows'], ret['path'], ret['seconds'], ret['rows_per_sec']))
+    if ret['catalog']:
+        print('Calibration updated in %s'%CATALOG_NAME)
+
+if __name__ == "__main__":
+    main()
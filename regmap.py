@@ -0,0 +1,257 @@
+import json, argparse
+
+import numpy as np
+
+# fc -> table, reads use the same fc, AO writes use 15 (coils) / 16 (holding registers)
+REGMAP_TABLES = {1: 'coils', 2: 'discrete_inputs', 3: 'holding_registers', 4: 'input_registers'}
+REGMAP_BIT_TABLES = (1, 2)
+# type -> (big-endian numpy dtype, words per value)
+REGMAP_TYPES = {
+    'int16': ('>i2', 1), 'uint16': ('>u2', 1),
+    'int32': ('>i4', 2), 'uint32': ('>u4', 2), 'float32': ('>f4', 2),
+    'float64': ('>f8', 4), 'bool': (None, 1),
+}
+REGMAP_WORD_ORDERS = ('big', 'little') # big: most significant word first (Modbus convention)
+REGMAP_MAX_READ_REGISTERS = 125
+REGMAP_MAX_READ_BITS = 2000
+REGMAP_MAX_WRITE_REGISTERS = 123
+REGMAP_MAX_WRITE_BITS = 1968
+REGMAP_TURNAROUND_MS = 2.0 # slave response delay assumed when pricing a round trip
+REGMAP_RTU_OVERHEAD_CHARS = 20 # request 8 + response header and CRC 5 + 2 x 3.5 char silence
+REGMAP_SERIAL_MODES = ('RTU', 'ASCII', 'RTU_OVER_TCP')
+
+class RegisterEntry():
+    # count consecutive values of one type mapped onto channels [channel, channel+count).
+    # The logger's raw values are int16 (AI) / uint16 (AO): int16 and uint16 registers
+    # without scaling are taken bit for bit, anything else is raw = value*scale + offset,
+    # rounded and saturated.
+    def __init__(self, config:dict, kind:str):
+        if kind not in ('ai', 'ao'):
+            raise ValueError('Invalid kind: %s'%kind)
+        self.kind = kind
+        self.channel = int(config[kind])
+        self.address = int(config['address'])
+        self.count = int(config.get('count', 1))
+        self.fc = int(config.get('fc', 4 if kind == 'ai' else 3))
+        self.type = config.get('type', 'bool' if self.fc in REGMAP_BIT_TABLES else 'int16' if kind == 'ai' else 'uint16')
+        self.word_order = config.get('word_order', 'big')
+        self.scale = float(config.get('scale', 1.0))
+        self.offset = float(config.get('offset', 0.0))
+        if self.fc not in REGMAP_TABLES or (kind == 'ao' and self.fc not in (1, 3)):
+            raise ValueError('Invalid function code for %s: %d'%(kind, self.fc))
+        if self.type not in REGMAP_TYPES:
+            raise ValueError('Invalid type: %s'%self.type)
+        if (self.type == 'bool') != (self.fc in REGMAP_BIT_TABLES):
+            raise ValueError('Type %s does not fit function code %d'%(self.type, self.fc))
+        if self.word_order not in REGMAP_WORD_ORDERS:
+            raise ValueError('Invalid word order: %s'%self.word_order)
+        if self.channel < 0 or self.address < 0 or self.count <= 0 or self.scale == 0.0:
+            raise ValueError('Invalid register entry: %s'%json.dumps(config))
+        self.width = REGMAP_TYPES[self.type][1]
+        self.span = self.count * self.width
+        self.end = self.address + self.span
+        self.identity = self.type in ('int16', 'uint16', 'bool') and self.scale == 1.0 and self.offset == 0.0
+
+    @property
+    def channels(self) -> range:
+        return range(self.channel, self.channel + self.count)
+
+    def word_index(self, offset:int) -> np.ndarray:
+        # [count, width] positions in the reply, most significant word first
+        _index = offset + np.arange(self.span).reshape(self.count, self.width)
+        return _index[:, ::-1] if self.word_order == 'little' else _index
+
+class _Group():
+    # entries of one request sharing type and scaling mode, decoded in one gather
+    def __init__(self, type:str, identity:bool):
+        self.type = type
+        self.identity = identity
+        self.index = []
+        self.positions = []
+        self.scale = []
+        self.offset = []
+
+    def freeze(self):
+        self.index = np.concatenate(self.index)
+        self.positions = np.concatenate(self.positions)
+        self.scale = np.concatenate(self.scale)
+        self.offset = np.concatenate(self.offset)
+
+def _group_entries(parts:list[tuple[RegisterEntry, int]]) -> tuple[np.ndarray, list[_Group]]:
+    _groups: dict[tuple, _Group] = {}
+    _channels = []
+    for entry, offset in parts:
+        _group = _groups.setdefault((entry.type, entry.identity), _Group(entry.type, entry.identity))
+        _group.index.append(entry.word_index(offset))
+        _group.positions.append(np.arange(len(_channels), len(_channels) + entry.count))
+        _group.scale.append(np.full(entry.count, entry.scale))
+        _group.offset.append(np.full(entry.count, entry.offset))
+        _channels.extend(entry.channels)
+    for _group in _groups.values():
+        _group.freeze()
+    return np.array(_channels, dtype=np.int64), list(_groups.values())
+
+class ReadRequest():
+    # One Modbus read covering one or more entries, possibly with unused registers
+    # in between. decode() turns the reply into int16 raw values for self.channels.
+    def __init__(self, fc:int, address:int, count:int, parts:list[tuple[RegisterEntry, int]]):
+        self.fc = fc
+        self.address = address
+        self.count = count
+        self.parts = parts
+        self.channels, self._groups = _group_entries(parts)
+
+    @property
+    def gap(self) -> int:
+        _used = np.zeros(self.count, dtype=bool)
+        for entry, offset in self.parts:
+            _used[offset:offset + entry.span] = True
+        return int(self.count - _used.sum())
+
+    def decode(self, data:list) -> np.ndarray:
+        ret = np.empty(len(self.channels), dtype=np.int16)
+        if self.fc in REGMAP_BIT_TABLES:
+            _words = np.asarray(data[:self.count], dtype=np.uint16)
+        else:
+            _words = np.asarray(data, dtype=np.uint16)
+        for _group in self._groups:
+            _gathered = _words[_group.index]
+            if _group.type == 'bool':
+                _values = _gathered.reshape(-1).astype(np.float64)
+            else:
+                _values = _gathered.astype('>u2').view(REGMAP_TYPES[_group.type][0]).reshape(-1)
+            if _group.identity:
+                ret[_group.positions] = _values.astype(np.int64).astype(np.uint16).view(np.int16)
+                continue
+            with np.errstate(invalid='ignore', over='ignore'):
+                _raw = np.rint(_values.astype(np.float64) * _group.scale + _group.offset)
+            ret[_group.positions] = np.clip(np.nan_to_num(_raw), -32768, 32767).astype(np.int16)
+        return ret
+
+class WriteRequest():
+    # One write of adjacent AO entries; gaps are never filled, they would overwrite
+    # registers that are not ours.
+    def __init__(self, fc:int, address:int, count:int, parts:list[tuple[RegisterEntry, int]]):
+        self.fc = fc
+        self.address = address
+        self.count = count
+        self.parts = parts
+
+    def encode(self, ao_raw) -> list:
+        _raw = np.asarray(ao_raw, dtype=np.uint16)
+        if self.fc in REGMAP_BIT_TABLES:
+            return [bool(v) for entry, _ in self.parts for v in (_raw[entry.channel:entry.channel + entry.count] != 0)]
+        _words = np.empty(self.count, dtype=np.uint16)
+        for entry, offset in self.parts:
+            _values = _raw[entry.channel:entry.channel + entry.count]
+            if entry.identity:
+                _encoded = _values
+            else:
+                _dtype = np.dtype(REGMAP_TYPES[entry.type][0])
+                _value = (_values.astype(np.float64) - entry.offset) / entry.scale
+                if _dtype.kind in 'iu':
+                    _info = np.iinfo(_dtype)
+                    _value = np.clip(np.rint(_value), _info.min, _info.max)
+                _encoded = _value.astype(_dtype).view('>u2').astype(np.uint16)
+            _words[entry.word_index(offset)] = _encoded.reshape(entry.count, entry.width)
+        return _words.tolist()
+
+def max_gap_registers(mode:str, baudrate:int, turnaround_ms:float=REGMAP_TURNAROUND_MS) -> int:
+    # registers worth reading for nothing instead of paying one more round trip
+    if mode not in REGMAP_SERIAL_MODES:
+        return REGMAP_MAX_READ_REGISTERS
+    _chars_per_s = baudrate / 10.0
+    _overhead = REGMAP_RTU_OVERHEAD_CHARS + turnaround_ms / 1000.0 * _chars_per_s
+    _chars_per_register = 4 if mode == 'ASCII' else 2
+    return int(_overhead * (2 if mode == 'ASCII' else 1) / _chars_per_register)
+
+def _coalesce(entries:list[RegisterEntry], limit:int, max_gap:int, cls):
+    # Greedy over entries sorted by address: extending the current request as far
+    # as the limit allows gives the fewest requests for a given gap threshold.
+    ret = []
+    _start = _end = 0
+    _parts: list[RegisterEntry] = []
+    for entry in sorted(entries, key=lambda e: (e.address, e.end)):
+        if entry.span > limit:
+            raise ValueError('Register entry too long: %d at %d'%(entry.span, entry.address))
+        if _parts and entry.address - _end <= max_gap and max(_end, entry.end) - _start <= limit:
+            _parts.append(entry)
+            _end = max(_end, entry.end)
+            continue
+        if _parts:
+            ret.append(cls(_parts[0].fc, _start, _end - _start, [(e, e.address - _start) for e in _parts]))
+        _start, _end, _parts = entry.address, entry.end, [entry]
+    if _parts:
+        ret.append(cls(_parts[0].fc, _start, _end - _start, [(e, e.address - _start) for e in _parts]))
+    return ret
+
+def plan_reads(entries:list[RegisterEntry], max_gap:int) -> list[ReadRequest]:
+    ret = []
+    for fc in REGMAP_TABLES:
+        _entries = [e for e in entries if e.kind == 'ai' and e.fc == fc]
+        _bits = fc in REGMAP_BIT_TABLES
+        # a register of gap costs as much wire time as 16 bits
+        ret += _coalesce(_entries, REGMAP_MAX_READ_BITS if _bits else REGMAP_MAX_READ_REGISTERS, max_gap * 16 if _bits else max_gap, ReadRequest)
+    return ret
+
+def plan_writes(entries:list[RegisterEntry]) -> list[WriteRequest]:
+    ret = []
+    for fc in (1, 3):
+        _entries = sorted([e for e in entries if e.kind == 'ao' and e.fc == fc], key=lambda e: e.address)
+        for _prev, _next in zip(_entries, _entries[1:]):
+            if _next.address < _prev.end:
+                raise ValueError('AO registers overlap at %d'%_next.address)
+        ret += _coalesce(_entries, REGMAP_MAX_WRITE_BITS if fc == 1 else REGMAP_MAX_WRITE_REGISTERS, 0, WriteRequest)
+    return ret
+
+def device_entries(config:dict) -> list[RegisterEntry]:
+    # legacy "ai"/"ao" [channel, count] with "ai_address"/"ao_address", plus "registers"
+    ret = []
+    _ai_channel, _ai_count = [int(v) for v in config.get('ai', [0, 0])]
+    if _ai_count > 0:
+        ret.append(RegisterEntry({'ai': _ai_channel, 'address': config.get('ai_address', 0), 'count': _ai_count, 'fc': 4, 'type': 'int16'}, 'ai'))
+    _ao_channel, _ao_count = [int(v) for v in config.get('ao', [0, 0])]
+    if _ao_count > 0:
+        ret.append(RegisterEntry({'ao': _ao_channel, 'address': config.get('ao_address', 0), 'count': _ao_count, 'fc': 3, 'type': 'uint16'}, 'ao'))
+    for _entry in config.get('registers', []):
+        _kinds = [k for k in ('ai', 'ao') if k in _entry]
+        if len(_kinds) != 1:
+            raise ValueError('Register entry needs one of "ai" or "ao": %s'%json.dumps(_entry))
+        ret.append(RegisterEntry(_entry, _kinds[0]))
+    return ret
+
+def request_seconds(requests:list[ReadRequest], mode:str, baudrate:int, turnaround_ms:float=REGMAP_TURNAROUND_MS) -> float:
+    # estimated wire time of one poll on a serial line
+    _chars_per_s = baudrate / 10.0
+    _factor = 2 if mode == 'ASCII' else 1
+    _chars = 0.0
+    for request in requests:
+        _payload = (request.count + 7) // 8 if request.fc in REGMAP_BIT_TABLES else request.count * 2
+        _chars += (REGMAP_RTU_OVERHEAD_CHARS + _payload) * _factor
+    return _chars / _chars_per_s + len(requests) * turnaround_ms / 1000.0
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the Modbus requests planned for the devices of a config.json')
+    parser.add_argument('config', help='config.json path')
+    parser.add_argument('--max-gap', type=int, default=None, help='override the gap threshold in registers')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        _devices = json.load(f).get('devices', [])
+    for i, _dev in enumerate(_devices):
+        _mode = _dev.get('mode', 'RTU').upper()
+        _baudrate = int(_dev.get('baudrate', 38400))
+        _entries = device_entries(_dev)
+        _max_gap = args.max_gap if args.max_gap is not None else int(_dev.get('max_gap', max_gap_registers(_mode, _baudrate)))
+        _reads = plan_reads(_entries, _max_gap)
+        _unmerged = plan_reads(_entries, -REGMAP_MAX_READ_BITS)
+        print('%s: %d entries, %d read requests (%d without merging), max gap %d'%(_dev.get('name', 'dev%d'%i), len(_entries), len(_reads), len(_unmerged), _max_gap))
+        for r in _reads:
+            print('  fc %d  %5d +%-4d  ch %s  gap %d'%(r.fc, r.address, r.count, ','.join(str(c) for c in r.channels), r.gap))
+        for r in plan_writes(_entries):
+            print('  write fc %d  %5d +%-4d'%(15 if r.fc == 1 else 16, r.address, r.count))
+        if _mode in REGMAP_SERIAL_MODES:
+            print('  about %.1f ms per poll at %d baud (%.1f ms without merging)'%(request_seconds(_reads, _mode, _baudrate)*1000.0, _baudrate, request_seconds(_unmerged, _mode, _baudrate)*1000.0))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import threading
+
+import numpy as np
+
+def frame_dtype(num_ai:int, num_ao:int, num_param:int) -> np.dtype:
+    return np.dtype([
+        ('seq', np.int64),
+        ('time_ns', np.int64),
+        ('mono_ns', np.int64),
+        ('ai_raw', np.int16, (num_ai,)),
+        ('ai_phy', np.float32, (num_ai,)),
+        ('ao_raw', np.uint16, (num_ao,)),
+        ('ao_phy', np.float32, (num_ao,)),
+        ('param', np.float32, (num_param,)),
+        ('stale', np.int64),
+    ])
+
+# session column prefix of each array field, see storage.AioDataTable
+FRAME_COLUMN_PREFIXES = (('ai_raw_', 'ai_raw'), ('ai_phy_', 'ai_phy'), ('ao_raw_', 'ao_raw'), ('ao_phy_', 'ao_phy'), ('param_phy_', 'param'))
+
+def frame_column(frames:np.ndarray, name:str) -> np.ndarray:
+    # a session column (seq, mono_ns, ai_phy_3, param_phy_0, ...) of frame_dtype rows
+    if name in ('seq', 'mono_ns'):
+        return frames[name]
+    for _prefix, _field in FRAME_COLUMN_PREFIXES:
+        if name.startswith(_prefix) and name[len(_prefix):].isdigit() and int(name[len(_prefix):]) < frames.dtype[_field].shape[0]:
+            return frames[_field][:, int(name[len(_prefix):])]
+    raise ValueError('Invalid column: %s'%name)
+
+class FrameRingBuffer():
+    # Fixed capacity history of acquisition frames. There is a single writer (the
+    # acquisition loop); readers get views into the preallocated array, which stay
+    # valid until the writer wraps around onto them.
+    def __init__(self, capacity:int, num_ai:int, num_ao:int, num_param:int):
+        if capacity <= 0:
+            raise ValueError('Invalid capacity')
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self._buf = np.zeros(capacity, dtype=frame_dtype(num_ai, num_ao, num_param))
+        self._head = 0
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._buf.dtype
+
+    def __len__(self) -> int:
+        with self._lock:
+            return min(self._head, self._capacity)
+
+    def append(self, frame):
+        _index = self._head % self._capacity
+        self._buf[_index] = (frame.seq, frame.time_ns, frame.mono_ns, frame.ai_raw, frame.ai_phy, frame.ao_raw, frame.ao_phy, frame.param, frame.stale)
+        with self._lock:
+            self._head += 1
+
+    def clear(self):
+        with self._lock:
+            self._head = 0
+
+    def _segments(self) -> list[np.ndarray]:
+        # oldest to newest, at most two views
+        with self._lock:
+            _head = self._head
+        if _head <= self._capacity:
+            return [self._buf[:_head]] if _head else []
+        _split = _head % self._capacity
+        if _split == 0:
+            return [self._buf]
+        return [self._buf[_split:], self._buf[:_split]]
+
+    def _window(self, field:str, start:int|None, stop:int|None) -> list[np.ndarray]:
+        ret = []
+        for _seg in self._segments():
+            _keys = _seg[field]
+            _lo = 0 if start is None else int(np.searchsorted(_keys, start, side='left'))
+            _hi = len(_seg) if stop is None else int(np.searchsorted(_keys, stop, side='left'))
+            if _hi > _lo:
+                ret.append(_seg[_lo:_hi])
+        return ret
+
+    def window_by_seq(self, start:int|None=None, stop:int|None=None) -> list[np.ndarray]:
+        return self._window('seq', start, stop)
+
+    def window_by_time(self, start_ns:int|None=None, stop_ns:int|None=None) -> list[np.ndarray]:
+        return self._window('time_ns', start_ns, stop_ns)
+
+    def _copy(self, field:str, start:int|None, stop:int|None) -> np.ndarray:
+        # Owned rows for readers that outlive the next append (a web request). The
+        # writer may overwrite the oldest rows while they are copied; those come
+        # out newer than the rows after them and are dropped with everything before.
+        _views = self._window(field, start, stop)
+        _rows = np.concatenate(_views) if _views else np.empty(0, dtype=self._buf.dtype)
+        _seq = _rows['seq']
+        _back = np.flatnonzero(_seq[1:] <= _seq[:-1])
+        if len(_back):
+            _rows = _rows[_back[-1] + 1:]
+        _keys = _rows[field]
+        _keep = np.ones(len(_rows), dtype=bool)
+        if start is not None:
+            _keep &= _keys >= start
+        if stop is not None:
+            _keep &= _keys < stop
+        return _rows[_keep]
+
+    def copy_window_by_seq(self, start:int|None=None, stop:int|None=None) -> np.ndarray:
+        return self._copy('seq', start, stop)
+
+    def copy_window_by_time(self, start_ns:int|None=None, stop_ns:int|None=None) -> np.ndarray:
+        return self._copy('time_ns', start_ns, stop_ns)
+
+    def latest(self, count:int) -> list[np.ndarray]:
+        ret = []
+        for _seg in reversed(self._segments()):
+            if count <= 0:
+                break
+            ret.insert(0, _seg[-count:])
+            count -= len(ret[0])
+        return ret
+
+    def oldest_seq(self) -> int|None:
+        _segs = self._segments()
+        return int(_segs[0]['seq'][0]) if _segs else None
+
+    def concat(self, views:list[np.ndarray]) -> np.ndarray:
+        if len(views) == 1:
+            return views[0]
+        return np.concatenate(views) if views else np.empty(0, dtype=self._buf.dtype)
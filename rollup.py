@@ -0,0 +1,304 @@
+import time, sqlite3, argparse
+
+import numpy as np
+
+from storage import SqlWriter, AioDataTable, create_sqlite_engine, SQL_FRAME_COLUMNS
+
+ROLLUP_LEVELS = (1, 60, 3600) # bucket seconds, finest first
+ROLLUP_STATS = ('min', 'max', 'mean', 'last')
+ROLLUP_REBUILD_ROWS = 100000
+
+def rollup_table(seconds:int) -> str:
+    return 'rollup_%ds'%seconds
+
+def rollup_columns() -> list[str]:
+    return [c.name for c in AioDataTable.__table__.columns if c.name not in SQL_FRAME_COLUMNS]
+
+def time_keys(time_ns:np.ndarray) -> np.ndarray:
+    # wall clock seconds as the local naive time reads, the same clock as data.time
+    _sec = np.asarray(time_ns, dtype=np.int64) // 1000000000
+    if len(_sec) == 0:
+        return _sec
+    _first, _last = time.localtime(int(_sec[0])).tm_gmtoff, time.localtime(int(_sec[-1])).tm_gmtoff
+    if _first == _last:
+        return _sec + _first
+    return _sec + np.array([time.localtime(int(s)).tm_gmtoff for s in _sec.tolist()], dtype=np.int64)
+
+def parse_time_keys(times:list[str]) -> np.ndarray:
+    # data.time strings to the same keys as time_keys()
+    return np.array(times, dtype='datetime64[us]').astype('datetime64[s]').astype(np.int64)
+
+def format_time_keys(keys:np.ndarray) -> list[str]:
+    return [t.replace('T', ' ') for t in np.datetime_as_string(np.asarray(keys, dtype='datetime64[s]').astype('datetime64[us]'), unit='us').tolist()]
+
+class _Agg():
+    # bucket aggregates as arrays: key, count, first_id, last_id [rows] and sum,
+    # min, max, last [rows, channels]; raw rows are buckets of count 1
+    def __init__(self, **arrays):
+        self._arrays = arrays
+
+    @staticmethod
+    def from_rows(keys:np.ndarray, ids:np.ndarray, values:np.ndarray) -> '_Agg':
+        _ids = np.asarray(ids, dtype=np.int64)
+        return _Agg(key=np.asarray(keys, dtype=np.int64), count=np.ones(len(_ids), dtype=np.int64), first_id=_ids, last_id=_ids, sum=values, min=values, max=values, last=values)
+
+    def __len__(self) -> int:
+        return len(self._arrays['key'])
+
+    def __getitem__(self, name:str) -> np.ndarray:
+        return self._arrays[name]
+
+    def concat(self, other:'_Agg|None') -> '_Agg':
+        # other goes first
+        if other is None:
+            return self
+        return _Agg(**{k: np.concatenate([other[k], v]) for k, v in self._arrays.items()})
+
+    def group(self, seconds:int) -> '_Agg':
+        _key = self['key'] // seconds * seconds
+        _starts = np.flatnonzero(np.r_[True, _key[1:] != _key[:-1]])
+        _ends = np.r_[_starts[1:], len(_key)] - 1
+        with np.errstate(invalid='ignore'):
+            return _Agg(
+                key=_key[_starts],
+                count=np.add.reduceat(self['count'], _starts),
+                first_id=self['first_id'][_starts],
+                last_id=self['last_id'][_ends],
+                sum=np.add.reduceat(self['sum'], _starts, axis=0),
+                min=np.fmin.reduceat(self['min'], _starts, axis=0),
+                max=np.fmax.reduceat(self['max'], _starts, axis=0),
+                last=self['last'][_ends],
+            )
+
+    def slice(self, start:int, stop:int|None=None) -> '_Agg':
+        return _Agg(**{k: v[start:stop] for k, v in self._arrays.items()})
+
+    def rows(self, time_strs:list[str]) -> list[tuple]:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            _mean = self['sum'] / self['count'][:, None]
+        _stats = np.stack([self['min'], self['max'], _mean, self['last']], axis=2).reshape(len(self), -1)
+        return [(k, t, c, f, l, *s) for k, t, c, f, l, s in zip(self['key'].tolist(), time_strs, self['count'].tolist(), self['first_id'].tolist(), self['last_id'].tolist(), _stats.tolist())]
+
+class RollupBuilder():
+    # Each level keeps only its open bucket. Rows go into the finest level, and a
+    # level's buckets are folded into the next one up as they close, so nothing
+    # is ever recomputed from raw rows.
+    def __init__(self, levels:tuple=ROLLUP_LEVELS):
+        if list(levels) != sorted(levels) or levels[0] <= 0 or any(b % a for a, b in zip(levels, levels[1:])):
+            raise ValueError('Invalid levels')
+        self._levels = tuple(levels)
+        self._open: list[_Agg|None] = [None] * len(levels)
+
+    @property
+    def levels(self) -> tuple:
+        return self._levels
+
+    def state(self) -> list:
+        return list(self._open)
+
+    def restore(self, state:list):
+        self._open = list(state)
+
+    def add(self, rows:_Agg) -> dict[int, _Agg]:
+        # returns {seconds: buckets to upsert}, closed ones plus the still open ones as they stand
+        ret = {}
+        # a wall clock step backwards must not reopen (and overwrite) a written bucket
+        _floor = rows['key'][:1] if self._open[0] is None else self._open[0]['key']
+        _closed = _Agg(**{**rows._arrays, 'key': np.maximum.accumulate(np.r_[_floor, rows['key']])[1:]})
+        _snapshot = None
+        for i, _seconds in enumerate(self._levels):
+            if len(_closed):
+                _grouped = _closed.concat(self._open[i]).group(_seconds)
+                self._open[i] = _grouped.slice(len(_grouped) - 1)
+                _closed = _grouped.slice(0, len(_grouped) - 1)
+            _current = self._open[i] if _snapshot is None else _snapshot.concat(self._open[i]).group(_seconds)
+            _out = _closed if len(_closed) else None
+            if _current is not None:
+                _out = _current if _out is None else _current.concat(_out)
+            if _out is not None:
+                ret[_seconds] = _out
+            _snapshot = _current
+        return ret
+
+def create_rollup_tables(conn, levels:tuple=ROLLUP_LEVELS):
+    _stats = ''.join(', %s_%s REAL'%(c, s) for c in rollup_columns() for s in ROLLUP_STATS)
+    for _seconds in levels:
+        conn.execute('CREATE TABLE IF NOT EXISTS %s (bucket INTEGER PRIMARY KEY, time TEXT, count INTEGER, first_id INTEGER, last_id INTEGER%s)'%(rollup_table(_seconds), _stats))
+
+def _upsert_sql(seconds:int) -> str:
+    _columns = ['bucket', 'time', 'count', 'first_id', 'last_id'] + ['%s_%s'%(c, s) for c in rollup_columns() for s in ROLLUP_STATS]
+    return 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)'%(rollup_table(seconds), ', '.join(_columns), ', '.join(['?']*len(_columns)))
+
+def _write_rollups(conn, buckets:dict[int, _Agg]):
+    for _seconds, _agg in buckets.items():
+        conn.executemany(_upsert_sql(_seconds), _agg.rows(format_time_keys(_agg['key'])))
+
+class RollupWriter(SqlWriter):
+    # SqlWriter that keeps the rollup tables up to date in the same transaction
+    # as the raw rows. Ids are assigned here, the writer is the only one appending.
+    def __init__(self, db_path:str, levels:tuple=ROLLUP_LEVELS, **kwargs):
+        super().__init__(db_path, **kwargs)
+        self._builder = RollupBuilder(levels)
+        self._next_id = 1
+
+    def _open(self):
+        super()._open()
+        # every segment file has its own rollups
+        self._builder = RollupBuilder(self._builder.levels)
+        with self._engine.begin() as conn:
+            create_rollup_tables(conn.connection.driver_connection, self._builder.levels)
+            self._next_id = (conn.exec_driver_sql('SELECT MAX(id) FROM data').fetchone()[0] or 0) + 1
+
+    def _write(self, batch:list):
+        _ids = np.arange(self._next_id, self._next_id + len(batch), dtype=np.int64)
+        _values = np.array([np.concatenate([f.ai_raw, f.ai_phy, f.ao_raw, f.ao_phy, f.param]) for f in batch], dtype=np.float64)
+        _state = self._builder.state()
+        try:
+            _buckets = self._builder.add(_Agg.from_rows(time_keys([f.time_ns for f in batch]), _ids, _values))
+            with self._engine.begin() as conn:
+                conn.exec_driver_sql(self._insert_sql, [self._flatten(frame) for frame in batch])
+                _write_rollups(conn.connection.driver_connection, _buckets)
+        except Exception:
+            self._builder.restore(_state)
+            raise
+        self._next_id += len(batch)
+
+def rebuild_rollups(db_path:str, levels:tuple=ROLLUP_LEVELS, chunk_rows:int=ROLLUP_REBUILD_ROWS, progress=None) -> int:
+    # regenerate the rollup tables of an existing session from its data table
+    if chunk_rows <= 0:
+        raise ValueError('Invalid chunk rows')
+    _builder = RollupBuilder(levels)
+    _columns = rollup_columns()
+    _sql = 'SELECT id, time, %s FROM data WHERE id > ? ORDER BY id LIMIT ?'%', '.join(_columns)
+    _engine = create_sqlite_engine(db_path)
+    _rows = 0
+    try:
+        with _engine.begin() as conn:
+            _conn = conn.connection.driver_connection
+            # sessions recorded before the time index existed, readers do not create it
+            _conn.execute('CREATE INDEX IF NOT EXISTS ix_data_time ON data (time)')
+            for _seconds in ROLLUP_LEVELS + tuple(levels):
+                _conn.execute('DROP TABLE IF EXISTS %s'%rollup_table(_seconds))
+            create_rollup_tables(_conn, levels)
+        _last = 0
+        while True:
+            with _engine.begin() as conn:
+                _conn = conn.connection.driver_connection
+                _chunk = _conn.execute(_sql, (_last, chunk_rows)).fetchall()
+                if not _chunk:
+                    break
+                _ids, _times, *_values = zip(*_chunk)
+                _values = np.array(_values, dtype=np.float64).T
+                _write_rollups(_conn, _builder.add(_Agg.from_rows(parse_time_keys(_times), np.array(_ids, dtype=np.int64), _values)))
+            _last = _ids[-1]
+            _rows += len(_chunk)
+            if progress:
+                progress(_rows)
+    finally:
+        _engine.dispose()
+    return _rows
+
+class RollupReader():
+    # Read side: picks the coarsest level that is still fine enough and returns
+    # its buckets as arrays. Only closed and currently open buckets exist, so a
+    # session being recorded is covered up to its last flush.
+    def __init__(self, db_path:str):
+        self._conn = sqlite3.connect('file:%s?mode=ro'%db_path, uri=True)
+        _tables = {r[0] for r in self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+        self._levels = tuple(s for s in ROLLUP_LEVELS if rollup_table(s) in _tables)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    @property
+    def levels(self) -> tuple:
+        return self._levels
+
+    def level_for(self, resolution:float) -> int|None:
+        # coarsest level no wider than the resolution (seconds per point)
+        _fit = [s for s in self._levels if s <= resolution]
+        return _fit[-1] if _fit else None
+
+    def key_range(self) -> tuple[int, int]|None:
+        if not self._levels:
+            return None
+        _row = self._conn.execute('SELECT MIN(bucket), MAX(bucket) FROM %s'%rollup_table(self._levels[0])).fetchone()
+        return None if _row[0] is None else (_row[0], _row[1] + self._levels[0])
+
+    def read(self, seconds:int, columns:list[str], start_key:int|None=None, end_key:int|None=None, stats:tuple=ROLLUP_STATS) -> dict:
+        # buckets overlapping [start_key, end_key)
+        if seconds not in self._levels:
+            raise ValueError('Invalid level: %d'%seconds)
+        for c in columns:
+            if c not in rollup_columns():
+                raise ValueError('Invalid column: %s'%c)
+        for s in stats:
+            if s not in ROLLUP_STATS:
+                raise ValueError('Invalid stat: %s'%s)
+        _lo = -(1 << 62) if start_key is None else start_key // seconds * seconds
+        _hi = (1 << 62) if end_key is None else end_key
+        _select = ''.join(', %s_%s'%(c, s) for s in stats for c in columns)
+        _rows = self._conn.execute('SELECT bucket, time, count, first_id, last_id%s FROM %s WHERE bucket >= ? AND bucket < ? ORDER BY bucket'%(_select, rollup_table(seconds)), (_lo, _hi)).fetchall()
+        _keys, _times, _counts, _first, _last, *_values = zip(*_rows) if _rows else ([], [], [], [], [])
+        ret = {
+            'bucket': np.array(_keys, dtype=np.int64),
+            'time': list(_times),
+            'count': np.array(_counts, dtype=np.int64),
+            'first_id': np.array(_first, dtype=np.int64),
+            'last_id': np.array(_last, dtype=np.int64),
+        }
+        _values = np.array(_values, dtype=np.float64).T.reshape(len(_rows), len(stats), len(columns)) if _rows else np.empty((0, len(stats), len(columns)))
+        for i, s in enumerate(stats):
+            ret[s] = _values[:, i]
+        return ret
+
+def merge_reads(parts:list[dict]) -> dict:
+    # RollupReader.read() results of consecutive segments with their ids already
+    # offset; the bucket cut by a segment change is in both, join it again
+    _parts = [p for p in parts if len(p['bucket'])]
+    if len(_parts) <= 1:
+        return _parts[0] if _parts else parts[0]
+    ret = {k: (sum((p[k] for p in _parts), []) if k == 'time' else np.concatenate([p[k] for p in _parts])) for k in _parts[0]}
+    _dup = np.flatnonzero(ret['bucket'][1:] == ret['bucket'][:-1])
+    if not len(_dup):
+        return ret
+    # _dup: first half of each joined pair, _dup + 1 is dropped
+    _a, _b = _dup, _dup + 1
+    _ca, _cb = ret['count'][_a][:, None], ret['count'][_b][:, None]
+    with np.errstate(invalid='ignore'):
+        if 'min' in ret:
+            ret['min'][_a] = np.fmin(ret['min'][_a], ret['min'][_b])
+        if 'max' in ret:
+            ret['max'][_a] = np.fmax(ret['max'][_a], ret['max'][_b])
+        if 'mean' in ret:
+            ret['mean'][_a] = (ret['mean'][_a] * _ca + ret['mean'][_b] * _cb) / (_ca + _cb)
+    if 'last' in ret:
+        ret['last'][_a] = ret['last'][_b]
+    ret['count'][_a] += ret['count'][_b]
+    ret['last_id'][_a] = ret['last_id'][_b]
+    _keep = np.ones(len(ret['bucket']), dtype=bool)
+    _keep[_b] = False
+    return {k: ([t for t, keep in zip(v, _keep.tolist()) if keep] if k == 'time' else v[_keep]) for k, v in ret.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the rollup tables (1 s / 1 min / 1 h aggregates) of a recorded session')
+    parser.add_argument('session', help='session .sqlite3 file')
+    parser.add_argument('--chunk-rows', type=int, default=ROLLUP_REBUILD_ROWS)
+    args = parser.parse_args()
+
+    _started = time.perf_counter()
+    def _progress(rows):
+        _elapsed = time.perf_counter() - _started
+        print('\r%d rows, %.0f rows/s'%(rows, rows/_elapsed if _elapsed > 0 else 0.0), end='', flush=True)
+    _rows = rebuild_rollups(args.session, chunk_rows=args.chunk_rows, progress=_progress)
+    print()
+    print('Rebuilt rollups of %d rows in %.2f s'%(_rows, time.perf_counter() - _started))
+
+if __name__ == "__main__":
+    main()
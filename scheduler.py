@@ -0,0 +1,140 @@
+import time, queue, threading
+from collections import deque
+
+class TickJob():
+    def __init__(self, name:str, interval_ms:float, callback):
+        self.name = name
+        self.interval = interval_ms/1000.0
+        self.callback = callback
+        self.enabled = False
+        self.deadline = 0.0
+        self.ticks = 0
+        self.missed = 0
+        self.overruns = 0
+        self.jitter_max = 0.0
+        self.jitter_sum = 0.0
+
+    def stats(self) -> dict:
+        return {
+            'interval_ms': self.interval*1000.0,
+            'enabled': self.enabled,
+            'ticks': self.ticks,
+            'missed': self.missed,
+            'overruns': self.overruns,
+            'jitter_mean_us': (self.jitter_sum/self.ticks*1E6) if self.ticks else 0.0,
+            'jitter_max_us': self.jitter_max*1E6,
+        }
+
+class TickScheduler():
+    # Periodic jobs on absolute perf_counter deadlines. The owner thread waits for
+    # timeout() and then calls run_due(); no thread is created per tick. A job that
+    # overruns skips the ticks it missed instead of running them back to back.
+    def __init__(self):
+        self._jobs: dict[str, TickJob] = {}
+
+    def add_job(self, name:str, interval_ms:float, callback):
+        if interval_ms <= 0:
+            raise ValueError('Invalid interval')
+        self._jobs[name] = TickJob(name, interval_ms, callback)
+
+    def start_job(self, name:str, delay_ms:float=0.0):
+        _job = self._jobs[name]
+        if _job.enabled:
+            return
+        _job.enabled = True
+        _job.deadline = time.perf_counter() + delay_ms/1000.0
+
+    def stop_job(self, name:str):
+        self._jobs[name].enabled = False
+
+    def is_running(self, name:str) -> bool:
+        return self._jobs[name].enabled
+
+    def set_interval(self, name:str, interval_ms:float):
+        if interval_ms <= 0:
+            raise ValueError('Invalid interval')
+        _job = self._jobs[name]
+        _job.interval = interval_ms/1000.0
+        if _job.enabled:
+            _job.deadline = min(_job.deadline, time.perf_counter() + _job.interval)
+
+    def timeout(self) -> float|None:
+        _deadlines = [j.deadline for j in self._jobs.values() if j.enabled]
+        if not _deadlines:
+            return None
+        return max(0.0, min(_deadlines) - time.perf_counter())
+
+    def run_due(self):
+        for _job in sorted(self._jobs.values(), key=lambda j: j.deadline):
+            if not _job.enabled:
+                continue
+            _now = time.perf_counter()
+            if _now < _job.deadline:
+                break
+            _late = _now - _job.deadline
+            _job.ticks += 1
+            _job.jitter_sum += _late
+            _job.jitter_max = max(_job.jitter_max, _late)
+            try:
+                _job.callback()
+            except Exception as e:
+                print('Background: Job %s failed'%_job.name)
+                print(e)
+            _now = time.perf_counter()
+            _skip = int((_now - _job.deadline) // _job.interval)
+            if _skip > 0:
+                _job.overruns += 1
+                _job.missed += _skip
+            _job.deadline += (_skip + 1) * _job.interval
+
+    def stats(self) -> dict:
+        return {name: job.stats() for name, job in self._jobs.items()}
+
+class CommandQueue():
+    # Command intake of a worker thread, a drop-in for queue.Queue. Lower priority
+    # values are served first, FIFO within a priority. A collapsible command that
+    # is already waiting is not queued again: it only syncs state that is read
+    # when it runs, so one run covers every request made meanwhile.
+    def __init__(self, priorities:dict|None=None, collapsible=(), default_priority:int=1):
+        self._priorities = dict(priorities or {})
+        self._collapsible = set(collapsible)
+        self._default = default_priority
+        self._levels: dict[int, deque] = {}
+        self._pending: dict = {}
+        self._cond = threading.Condition()
+        self.collapsed = 0
+        self.wait_latency = None # LatencyHistogram of put -> get, see metrics.py
+
+    def qsize(self) -> int:
+        with self._cond:
+            return sum(len(q) for q in self._levels.values())
+
+    def put(self, cmd):
+        with self._cond:
+            if cmd in self._collapsible and self._pending.get(cmd):
+                self.collapsed += 1
+                return
+            _priority = self._priorities.get(cmd, self._default)
+            self._levels.setdefault(_priority, deque()).append((cmd, time.perf_counter()))
+            self._pending[cmd] = self._pending.get(cmd, 0) + 1
+            self._cond.notify()
+
+    def _pop(self):
+        for _priority in sorted(self._levels):
+            _level = self._levels[_priority]
+            if _level:
+                cmd, _queued = _level.popleft()
+                self._pending[cmd] -= 1
+                if self.wait_latency is not None:
+                    self.wait_latency.observe(time.perf_counter() - _queued)
+                return cmd
+        raise queue.Empty
+
+    def get(self, block:bool=True, timeout:float|None=None):
+        with self._cond:
+            if block and not self._cond.wait_for(lambda: any(self._levels.values()), timeout):
+                raise queue.Empty
+            return self._pop()
+
+    def get_nowait(self):
+        return self.get(False)
@@ -0,0 +1,588 @@
+import os, json, time, queue, sqlite3, datetime, threading
+from typing import NamedTuple
+
+import numpy as np
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.schema import Column
+from sqlalchemy.types import DateTime, Integer, Float
+
+SQL_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+SQL_SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+SQL_FRAME_COLUMNS = ('id', 'time', 'seq', 'mono_ns') # per row bookkeeping, not channels
+FRAME_DECIMATE_METHODS = ('every', 'mean')
+
+Base = declarative_base()
+
+class AioDataTable(Base): # type: ignore
+    __tablename__ = 'data'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    time = Column(DateTime, index=True) # ix_data_time, created with the table by the writer
+    seq = Column(Integer) # acquisition frame number within the session
+    mono_ns = Column(Integer) # perf_counter_ns() of the read
+    ai_raw_0 = Column(Integer)
+    ai_raw_1 = Column(Integer)
+    ai_raw_2 = Column(Integer)
+    ai_raw_3 = Column(Integer)
+    ai_raw_4 = Column(Integer)
+    ai_raw_5 = Column(Integer)
+    ai_raw_6 = Column(Integer)
+    ai_raw_7 = Column(Integer)
+    ai_raw_8 = Column(Integer)
+    ai_raw_9 = Column(Integer)
+    ai_raw_10 = Column(Integer)
+    ai_raw_11 = Column(Integer)
+    ai_raw_12 = Column(Integer)
+    ai_raw_13 = Column(Integer)
+    ai_raw_14 = Column(Integer)
+    ai_raw_15 = Column(Integer)
+    ai_phy_0 = Column(Float)
+    ai_phy_1 = Column(Float)
+    ai_phy_2 = Column(Float)
+    ai_phy_3 = Column(Float)
+    ai_phy_4 = Column(Float)
+    ai_phy_5 = Column(Float)
+    ai_phy_6 = Column(Float)
+    ai_phy_7 = Column(Float)
+    ai_phy_8 = Column(Float)
+    ai_phy_9 = Column(Float)
+    ai_phy_10 = Column(Float)
+    ai_phy_11 = Column(Float)
+    ai_phy_12 = Column(Float)
+    ai_phy_13 = Column(Float)
+    ai_phy_14 = Column(Float)
+    ai_phy_15 = Column(Float)
+    ao_raw_0 = Column(Integer)
+    ao_raw_1 = Column(Integer)
+    ao_raw_2 = Column(Integer)
+    ao_raw_3 = Column(Integer)
+    ao_raw_4 = Column(Integer)
+    ao_raw_5 = Column(Integer)
+    ao_raw_6 = Column(Integer)
+    ao_raw_7 = Column(Integer)
+    ao_phy_0 = Column(Float)
+    ao_phy_1 = Column(Float)
+    ao_phy_2 = Column(Float)
+    ao_phy_3 = Column(Float)
+    ao_phy_4 = Column(Float)
+    ao_phy_5 = Column(Float)
+    ao_phy_6 = Column(Float)
+    ao_phy_7 = Column(Float)
+    param_phy_0 = Column(Float)
+    param_phy_1 = Column(Float)
+    param_phy_2 = Column(Float)
+    param_phy_3 = Column(Float)
+    param_phy_4 = Column(Float)
+    param_phy_5 = Column(Float)
+    param_phy_6 = Column(Float)
+    param_phy_7 = Column(Float)
+    param_phy_8 = Column(Float)
+    param_phy_9 = Column(Float)
+    param_phy_10 = Column(Float)
+    param_phy_11 = Column(Float)
+    param_phy_12 = Column(Float)
+    param_phy_13 = Column(Float)
+    param_phy_14 = Column(Float)
+    param_phy_15 = Column(Float)
+
+class GapTable(Base): # type: ignore
+    # one row per run of consecutive acquisition frames that failed to read
+    __tablename__ = 'gaps'
+    seq = Column(Integer, primary_key=True) # first missing frame
+    frames = Column(Integer)
+    time = Column(DateTime)
+    end_time = Column(DateTime)
+    mono_ns = Column(Integer)
+
+class FrameGap(NamedTuple):
+    seq: int
+    frames: int
+    time_ns: int
+    mono_ns: int
+    end_time_ns: int
+
+    def merge(self, other:'FrameGap') -> 'FrameGap|None':
+        # one gap when other starts right after this one
+        if other.seq != self.seq + self.frames:
+            return None
+        return self._replace(frames=self.frames + other.frames, end_time_ns=other.end_time_ns)
+
+def create_sqlite_engine(db_path:str, synchronous:str='NORMAL'):
+    synchronous = synchronous.upper()
+    if synchronous not in SQL_SYNCHRONOUS_LEVELS:
+        raise ValueError('Invalid synchronous level')
+    engine = create_engine('sqlite:///'+db_path)
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=%s'%synchronous)
+        cursor.close()
+
+    return engine
+
+def segment_path(path:str, segment:int) -> str:
+    # 20240101120000.sqlite3, 20240101120000.001.sqlite3, ...
+    if segment == 0:
+        return path
+    _root, _ext = os.path.splitext(path)
+    return '%s.%03d%s'%(_root, segment, _ext)
+
+def copy_session(src_path:str, dst_path:str):
+    # page level copy, keeps the WAL contents of a session still being written
+    if os.path.exists(dst_path):
+        raise FileExistsError(dst_path)
+    with sqlite3.connect(src_path) as _src, sqlite3.connect(dst_path) as _dst:
+        _src.backup(_dst)
+
+def _mean_frame(frames:list):
+    # block average of frames, integer fields rounded, stale bits or-ed
+    _first = frames[0]
+    _values = {}
+    for name in _first._fields:
+        _value = getattr(_first, name)
+        if name == 'seq':
+            continue
+        if name == 'stale':
+            _values[name] = np.bitwise_or.reduce([f.stale for f in frames])
+        elif isinstance(_value, np.ndarray):
+            _mean = np.mean([getattr(f, name) for f in frames], axis=0)
+            _values[name] = (np.rint(_mean) if _value.dtype.kind in 'iu' else _mean).astype(_value.dtype)
+        else:
+            _values[name] = sum(getattr(f, name) for f in frames) // len(frames)
+    return _first._replace(**_values)
+
+class FrameDecimator():
+    # Rate reduction on the storage side. Blocks are aligned to the frame number
+    # (seq // factor), so a missing frame never shifts the phase: 'every' keeps the
+    # first frame a block gets, 'mean' averages the frames it got.
+    def __init__(self, factor:int=1, method:str='every'):
+        if factor < 1 or method not in FRAME_DECIMATE_METHODS:
+            raise ValueError('Invalid decimation')
+        self.factor = factor
+        self.method = method
+        self._block = None
+        self._frames = []
+
+    def push(self, frame) -> list:
+        # frames to write now: none, one, or for 'mean' the previous and this block
+        _block = frame.seq // self.factor
+        if self.method == 'every':
+            if _block == self._block:
+                return []
+            self._block = _block
+            return [frame]
+        ret = []
+        if _block != self._block and self._frames:
+            ret.append(self.flush())
+        self._block = _block
+        self._frames.append(frame)
+        if frame.seq % self.factor == self.factor - 1:
+            ret.append(self.flush())
+        return ret
+
+    def flush(self):
+        # the open block of 'mean', even if incomplete
+        if not self._frames:
+            return None
+        ret = _mean_frame(self._frames) if len(self._frames) > 1 else self._frames[0]
+        self._frames = []
+        return ret
+
+class FrameWriter():
+    # Frames (see ThreadSafeAioData.snapshot) are queued by the acquisition loop
+    # and written in batches by the writer thread. Subclasses implement _open(),
+    # _write(batch), _write_gaps(gaps) and _close() for the file at self._path.
+    # With rotation set, the writer thread closes the file between two batches
+    # and goes on in the next segment file; frames wait in the queue meanwhile.
+    _STOP = object()
+
+    def __init__(self, path:str, flush_interval_ms:int=1000, flush_rows:int=1000, queue_size:int=60000):
+        self._base_path = path
+        self._path = path
+        self._flush_interval = flush_interval_ms/1000.0
+        self._flush_rows = max(1, flush_rows)
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._decimator = None
+        self._gap = None # last gap written, extended while reads keep failing
+        self._rotate_bytes = 0
+        self._rotate_seconds = 0.0
+        self._segment = 0
+        self._segment_opened = 0.0
+        self._segment_rows = 0
+        self._segment_first = None # (time_ns, seq) of the first and last frame
+        self._segment_last = None
+        self._is_open = False
+
+        self.on_segment = None # callback(segment_info()) from the writer thread after each flush
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.frames_missed = 0
+        self.errors = 0
+        self.last_error = None
+        self.flush_latency = None # LatencyHistogram of _write(), see metrics.py
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def segment(self) -> int:
+        return self._segment
+
+    def set_rotation(self, max_bytes:int=0, max_seconds:float=0.0):
+        # before start(); 0 for no limit
+        if max_bytes < 0 or max_seconds < 0:
+            raise ValueError('Invalid rotation')
+        self._rotate_bytes = max_bytes
+        self._rotate_seconds = max_seconds
+
+    def segment_info(self, closed:bool=False) -> dict:
+        _first = self._segment_first or (None, None)
+        _last = self._segment_last or (None, None)
+        return {
+            'segment': self._segment,
+            'path': self._path,
+            'rows': self._segment_rows,
+            'start_ns': _first[0],
+            'end_ns': _last[0],
+            'first_seq': _first[1],
+            'last_seq': _last[1],
+            'bytes': self._size(),
+            'closed': closed,
+        }
+
+    def _size(self) -> int:
+        return os.path.getsize(self._path) if os.path.isfile(self._path) else 0
+
+    def start(self):
+        if self._thread:
+            return
+        self._open_segment()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.name = '%sThread'%type(self).__name__
+        self._thread.start()
+
+    def stop(self):
+        if not self._thread:
+            return
+        self.set_decimation(1)
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._thread = None
+        if not self._is_open:
+            # rotated after the last flush: the next segment was never opened
+            return
+        self._is_open = False
+        try:
+            self._close()
+        except Exception as e:
+            self._error('Failed to close %s'%self._path, e)
+        self._notify(True)
+
+    def set_decimation(self, factor:int, method:str='every'):
+        # same thread as put(); the open block is written out first
+        _decimator = FrameDecimator(factor, method) if factor > 1 else None
+        if self._decimator:
+            _frame = self._decimator.flush()
+            if _frame is not None:
+                self._enqueue(_frame)
+        self._decimator = _decimator
+
+    def _enqueue(self, item) -> bool:
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.rows_dropped += 1
+            return False
+
+    def put(self, frame) -> bool:
+        if self._decimator:
+            return all([self._enqueue(f) for f in self._decimator.push(frame)])
+        return self._enqueue(frame)
+
+    def put_gap(self, seq:int, time_ns:int, mono_ns:int) -> bool:
+        # acquisition frame seq failed to read
+        return self._enqueue(FrameGap(seq, 1, time_ns, mono_ns, time_ns))
+
+    def _open(self):
+        pass
+
+    def _write(self, batch:list):
+        raise NotImplementedError
+
+    def _write_gaps(self, gaps:list[FrameGap]):
+        pass
+
+    def _close(self):
+        pass
+
+    def _error(self, message:str, e:Exception):
+        # counted and kept for the owner to report, the writer thread carries on
+        self.errors += 1
+        self.last_error = '%s: %s'%(message, e)
+        print('Background: %s'%message)
+        print(e)
+
+    def _open_segment(self):
+        self._open()
+        self._is_open = True
+        self._segment_opened = time.monotonic()
+        self._segment_rows = 0
+        self._segment_first = self._segment_last = None
+        self._gap = None
+
+    def _notify(self, closed:bool=False):
+        if self.on_segment is None:
+            return
+        try:
+            self.on_segment(self.segment_info(closed))
+        except Exception as e:
+            print('Background: Failed to report segment')
+            print(e)
+
+    def _rotate(self):
+        if not self._segment_rows:
+            return
+        if not ((self._rotate_bytes and self._size() >= self._rotate_bytes) or (self._rotate_seconds and time.monotonic() - self._segment_opened >= self._rotate_seconds)):
+            return
+        self._is_open = False
+        try:
+            self._close()
+        except Exception as e:
+            # the next segment is still the best place for the frames to come
+            self._error('Failed to close %s'%self._path, e)
+        self._notify(True)
+        self._segment += 1
+        self._path = segment_path(self._base_path, self._segment)
+        self._segment_rows = 0
+        self._segment_first = self._segment_last = None
+        # opened by the next flush, a session stopped now leaves no empty segment
+        print('Background: Session continues in %s'%self._path)
+
+    def _after_flush(self):
+        # a failure here must not end the writer thread, frames would then pile up
+        # in the queue and be dropped without a word
+        try:
+            self._notify()
+            self._rotate()
+        except Exception as e:
+            self._error('Failed to rotate %s'%self._path, e)
+
+    def _flush_gaps(self, gaps:list[FrameGap]):
+        # merged with each other and with the last one written, which is then rewritten
+        _merged = [self._gap] if self._gap else []
+        for _gap in gaps:
+            _joined = _merged[-1].merge(_gap) if _merged else None
+            if _joined:
+                _merged[-1] = _joined
+            else:
+                _merged.append(_gap)
+        if self._gap and _merged[0].frames == self._gap.frames:
+            _merged.pop(0)
+        try:
+            self._write_gaps(_merged)
+            self._gap = _merged[-1]
+            self.frames_missed += sum(g.frames for g in gaps)
+        except Exception as e:
+            self._error('Failed to save gaps', e)
+
+    def _flush(self, batch:list):
+        if batch and not self._is_open:
+            # the next segment after a rotation; one that failed to open is retried at every flush
+            try:
+                self._open_segment()
+            except Exception as e:
+                self.rows_dropped += sum(type(item) is not FrameGap for item in batch)
+                self._error('Failed to open %s'%self._path, e)
+                return
+        _gaps = [item for item in batch if type(item) is FrameGap]
+        if _gaps:
+            self._flush_gaps(_gaps)
+            batch = [item for item in batch if type(item) is not FrameGap]
+        if not batch:
+            return
+        try:
+            _started = time.perf_counter()
+            self._write(batch)
+            if self.flush_latency is not None:
+                self.flush_latency.observe(time.perf_counter() - _started)
+            self.rows_written += len(batch)
+            self._segment_rows += len(batch)
+            self._segment_first = self._segment_first or (batch[0].time_ns, batch[0].seq)
+            self._segment_last = (batch[-1].time_ns, batch[-1].seq)
+        except Exception as e:
+            self.rows_dropped += len(batch)
+            self._error('Failed to save data', e)
+
+    def _run(self):
+        _batch = []
+        _deadline = time.perf_counter() + self._flush_interval
+        _running = True
+        while _running:
+            try:
+                _item = self._queue.get(timeout=max(0.0, _deadline - time.perf_counter()))
+                while True:
+                    if _item is self._STOP:
+                        _running = False
+                        break
+                    _batch.append(_item)
+                    if len(_batch) >= self._flush_rows:
+                        break
+                    _item = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            if not _running or len(_batch) >= self._flush_rows or time.perf_counter() >= _deadline:
+                _flushed = bool(_batch)
+                self._flush(_batch)
+                _batch = []
+                _deadline = time.perf_counter() + self._flush_interval
+                if _flushed and _running:
+                    self._after_flush()
+
+class SqlWriter(FrameWriter):
+    # One row per frame in the data table, one executemany per transaction.
+    def __init__(self, db_path:str, synchronous:str='NORMAL', flush_interval_ms:int=1000, flush_rows:int=1000, queue_size:int=60000):
+        super().__init__(db_path, flush_interval_ms, flush_rows, queue_size)
+        self._synchronous = synchronous
+        self._engine = create_sqlite_engine(db_path, synchronous)
+
+        _columns = [c.name for c in AioDataTable.__table__.columns if c.name != 'id']
+        self._insert_sql = 'INSERT INTO %s (%s) VALUES (%s)'%(AioDataTable.__tablename__, ', '.join(_columns), ', '.join(['?']*len(_columns)))
+
+    @property
+    def db_path(self) -> str:
+        return self._path
+
+    def _open(self):
+        if self._engine.url.database != self._path:
+            self._engine = create_sqlite_engine(self._path, self._synchronous)
+        AioDataTable.metadata.create_all(self._engine)
+
+    def _close(self):
+        self._engine.dispose()
+
+    def _size(self) -> int:
+        return sum(os.path.getsize(p) for p in (self._path, self._path+'-wal') if os.path.exists(p))
+
+    def _flatten(self, frame) -> tuple:
+        _time = datetime.datetime.fromtimestamp(frame.time_ns/1E9).strftime(SQL_TIME_FORMAT)
+        return (_time, frame.seq, frame.mono_ns, *frame.ai_raw.tolist(), *frame.ai_phy.tolist(), *frame.ao_raw.tolist(), *frame.ao_phy.tolist(), *frame.param.tolist())
+
+    def _write(self, batch:list):
+        with self._engine.begin() as conn:
+            conn.exec_driver_sql(self._insert_sql, [self._flatten(frame) for frame in batch])
+
+    def _write_gaps(self, gaps:list[FrameGap]):
+        _time = lambda ns: datetime.datetime.fromtimestamp(ns/1E9).strftime(SQL_TIME_FORMAT)
+        with self._engine.begin() as conn:
+            conn.exec_driver_sql('INSERT OR REPLACE INTO gaps (seq, frames, time, end_time, mono_ns) VALUES (?, ?, ?, ?, ?)', [(g.seq, g.frames, _time(g.time_ns), _time(g.end_time_ns), g.mono_ns) for g in gaps])
+
+class SessionReader():
+    # Reads a session database page by page (keyset on id), so callers can stream
+    # arbitrarily long runs while the writer keeps appending. Read-only: sessions
+    # recorded before the time index existed are scanned (rollup.py adds it).
+    def __init__(self, db_path:str):
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(db_path)
+        self._db_path = db_path
+        self._engine = create_engine('sqlite:///file:%s?mode=ro&uri=true'%db_path)
+        with self._engine.connect() as conn:
+            self._columns = [r[1] for r in conn.exec_driver_sql('PRAGMA table_info(data)').fetchall() if r[1] != 'id']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._engine.dispose()
+
+    @property
+    def db_path(self) -> str:
+        return self._db_path
+
+    @property
+    def columns(self) -> list[str]:
+        return list(self._columns)
+
+    def _first_id_at(self, conn, time_str:str) -> int|None:
+        _row = conn.exec_driver_sql('SELECT id FROM data WHERE time >= ? ORDER BY time LIMIT 1', (time_str,)).fetchone()
+        return None if _row is None else _row[0]
+
+    def id_range(self, start:str|None=None, end:str|None=None) -> tuple[int, int|None]:
+        # (exclusive lower id, exclusive upper id or None) of rows in [start, end)
+        _lo, _hi = 0, None
+        with self._engine.connect() as conn:
+            if start is not None:
+                _id = self._first_id_at(conn, start)
+                _lo = (_id - 1) if _id is not None else (conn.exec_driver_sql('SELECT MAX(id) FROM data').fetchone()[0] or 0)
+            if end is not None:
+                _hi = self._first_id_at(conn, end)
+        return (_lo, _hi)
+
+    def last_id(self) -> int:
+        with self._engine.connect() as conn:
+            return conn.exec_driver_sql('SELECT MAX(id) FROM data').fetchone()[0] or 0
+
+    def gaps(self, start:str|None=None, end:str|None=None) -> list[dict]:
+        # failed reads overlapping [start, end); sessions recorded before frame numbers have none
+        with self._engine.connect() as conn:
+            if not conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'gaps'").fetchone():
+                return []
+            _where = [c for c, v in (('end_time >= ?', start), ('time < ?', end)) if v is not None]
+            _sql = 'SELECT seq, frames, time, end_time FROM gaps%s ORDER BY seq'%(' WHERE '+' AND '.join(_where) if _where else '')
+            _rows = conn.exec_driver_sql(_sql, tuple(v for v in (start, end) if v is not None)).fetchall()
+        return [{'seq': r[0], 'frames': r[1], 'start': r[2], 'end': r[3]} for r in _rows]
+
+    def times(self, ids:list[int]) -> dict[int, str]:
+        # time of the given rows in one query, ids go in as a single JSON array parameter
+        with self._engine.connect() as conn:
+            return dict(conn.exec_driver_sql('SELECT id, time FROM data WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(ids),)).fetchall())
+
+    def _iter_pages(self, columns:list[str], since_index:int, start:str|None, end:str|None, limit:int|None, chunk_rows:int, fetch):
+        for _col in columns:
+            if _col not in self._columns:
+                raise ValueError('Invalid column: %s'%_col)
+        _lo, _hi = self.id_range(start, end)
+        _lo = max(_lo, since_index)
+        _sql = 'SELECT id%s FROM data WHERE id > ?%s ORDER BY id LIMIT ?'%(''.join(', '+c for c in columns), '' if _hi is None else ' AND id < %d'%_hi)
+        _remaining = limit
+        while _remaining is None or _remaining > 0:
+            _n = chunk_rows if _remaining is None else min(chunk_rows, _remaining)
+            _rows = fetch(_sql, (_lo, _n))
+            if not _rows:
+                break
+            yield _rows
+            _lo = _rows[-1][0]
+            if _remaining is not None:
+                _remaining -= len(_rows)
+            if len(_rows) < _n:
+                break
+
+    def iter_rows(self, columns:list[str], since_index:int=0, start:str|None=None, end:str|None=None, limit:int|None=None, chunk_rows:int=1000):
+        def _fetch(sql, params):
+            with self._engine.connect() as conn:
+                return conn.exec_driver_sql(sql, params).fetchall()
+        yield from self._iter_pages(columns, since_index, start, end, limit, chunk_rows, _fetch)
+
+    def iter_arrays(self, columns:list[str], since_index:int=0, start:str|None=None, end:str|None=None, limit:int|None=None, chunk_rows:int=100000, dtype=np.float64):
+        # numeric columns only, yields (ids, values[rows, columns]) per chunk. Goes
+        # through the DBAPI cursor, plain tuples convert to numpy much faster than Rows.
+        _conn = self._engine.raw_connection()
+        try:
+            _fetch = lambda sql, params: _conn.cursor().execute(sql, params).fetchall()
+            for _rows in self._iter_pages(columns, since_index, start, end, limit, chunk_rows, _fetch):
+                _array = np.array(_rows, dtype=np.float64)
+                yield _array[:, 0].astype(np.int64), _array[:, 1:].astype(dtype, copy=False)
+        finally:
+            _conn.close()
@@ -0,0 +1,27 @@
+import os, sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from channels import NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM
+from core import AioFrame
+
+T0_NS = 1_700_000_000_000_000_000
+
+def make_frames(count:int, interval_ns:int=10_000_000, first_seq:int=0) -> list:
+    # deterministic frames with slowly changing raw values and their phy columns
+    ret = []
+    for i in range(count):
+        _seq = first_seq + i
+        _ai_raw = ((np.arange(NUM_CH_AI) * 37 + _seq * 3) % 2000 - 1000).astype(np.int16)
+        _ao_raw = ((np.arange(NUM_CH_AO) * 11 + _seq) % 4000).astype(np.uint16)
+        ret.append(AioFrame(_seq, T0_NS + _seq * interval_ns, _seq * interval_ns, _ai_raw, (_ai_raw * 0.5).astype(np.float32), _ao_raw, (_ao_raw * 0.25).astype(np.float32), np.full(NUM_CH_PARAM, _seq * 0.125, dtype=np.float32), 0))
+    return ret
+
+def write_session(writer, frames:list):
+    writer.start()
+    for frame in frames:
+        assert writer.put(frame)
+    writer.stop()
+    return writer
@@ -0,0 +1,112 @@
+import os, sqlite3
+
+import numpy as np
+import pytest
+
+from archive import _encode, _decode, _time_str, archive_session, ArchiveReader, ARCHIVE_CODECS, ARCHIVE_LEVELS
+from columnar import convert_to_sqlite
+from storage import SqlWriter
+from conftest import make_frames, write_session
+
+@pytest.mark.parametrize('codec', ARCHIVE_CODECS)
+@pytest.mark.parametrize('dtype, shape', [(np.int16, (16,)), (np.uint16, (8,)), (np.int64, ()), (np.float32, (16,)), (np.float64, ())])
+def test_encode_decode_round_trip(codec, dtype, shape):
+    _rng = np.random.default_rng(0)
+    _dtype = np.dtype(dtype)
+    if _dtype.kind in 'iu':
+        _info = np.iinfo(_dtype)
+        # full range steps: the zigzag deltas wrap around the width
+        _values = _rng.integers(_info.min, _info.max, size=(257,)+shape, dtype=_dtype, endpoint=True)
+        _values[:2] = _info.min
+        _values[2:4] = _info.max
+    else:
+        _values = _rng.normal(0.0, 1E3, size=(257,)+shape).astype(_dtype)
+        _values.flat[:3] = [np.nan, np.inf, -0.0]
+    _decoded = _decode(_encode(_values, codec, ARCHIVE_LEVELS[codec]), codec, _dtype, shape, len(_values))
+    assert _decoded.dtype == _dtype
+    assert _decoded.shape == _values.shape
+    assert _decoded.tobytes() == _values.tobytes()
+
+def test_encode_decode_single_row():
+    _values = np.array([[-32768, 32767, 0]], dtype=np.int16)
+    assert np.array_equal(_decode(_encode(_values, 'zlib', 6), 'zlib', _values.dtype, (3,), 1), _values)
+
+def test_archive_session_matches_source(tmp_path):
+    _frames = make_frames(3000)
+    _path = str(tmp_path / '20240101120000.sqlite3')
+    write_session(SqlWriter(_path, flush_interval_ms=10, flush_rows=500), _frames)
+    _info = archive_session(_path, block_rows=1024)
+    with ArchiveReader(_info['path']) as _reader:
+        assert len(_reader) == len(_frames)
+        _data = _reader.read(['seq', 'ai_raw', 'ao_raw', 'ai_phy', 'param'])
+    assert np.array_equal(_data['seq'], [f.seq for f in _frames])
+    assert np.array_equal(_data['ai_raw'], np.array([f.ai_raw for f in _frames]))
+    assert np.array_equal(_data['ao_raw'], np.array([f.ao_raw for f in _frames]))
+    assert np.array_equal(_data['ai_phy'], np.array([f.ai_phy for f in _frames]))
+    assert np.array_equal(_data['param'], np.array([f.param for f in _frames]))
+
+def _baseline_session(path:str, frames:list):
+    # the data table as written before seq, mono_ns and the gaps table existed
+    _columns = ['ai_raw_%d'%i for i in range(16)] + ['ai_phy_%d'%i for i in range(16)] + ['ao_raw_%d'%i for i in range(8)] + ['ao_phy_%d'%i for i in range(8)] + ['param_phy_%d'%i for i in range(16)]
+    _conn = sqlite3.connect(path)
+    with _conn:
+        _conn.execute('CREATE TABLE data (id INTEGER PRIMARY KEY, time DATETIME, %s)'%', '.join(_columns))
+        _conn.executemany('INSERT INTO data (time, %s) VALUES (?%s)'%(', '.join(_columns), ', ?'*len(_columns)),
+                          [(_time_str(f.time_ns), *f.ai_raw.tolist(), *f.ai_phy.tolist(), *f.ao_raw.tolist(), *f.ao_phy.tolist(), *f.param.tolist()) for f in frames])
+    _conn.close()
+
+def test_baseline_session_restores_to_sqlite(tmp_path):
+    _frames = make_frames(1500)
+    _path = str(tmp_path / '20240101120000.sqlite3')
+    _baseline_session(_path, _frames)
+    _info = archive_session(_path, block_rows=1024)
+    _out = str(tmp_path / 'restored.sqlite3')
+    with ArchiveReader(_info['path']) as _reader:
+        assert 'seq' not in _reader.fields
+        assert convert_to_sqlite(_reader, _out, rows=400) == len(_frames)
+    _conn = sqlite3.connect(_out)
+    _rows = _conn.execute('SELECT seq, mono_ns, ai_raw_3, ao_raw_7, param_phy_15 FROM data ORDER BY id').fetchall()
+    _conn.close()
+    assert len(_rows) == len(_frames)
+    assert all(r[0] is None and r[1] is None for r in _rows)
+    assert [r[2] for r in _rows] == [int(f.ai_raw[3]) for f in _frames]
+    assert [r[3] for r in _rows] == [int(f.ao_raw[7]) for f in _frames]
+    assert [r[4] for r in _rows] == pytest.approx([float(f.param[15]) for f in _frames])
+
+def test_failed_restore_leaves_no_file(tmp_path):
+    _path = str(tmp_path / '20240101120000.sqlite3')
+    write_session(SqlWriter(_path, flush_interval_ms=10, flush_rows=500), make_frames(100))
+    _info = archive_session(_path)
+    _out = str(tmp_path / 'restored.sqlite3')
+    def _progress(rows):
+        raise RuntimeError('interrupted')
+    with ArchiveReader(_info['path']) as _reader:
+        with pytest.raises(RuntimeError):
+            convert_to_sqlite(_reader, _out, rows=10, progress=_progress)
+        assert not os.path.exists(_out) and not os.path.exists(_out + '.tmp')
+        assert convert_to_sqlite(_reader, _out) == 100
+
+def test_archive_queue_counts_across_threads(tmp_path, monkeypatch):
+    # submits on this thread, done callbacks on the pool threads, as with the writer and the archive pool
+    import core
+    from concurrent.futures import ThreadPoolExecutor
+
+    class _Catalog:
+        def session(self, name): return None
+        def set_archive(self, name, segment, path, size, removed): pass
+
+    def _archive(path, out_path, meta, codec):
+        if path.endswith('7'):
+            raise OSError('bad segment')
+        return {'path': path+'.zarc', 'bytes': 1, 'source_bytes': 1}
+
+    monkeypatch.setattr(core, 'archive_session', _archive)
+    _core = core.LoggerCore(str(tmp_path / 'config.json'))
+    _core._catalog = _Catalog()
+    _core._archive_remove_source = False
+    _core._archive_pool = ThreadPoolExecutor(4)
+    for _i in range(500):
+        _core._bg_archive_submit('s', _i, str(tmp_path / ('%d'%_i)))
+    _core._archive_pool.shutdown(wait=True)
+    _stats = _core._util_archive_stats()
+    assert _stats == {'pending': 0, 'done': 450, 'failed': 50}
@@ -0,0 +1,102 @@
+import os, sqlite3
+
+import pytest
+
+from archive import archive_session
+from catalog import SessionCatalog
+from storage import SqlWriter
+from conftest import make_frames, write_session
+
+SESSION = '20240101120000'
+
+def _seqs(path:str) -> list[int]:
+    _conn = sqlite3.connect(path)
+    try:
+        return [r[0] for r in _conn.execute('SELECT seq FROM data ORDER BY id').fetchall()]
+    finally:
+        _conn.close()
+
+@pytest.fixture
+def rotated(tmp_path):
+    # a session rotated every 64 kB, reported to the catalog as core does
+    _catalog = SessionCatalog(str(tmp_path))
+    _catalog.open_session(SESSION, 'sqlite')
+    _writer = SqlWriter(str(tmp_path / (SESSION + '.sqlite3')), flush_interval_ms=10, flush_rows=200)
+    _writer.set_rotation(max_bytes=64 * 1024)
+    _writer.on_segment = lambda info: _catalog.update_segment(SESSION, info)
+    _frames = make_frames(3000)
+    write_session(_writer, _frames)
+    _catalog.close_session(SESSION)
+    return _catalog, _writer, _frames
+
+def _session_files(directory:str) -> list[str]:
+    return sorted(f for f in os.listdir(directory) if f.startswith(SESSION) and f.endswith('.sqlite3'))
+
+def test_rotation_loses_no_frame(rotated):
+    _catalog, _writer, _frames = rotated
+    _segments = _catalog.segments(SESSION)
+    assert len(_segments) >= 3
+    assert os.path.basename(_segments[1]['path']) == SESSION + '.001.sqlite3'
+    # one file per segment; a rotation right before stop() leaves no empty one behind
+    assert _session_files(os.path.dirname(_catalog.path)) == sorted(os.path.basename(s['path']) for s in _segments)
+    assert all(s['rows'] for s in _segments)
+    assert [q for s in _segments for q in _seqs(s['path'])] == [f.seq for f in _frames]
+    assert _writer.rows_written == len(_frames) and _writer.rows_dropped == 0 and _writer.errors == 0
+
+def test_segments_number_rows_across_files(rotated):
+    _catalog, _writer, _frames = rotated
+    _segments = _catalog.segments(SESSION)
+    assert [s['segment'] for s in _segments] == list(range(len(_segments)))
+    assert all(s['closed'] for s in _segments)
+    _base = 0
+    for s in _segments:
+        assert s['base'] == _base
+        assert _seqs(s['path']) == list(range(s['first_seq'], s['last_seq'] + 1))
+        # seq is the frame number, base + id the row number
+        assert s['first_seq'] == _base
+        _base += s['rows']
+    assert _base == len(_frames)
+    assert _catalog.sessions()[0]['rows'] == len(_frames)
+    # a time window only returns the segments it overlaps, keeping their base
+    _last = _segments[-1]
+    assert [(s['segment'], s['base']) for s in _catalog.segments(SESSION, start=_last['start'])] == [(_last['segment'], _last['base'])]
+    assert [s['segment'] for s in _catalog.segments(SESSION, end=_segments[0]['end'])] == [0]
+
+def test_scan_adopts_unknown_files_and_drops_deleted_ones(tmp_path):
+    _old = str(tmp_path / '20230101000000.sqlite3')
+    write_session(SqlWriter(_old, flush_interval_ms=10), make_frames(100))
+    _archived = str(tmp_path / '20230202000000.sqlite3')
+    write_session(SqlWriter(_archived, flush_interval_ms=10), make_frames(50, first_seq=7))
+    _archive = archive_session(_archived)['path']
+    os.remove(_archived)
+    open(str(tmp_path / 'notes.sqlite3'), 'w').close()
+
+    _catalog = SessionCatalog(str(tmp_path))
+    assert _catalog.scan() == 2
+    assert _catalog.scan() == 0
+    _sessions = {s['name']: s for s in _catalog.sessions()}
+    assert sorted(_sessions) == ['20230101000000', '20230202000000']
+    assert _sessions['20230101000000']['rows'] == 100 and _sessions['20230101000000']['closed']
+    # known only from its archive: rows and seq range from the archive index
+    _segment = _catalog.segments('20230202000000')[0]
+    assert (_segment['rows'], _segment['first_seq'], _segment['last_seq']) == (50, 7, 56)
+    assert _segment['archive'] == _archive and _segment['bytes'] is None
+
+    os.remove(_old)
+    os.remove(_archive)
+    assert _catalog.scan() == 0
+    assert _catalog.sessions() == []
+
+def test_scan_keeps_a_segment_whose_source_was_archived_and_removed(rotated):
+    _catalog, _writer, _frames = rotated
+    _count = len(_catalog.segments(SESSION))
+    _first = _catalog.segments(SESSION)[0]
+    _archive = archive_session(_first['path'])['path']
+    assert _catalog.scan() == 0
+    assert _catalog.segments(SESSION)[0]['archive'] == _archive
+    os.remove(_first['path'])
+    _catalog.scan()
+    assert [s['segment'] for s in _catalog.segments(SESSION)] == list(range(_count))
+    os.remove(_archive)
+    _catalog.scan()
+    assert [s['segment'] for s in _catalog.segments(SESSION)] == list(range(1, _count))
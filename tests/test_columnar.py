@@ -0,0 +1,111 @@
+import os, csv, sqlite3, time
+
+import numpy as np
+import pytest
+
+from channels import NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM
+from columnar import ColumnarWriter, ColumnarReader, convert_to_sqlite, convert_to_csv, COLUMNAR_MANIFEST_NAME
+from storage import SqlWriter
+from conftest import make_frames
+
+MISSING = [40, 41, 42, 99]
+
+def _columnar(path:str, **kwargs) -> ColumnarWriter:
+    # small chunks: reads and conversions cross chunk boundaries
+    return ColumnarWriter(path, NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM, chunk_frames=64, flush_interval_ms=5, **kwargs)
+
+def _record(writer, frames:list):
+    writer.start()
+    for frame in frames:
+        if frame.seq in MISSING:
+            assert writer.put_gap(frame.seq, frame.time_ns, frame.mono_ns)
+        else:
+            assert writer.put(frame)
+    writer.stop()
+    return writer
+
+def _assert_frames(views:dict, frames:list):
+    assert views['seq'].tolist() == [f.seq for f in frames]
+    assert views['time_ns'].tolist() == [f.time_ns for f in frames]
+    for name in ('ai_raw', 'ai_phy', 'ao_raw', 'ao_phy', 'param'):
+        assert np.array_equal(views[name], np.array([getattr(f, name) for f in frames])), name
+
+def _wait_frames(writer:ColumnarWriter, reader:ColumnarReader|None, count:int) -> ColumnarReader:
+    # until the writer thread has flushed count frames
+    _deadline = time.monotonic() + 10.0
+    while True:
+        if reader is None and os.path.exists(os.path.join(writer.path, COLUMNAR_MANIFEST_NAME)):
+            reader = ColumnarReader(writer.path)
+        if reader is not None:
+            reader.refresh()
+            if len(reader) >= count:
+                return reader
+        assert time.monotonic() < _deadline
+        time.sleep(0.005)
+
+def test_read_while_writing(tmp_path):
+    _frames = make_frames(1000)
+    _writer = _columnar(str(tmp_path / 's.msl'), flush_rows=16)
+    _writer.start()
+    _reader = None
+    _seen = []
+    for _start in range(0, len(_frames), 50):
+        for frame in _frames[_start:_start+50]:
+            assert _writer.put(frame)
+        _reader = _wait_frames(_writer, _reader, _start + 50)
+        # the maps of a chunk taken while it filled up see the rest once it is there
+        _seen.append(len(_reader))
+        _assert_frames(_reader.read(), _frames[:len(_reader)])
+        assert not _reader.closed
+    _writer.stop()
+    _reader.refresh()
+    assert _reader.closed
+    assert _seen == list(range(50, len(_frames)+1, 50))
+    _assert_frames(_reader.read(), _frames)
+    _assert_frames(_reader.read(start=100, stop=300), _frames[100:300])
+    assert _reader.index_at(_frames[500].time_ns) == 500
+    _reader.close()
+
+def _sql_rows(path:str, table:str, columns:str) -> list[tuple]:
+    _conn = sqlite3.connect(path)
+    try:
+        return _conn.execute('SELECT %s FROM %s ORDER BY rowid'%(columns, table)).fetchall()
+    finally:
+        _conn.close()
+
+def test_convert_to_sqlite_matches_sql_writer(tmp_path):
+    _frames = make_frames(200)
+    _writer = _record(_columnar(str(tmp_path / 's.msl')), _frames)
+    _direct = _record(SqlWriter(str(tmp_path / 'direct.sqlite3'), flush_interval_ms=5), _frames)
+    _out = str(tmp_path / 'converted.sqlite3')
+    _progress = []
+    with ColumnarReader(_writer.path) as _reader:
+        assert convert_to_sqlite(_reader, _out, rows=50, progress=_progress.append) == 200 - len(MISSING)
+        with pytest.raises(FileExistsError):
+            convert_to_sqlite(_reader, _out)
+    assert _progress == [50, 100, 150, 196]
+    # same rows as if the session had been recorded to sqlite in the first place
+    _expected = _sql_rows(_direct.path, 'data', '*')
+    assert len(_expected) == 200 - len(MISSING)
+    assert _sql_rows(_out, 'data', '*') == _expected
+    assert _sql_rows(_out, 'gaps', '*') == _sql_rows(_direct.path, 'gaps', '*')
+
+def test_convert_to_csv(tmp_path):
+    _frames = make_frames(150)
+    _frames[7] = _frames[7]._replace(stale=0b101)
+    _writer = _record(_columnar(str(tmp_path / 's.msl')), _frames)
+    _out = str(tmp_path / 's.csv')
+    with ColumnarReader(_writer.path) as _reader:
+        assert convert_to_csv(_reader, _out, rows=40) == 150 - len(MISSING)
+    with open(_out, newline='') as f:
+        _rows = list(csv.reader(f))
+    _header, _rows = _rows[0], _rows[1:]
+    _kept = [f for f in _frames if f.seq not in MISSING]
+    assert _header[:3] == ['time', 'seq', 'mono_ns'] and _header[-1] == 'stale'
+    assert len(_header) == 3 + 2*NUM_CH_AI + 2*NUM_CH_AO + NUM_CH_PARAM + 1
+    assert [int(r[1]) for r in _rows] == [f.seq for f in _kept]
+    assert [int(r[-1]) for r in _rows] == [f.stale for f in _kept]
+    _ai_raw_3 = _header.index('ai_raw_3')
+    assert [int(r[_ai_raw_3]) for r in _rows] == [int(f.ai_raw[3]) for f in _kept]
+    _param_0 = _header.index('param_phy_0')
+    assert [float(r[_param_0]) for r in _rows] == [float(f.param[0]) for f in _kept]
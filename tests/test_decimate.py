@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from decimate import MinMaxAccumulator, lttb, decimate
+
+def _source(rows:int=10000, num_ch:int=4) -> tuple[np.ndarray, np.ndarray]:
+    # ascending x with holes, quantized values (ties) and a few NaN
+    _rng = np.random.default_rng(1)
+    _x = np.cumsum(_rng.integers(1, 4, size=rows)).astype(np.int64)
+    _v = np.round(_rng.normal(0.0, 10.0, size=(rows, num_ch)))
+    _v[_rng.integers(0, rows, size=50), _rng.integers(0, num_ch, size=50)] = np.nan
+    _v[100:140, 1] = np.nan
+    return _x, _v
+
+def _chunks(x:np.ndarray, v:np.ndarray, size:int):
+    for _start in range(0, len(x), size):
+        yield x[_start:_start+size], v[_start:_start+size]
+
+@pytest.mark.parametrize('size', [1, 7, 333, 4096])
+def test_chunked_equals_one_pass(size):
+    _x, _v = _source()
+    _one = MinMaxAccumulator(int(_x[0]), int(_x[-1]), 300, _v.shape[1])
+    _one.add(_x, _v)
+    _acc = MinMaxAccumulator(int(_x[0]), int(_x[-1]), 300, _v.shape[1])
+    for _cx, _cv in _chunks(_x, _v, size):
+        _acc.add(_cx, _cv)
+    assert _acc.rows == _one.rows == len(_x)
+    for _a, _b in zip(_acc.result(), _one.result()):
+        assert np.array_equal(_a, _b, equal_nan=True)
+
+def test_envelope_keeps_extremes():
+    _x, _v = _source()
+    _buckets = 250
+    _acc = MinMaxAccumulator(int(_x[0]), int(_x[-1]), _buckets, _v.shape[1])
+    for _cx, _cv in _chunks(_x, _v, 1000):
+        _acc.add(_cx, _cv)
+    _rx, _ry = _acc.result()
+    assert len(_rx) <= 2 * _buckets
+    assert np.all(np.diff(_rx, axis=0) > 0)
+    _span = int(_x[-1] - _x[0] + 1)
+    _of_source = (_x - _x[0]) * _buckets // _span
+    _of_result = (_rx - _x[0]) * _buckets // _span
+    for ch in range(_v.shape[1]):
+        for _bucket in np.unique(_of_source):
+            _in = _v[_of_source == _bucket, ch]
+            _out = _ry[_of_result[:, ch] == _bucket, ch]
+            if np.isnan(_in).all():
+                assert np.isnan(_out).all()
+                continue
+            # min and max of every bucket survive, nothing else
+            assert np.nanmin(_out) == np.nanmin(_in) and np.nanmax(_out) == np.nanmax(_in)
+        # the points are real samples at their own x
+        _at = np.searchsorted(_x, _rx[:, ch])
+        assert np.array_equal(_x[_at], _rx[:, ch])
+        assert np.array_equal(_v[_at, ch], _ry[:, ch], equal_nan=True)
+
+def test_single_row_buckets_give_one_point():
+    _x = np.array([0, 1, 2, 5, 6, 9], dtype=np.int64)
+    _v = np.array([[1.0], [3.0], [2.0], [4.0], [4.0], [-1.0]])
+    _acc = MinMaxAccumulator(0, 9, 5, 1)
+    _acc.add(_x, _v)
+    _rx, _ry = _acc.result()
+    # buckets of two x each: [0 1] [2] [5] [6] [9]; a tie keeps the earlier point once
+    assert _rx[:, 0].tolist() == [0, 1, 2, 5, 6, 9]
+    assert _ry[:, 0].tolist() == [1.0, 3.0, 2.0, 4.0, 4.0, -1.0]
+    with pytest.raises(ValueError):
+        _acc.add(np.array([10]), np.array([[0.0]]))
+
+def test_lttb_keeps_ends_and_peaks():
+    _x = np.arange(1000, dtype=np.int64)[:, None].repeat(2, axis=1)
+    _y = np.zeros((1000, 2))
+    _y[333, 0] = 100.0
+    _y[666, 1] = -100.0
+    _rx, _ry = lttb(_x, _y, 50)
+    assert _rx.shape == _ry.shape == (50, 2)
+    assert np.all(_rx[0] == 0) and np.all(_rx[-1] == 999)
+    assert np.all(np.diff(_rx, axis=0) > 0)
+    assert 333 in _rx[:, 0] and 666 in _rx[:, 1]
+    # short input is returned as is
+    _sx, _sy = lttb(_x[:40], _y[:40], 50)
+    assert np.array_equal(_sx, _x[:40]) and np.array_equal(_sy, _y[:40])
+    with pytest.raises(ValueError):
+        lttb(_x, _y, 2)
+
+@pytest.mark.parametrize('method', ['minmax', 'lttb'])
+def test_decimate_bounds_points(method):
+    _x, _v = _source()
+    _rx, _ry, _rows = decimate(_chunks(_x, _v, 777), int(_x[0]), int(_x[-1]), _v.shape[1], 200, method)
+    assert _rows == len(_x)
+    assert len(_rx) <= 200 and _rx.shape == _ry.shape
+    for ch in range(_v.shape[1]):
+        if method == 'minmax':
+            assert np.nanmax(_ry[:, ch]) == np.nanmax(_v[:, ch])
+            assert np.nanmin(_ry[:, ch]) == np.nanmin(_v[:, ch])
+    with pytest.raises(ValueError):
+        decimate(_chunks(_x, _v, 777), int(_x[0]), int(_x[-1]), _v.shape[1], 3, method)
+    with pytest.raises(ValueError):
+        decimate(_chunks(_x, _v, 777), int(_x[0]), int(_x[-1]), _v.shape[1], 200, 'mean')
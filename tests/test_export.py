@@ -0,0 +1,65 @@
+import io, csv, sqlite3
+
+import numpy as np
+import pytest
+
+from export import iter_csv, write_npz
+from storage import SqlWriter
+from conftest import make_frames, write_session
+
+@pytest.fixture
+def session(tmp_path):
+    # NaN phy values are stored by SQLite as NULL, as is any cell never written
+    _path = str(tmp_path / '20240101120000.sqlite3')
+    _frames = make_frames(50)
+    _frames[3] = _frames[3]._replace(ai_phy=np.full(16, np.nan, dtype=np.float32))
+    write_session(SqlWriter(_path, flush_interval_ms=10, flush_rows=20), _frames)
+    _conn = sqlite3.connect(_path)
+    with _conn:
+        _conn.execute('UPDATE data SET ao_phy_1 = NULL, param_phy_2 = NULL WHERE id = 10')
+        _conn.execute('UPDATE data SET ai_raw_0 = NULL WHERE id = 20')
+    _conn.close()
+    return _path, _frames
+
+def test_csv_null_cells_are_empty_fields(session):
+    _path, _frames = session
+    _rows = list(csv.DictReader(io.StringIO(''.join(iter_csv(_path, chunk_rows=7)))))
+    assert len(_rows) == len(_frames)
+    assert [int(r['index']) for r in _rows] == list(range(1, len(_frames) + 1))
+    assert _rows[3]['ai_phy_0'] == '' and _rows[3]['ai_phy_15'] == ''
+    assert _rows[3]['ai_raw_0'] == str(_frames[3].ai_raw[0])
+    assert _rows[9]['ao_phy_1'] == '' and _rows[9]['param_phy_2'] == ''
+    assert float(_rows[9]['ao_phy_0']) == pytest.approx(_frames[9].ao_phy[0])
+    assert _rows[19]['ai_raw_0'] == ''
+    assert float(_rows[0]['ai_phy_1']) == pytest.approx(_frames[0].ai_phy[1])
+
+def test_csv_without_nulls_is_unchanged_by_the_fallback(session):
+    _path, _frames = session
+    _lines = ''.join(iter_csv(_path, channels=['seq', 'ai_raw_1'], chunk_rows=7)).splitlines()
+    assert _lines[0] == 'index,time,seq,ai_raw_1'
+    assert [l.split(',')[2:] for l in _lines[1:]] == [[str(f.seq), str(f.ai_raw[1])] for f in _frames]
+
+def test_npz_null_cells(session, tmp_path):
+    _path, _frames = session
+    _out = str(tmp_path / 'out.npz')
+    assert write_npz(_path, _out, chunk_rows=7) == len(_frames)
+    with np.load(_out) as _npz:
+        assert _npz['ai_phy_0'].dtype == np.float32
+        assert np.isnan(_npz['ai_phy_0'][3])
+        assert np.isnan(_npz['ao_phy_1'][9]) and np.isnan(_npz['param_phy_2'][9])
+        assert _npz['ai_raw_0'][19] == 0
+        assert np.array_equal(_npz['seq'], [f.seq for f in _frames])
+        _ok = np.ones(len(_frames), dtype=bool)
+        _ok[3] = False
+        assert np.array_equal(_npz['ai_phy_1'][_ok], np.array([f.ai_phy[1] for f in _frames])[_ok])
+
+def test_npz_with_worker_processes_matches_single(session, tmp_path):
+    _path, _frames = session
+    _single, _jobs = str(tmp_path / 'single.npz'), str(tmp_path / 'jobs.npz')
+    assert write_npz(_path, _single, chunk_rows=7) == len(_frames)
+    assert write_npz(_path, _jobs, chunk_rows=7, jobs=2) == len(_frames)
+    with np.load(_single) as _a, np.load(_jobs) as _b:
+        assert _a.files == _b.files
+        for _key in _a.files:
+            assert _a[_key].dtype == _b[_key].dtype
+            assert np.array_equal(_a[_key], _b[_key], equal_nan=_a[_key].dtype.kind == 'f')
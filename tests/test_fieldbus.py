@@ -0,0 +1,219 @@
+import time, threading
+
+import numpy as np
+import pytest
+
+import bench
+from bench import SimulatedSlave
+import fieldbus
+from fieldbus import FieldBus
+
+READ_DELAY_S = 0.1
+
+def _wait_connected(bus:FieldBus, timeout:float=5.0):
+    _deadline = time.perf_counter() + timeout
+    while any(lane.client is None for lane in bus.lanes):
+        assert time.perf_counter() < _deadline, 'not connected'
+        time.sleep(0.02)
+
+@pytest.fixture
+def slow_reads(monkeypatch):
+    # every input register read takes READ_DELAY_S; the server of each bus runs on
+    # its own event loop, so only requests to the same bus wait for each other
+    _get_values = bench._RampBlock.getValues
+    def _slow(self, address, count=1):
+        time.sleep(READ_DELAY_S)
+        return _get_values(self, address, count)
+    monkeypatch.setattr(bench._RampBlock, 'getValues', _slow)
+
+@pytest.fixture
+def fieldbus_factory():
+    _started = []
+    def _start(devices:list[dict]) -> FieldBus:
+        ret = FieldBus(devices, 16, 8)
+        ret.start()
+        _started.append(ret)
+        _wait_connected(ret)
+        return ret
+    yield _start
+    for bus in _started:
+        bus.stop()
+
+@pytest.fixture
+def slaves():
+    _started = []
+    def _start(devices:list[dict], **kwargs) -> SimulatedSlave:
+        ret = SimulatedSlave(devices, **kwargs)
+        ret.start()
+        _started.append(ret)
+        return ret
+    yield _start
+    for slave in _started:
+        if slave._thread is not None:
+            slave.stop()
+
+def test_buses_are_polled_concurrently(slaves, fieldbus_factory, slow_reads):
+    _devices = [{'name': 'a', 'slave': 1, 'ai': [0, 8], 'ao': [0, 4]}, {'name': 'b', 'slave': 1, 'ai': [8, 8], 'ao': [4, 4]}]
+    _a = slaves(_devices[:1])
+    _b = slaves(_devices[1:])
+    _fieldbus = fieldbus_factory(_a.config_devices(_devices[:1]) + _b.config_devices(_devices[1:]))
+    assert len(_fieldbus.buses) == 2
+    _fieldbus.poll(2.0)
+    _started = time.perf_counter()
+    for _ in range(5):
+        _result = _fieldbus.poll(2.0)
+        assert _result.ok and _result.stale == 0
+    # one read per bus and tick: the slower bus, not the sum of both
+    assert (time.perf_counter() - _started) / 5 < READ_DELAY_S * 1.6
+
+def test_slaves_on_one_bus_are_merged_into_one_frame(slaves, fieldbus_factory):
+    _devices = [{'name': 'trio', 'slave': 1, 'ai': [0, 8], 'ao': [0, 4]}, {'name': 'quartet', 'slave': 2, 'ai': [8, 8], 'ao': [4, 4]}]
+    _slave = slaves(_devices)
+    _fieldbus = fieldbus_factory([dict(d, pool_size=1) for d in _slave.config_devices(_devices)])
+    assert len(_fieldbus.lanes) == 1
+    _result = _fieldbus.poll(2.0)
+    assert _result.ok and _result.stale == 0
+    _ai = _result.ai_raw.astype(np.int64)
+    # the ramp of each slave: register i holds (reads * (i+1)) & 0x7fff
+    for _first in (0, 8):
+        assert _ai[_first] > 0
+        assert _ai[_first:_first+8].tolist() == [(_ai[_first] * (i+1)) & 0x7fff for i in range(8)]
+    assert _result.time_ns <= time.time_ns()
+
+def test_device_that_stops_answering_is_stale(slaves, fieldbus_factory):
+    _devices = [{'name': 'trio', 'slave': 1, 'ai': [0, 8], 'ao': [0, 4]}, {'name': 'quartet', 'slave': 2, 'ai': [8, 8], 'ao': [4, 4]}]
+    _slave = slaves(_devices)
+    _fieldbus = fieldbus_factory([dict(d, pool_size=1, timeout=0.2) for d in _slave.config_devices(_devices)])
+    _result = _fieldbus.poll(2.0)
+    assert _result.stale == 0
+    _held = _result.ai_raw[8:].copy()
+    # unit 2 no longer answers, unit 1 on the same connection still does
+    del _slave._context[2]
+    for _ in range(2):
+        _result = _fieldbus.poll(2.0)
+        assert _result.ok
+        assert _result.stale == 1 << 1
+        assert np.array_equal(_result.ai_raw[8:], _held)
+    assert _fieldbus.error_counts()['read_errors'] >= 2
+
+def _lane_sockets(bus:FieldBus) -> list:
+    return [lane.client.socket.getsockname() for lane in bus.lanes]
+
+@pytest.mark.parametrize('mode', ['TCP', 'RTU_OVER_TCP'])
+def test_connections_are_reused_across_ticks(slaves, fieldbus_factory, mode):
+    _devices = [{'name': 'trio', 'slave': 1, 'ai': [0, 8], 'ao': [0, 4]}, {'name': 'quartet', 'slave': 2, 'ai': [8, 8], 'ao': [4, 4]}]
+    _slave = slaves(_devices, mode=mode)
+    _fieldbus = fieldbus_factory(_slave.config_devices(_devices))
+    # pool_size 2: one connection per slave
+    assert len(_fieldbus.lanes) == 2
+    _sockets = _lane_sockets(_fieldbus)
+    _last = None
+    for _ in range(20):
+        _result = _fieldbus.poll(2.0)
+        assert _result.ok and _result.stale == 0
+        # RTU framing over TCP: the replies decode to the ramp of each unit
+        assert _result.ai_raw[1] == (_result.ai_raw[0] * 2) & 0x7fff
+        assert _result.ai_raw[9] == (_result.ai_raw[8] * 2) & 0x7fff
+        if _last is not None:
+            assert _result.ai_raw[0] == _last + 1
+        _last = int(_result.ai_raw[0])
+    assert _lane_sockets(_fieldbus) == _sockets
+    assert _fieldbus.error_counts() == {'read_errors': 0, 'write_errors': 0, 'disconnects': 0, 'busy_skips': 0}
+
+def test_reconnect_after_server_restart_does_not_block_the_tick(slaves, fieldbus_factory, monkeypatch):
+    monkeypatch.setattr(fieldbus, 'MODBUS_RECONNECT_INTERVAL', 0.1)
+    _devices = [{'name': 'trio', 'slave': 1, 'ai': [0, 8], 'ao': [0, 4]}]
+    _slave = slaves(_devices)
+    _fieldbus = fieldbus_factory([dict(d, timeout=0.2) for d in _slave.config_devices(_devices)])
+    assert _fieldbus.poll(2.0).stale == 0
+    _slave.stop()
+    # while the server is gone every tick returns within its budget, all stale
+    _started = time.perf_counter()
+    for _ in range(10):
+        _result = _fieldbus.poll(0.3)
+        assert _result.stale == 1
+    assert time.perf_counter() - _started < 10 * 0.3
+    assert _fieldbus.error_counts()['disconnects'] == 1
+    slaves(_devices, port=_slave.port)
+    _deadline = time.perf_counter() + 5.0
+    while _fieldbus.poll(0.3).stale:
+        assert time.perf_counter() < _deadline, 'not reconnected'
+        time.sleep(0.05)
+    assert _fieldbus.poll(0.3).ok
+
+def _holding(slave:SimulatedSlave, unit:int, count:int) -> list[int]:
+    return slave._context[unit].getValues(3, 0, count)
+
+def _record(monkeypatch, lane) -> list:
+    # order of the lane's Modbus requests: ('read', address) / ('write', values)
+    ret = []
+    _read, _write_ao = lane._read, lane._write_ao
+    def _recording_read(dev, request):
+        ret.append(('read', request.address))
+        return _read(dev, request)
+    def _recording_write_ao(ao_raw):
+        ret.append(('write', list(ao_raw)))
+        return _write_ao(ao_raw)
+    monkeypatch.setattr(lane, '_read', _recording_read)
+    monkeypatch.setattr(lane, '_write_ao', _recording_write_ao)
+    return ret
+
+def _ao(value:int) -> list[int]:
+    return [value + i for i in range(8)]
+
+def test_ao_write_goes_ahead_of_queued_reads_and_collapses(slaves, fieldbus_factory, monkeypatch):
+    _devices = [{'name': 'trio', 'slave': 1, 'ai': [0, 8], 'ao': [0, 4]}]
+    _slave = slaves(_devices)
+    _fieldbus = fieldbus_factory(_slave.config_devices(_devices))
+    _lane = _fieldbus.lanes[0]
+    _calls = _record(monkeypatch, _lane)
+    # hold the lane, queue a read, then a burst of setpoints
+    _gate = threading.Event()
+    _lane.submit(_gate.wait)
+    _read = _lane.trigger_read()
+    for i in range(10):
+        _fieldbus.write_ao(_ao(100 * i))
+    _gate.set()
+    _read.result(2.0)
+    assert _calls == [('write', _ao(900)), ('read', 0)]
+    assert _fieldbus.ao_counts() == {'requested': 10, 'written': 1}
+    assert _holding(_slave, 1, 4) == _ao(900)[:4]
+
+def test_ao_write_lands_between_the_reads_of_a_poll(slaves, fieldbus_factory, monkeypatch):
+    _slave = slaves([{'name': 'wide', 'slave': 1, 'ai': [0, 60], 'ao': [0, 4]}])
+    # two reads per poll: max_gap 0 keeps the entries apart
+    _fieldbus = fieldbus_factory([{'name': 'wide', 'mode': 'TCP', 'host': bench.BENCH_HOST, 'port': _slave.port, 'slave': 1, 'max_gap': 0, 'ai': [0, 4], 'ao': [0, 4],
+                                   'registers': [{'ai': 4, 'address': 50, 'count': 2}]}])
+    _lane = _fieldbus.lanes[0]
+    _calls = _record(monkeypatch, _lane)
+    _read = _lane._read
+    def _read_then_setpoint(dev, request):
+        ret = _read(dev, request)
+        if request.address == 0:
+            _fieldbus.write_ao(_ao(7))
+        return ret
+    monkeypatch.setattr(_lane, '_read', _read_then_setpoint)
+    assert _fieldbus.poll(2.0).stale == 0
+    assert _calls == [('read', 0), ('write', _ao(7)), ('read', 50)]
+
+def test_outputs_are_rewritten_after_reconnect(slaves, fieldbus_factory, monkeypatch):
+    monkeypatch.setattr(fieldbus, 'MODBUS_RECONNECT_INTERVAL', 0.1)
+    _devices = [{'name': 'trio', 'slave': 1, 'ai': [0, 8], 'ao': [0, 4]}, {'name': 'quartet', 'slave': 2, 'ai': [8, 8], 'ao': [4, 4]}]
+    _slave = slaves(_devices)
+    _fieldbus = fieldbus_factory([dict(d, timeout=0.2) for d in _slave.config_devices(_devices)])
+    _fieldbus.write_ao(_ao(40))
+    _deadline = time.perf_counter() + 2.0
+    while _holding(_slave, 2, 4) != _ao(40)[4:]:
+        assert time.perf_counter() < _deadline, 'not written'
+        time.sleep(0.02)
+    assert _holding(_slave, 1, 4) == _ao(40)[:4]
+    _slave.stop()
+    for _ in range(3):
+        _fieldbus.poll(0.3)
+    # a new server on the same port: a power-cycled gateway, outputs back at 0
+    _restarted = slaves(_devices, port=_slave.port)
+    _deadline = time.perf_counter() + 5.0
+    while _holding(_restarted, 1, 4) != _ao(40)[:4] or _holding(_restarted, 2, 4) != _ao(40)[4:]:
+        assert time.perf_counter() < _deadline, 'outputs not rewritten'
+        _fieldbus.poll(0.3)
+    assert _fieldbus.ao_counts()['requested'] == 2
@@ -0,0 +1,78 @@
+import threading, time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from core import LoggerCore
+
+@pytest.fixture
+def client(tmp_path):
+    # routes on an app of its own, the class-level app stays free for a real server
+    _core = LoggerCore(str(tmp_path / 'config.json'))
+    _core._bg_webserver_create_hub()
+    _app = FastAPI()
+    _core._bg_webserver_add_routes(_app)
+    with TestClient(_app) as _client:
+        yield _core, _client
+
+def _new_frame(core:LoggerCore, value:int):
+    core.aio.set_ai_raw_all([value] * len(core.aio.get_ai_raw_all()))
+    core._ws_hub.request_wake()
+
+def test_etag_and_not_modified(client):
+    _core, _client = client
+    _res = _client.get('/latest')
+    assert _res.status_code == 200
+    _etag = _res.headers['ETag']
+    _seq = int(_res.headers['X-Frame-Seq'])
+    assert _res.json()
+
+    _res = _client.get('/latest', headers={'If-None-Match': _etag})
+    assert _res.status_code == 304
+    assert _res.headers['ETag'] == _etag
+    assert not _res.content
+    assert _client.get('/latest', headers={'If-None-Match': 'W/"0-0", %s'%_etag}).status_code == 304
+    assert _client.get('/latest', headers={'If-None-Match': '*'}).status_code == 304
+
+    _new_frame(_core, 100)
+    _res = _client.get('/latest', headers={'If-None-Match': _etag})
+    assert _res.status_code == 200
+    assert _res.headers['ETag'] != _etag
+    assert int(_res.headers['X-Frame-Seq']) > _seq
+    assert _core._metric_latest[304].value == 3
+    assert _core._metric_latest[200].value == 2
+
+def test_long_poll_returns_on_new_frame(client):
+    _core, _client = client
+    _seq = int(_client.get('/latest').headers['X-Frame-Seq'])
+    _timer = threading.Timer(0.2, _new_frame, (_core, 200))
+    _timer.start()
+    _t0 = time.monotonic()
+    _res = _client.get('/latest', params={'wait_for_seq': _seq, 'timeout': 5})
+    _elapsed = time.monotonic() - _t0
+    _timer.join()
+    assert _res.status_code == 200
+    assert int(_res.headers['X-Frame-Seq']) > _seq
+    assert 0.15 < _elapsed < 2.0
+    assert _core._ws_hub.num_waiters == 0
+
+def test_long_poll_times_out_with_current_frame(client):
+    _core, _client = client
+    _res = _client.get('/latest')
+    _seq = int(_res.headers['X-Frame-Seq'])
+    _t0 = time.monotonic()
+    _res = _client.get('/latest', params={'wait_for_seq': _seq, 'timeout': 0.3}, headers={'If-None-Match': _res.headers['ETag']})
+    _elapsed = time.monotonic() - _t0
+    assert _res.status_code == 304
+    assert int(_res.headers['X-Frame-Seq']) == _seq
+    assert 0.25 < _elapsed < 2.0
+    assert _core._ws_hub.num_waiters == 0
+
+def test_long_poll_behind_returns_at_once(client):
+    _core, _client = client
+    _new_frame(_core, 300)
+    _t0 = time.monotonic()
+    _res = _client.get('/latest', params={'wait_for_seq': -1, 'timeout': 5})
+    assert _res.status_code == 200
+    assert time.monotonic() - _t0 < 1.0
@@ -0,0 +1,91 @@
+import re
+
+import pytest
+
+from metrics import MetricsRegistry, LatencyHistogram
+
+# name{labels} value, as in the text exposition format 0.0.4
+SAMPLE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(?P<labels>.*)\})? (?P<value>\S+)$')
+LABEL = re.compile(r'(?P<key>[a-zA-Z_][a-zA-Z0-9_]*)="(?P<value>(?:[^"\\]|\\.)*)"(?:,|$)')
+
+def _parse(text:str) -> tuple[dict, dict, list]:
+    # ({family: type}, {family: help}, [(name, {label: value}, value)])
+    _types, _helps, _samples = {}, {}, []
+    assert text.endswith('\n')
+    for _line in text.splitlines():
+        if _line.startswith('# TYPE '):
+            _name, _type = _line[7:].split(' ')
+            assert _name not in _types
+            _types[_name] = _type
+        elif _line.startswith('# HELP '):
+            _name, _help = _line[7:].split(' ', 1)
+            _helps[_name] = _help
+        else:
+            _match = SAMPLE.match(_line)
+            assert _match, _line
+            _labels = {m['key']: m['value'] for m in LABEL.finditer(_match['labels'] or '')}
+            _samples.append((_match['name'], _labels, float(_match['value'])))
+    return _types, _helps, _samples
+
+def test_exposition_format():
+    _registry = MetricsRegistry('t_')
+    _hist = _registry.histogram('stage_seconds', 'Latency of one stage', {'stage': 'poll'})
+    for _seconds in (3E-5, 3E-5, 0.002, 0.04, 20.0):
+        _hist.observe(_seconds)
+    _registry.histogram('stage_seconds', 'Latency of one stage', {'stage': 'idle'})
+    _registry.counter('responses_total', 'Responses', {'status': '200'}).inc(3)
+    _registry.counter('responses_total', 'Responses', {'status': '304'})
+    _registry.counter('odd_total', '', {'path': 'C:\\data "x"'}, source=lambda: 7)
+    _registry.gauge('queue_depth', 'Waiting', lambda: 2)
+
+    _types, _helps, _samples = _parse(_registry.prometheus())
+    assert _types == {'t_stage_seconds': 'histogram', 't_responses_total': 'counter', 't_odd_total': 'counter', 't_queue_depth': 'gauge'}
+    assert _helps == {'t_stage_seconds': 'Latency of one stage', 't_responses_total': 'Responses', 't_queue_depth': 'Waiting'}
+    _values = {(n, tuple(sorted(l.items()))): v for n, l, v in _samples}
+    assert _values[('t_responses_total', (('status', '200'),))] == 3.0
+    assert _values[('t_responses_total', (('status', '304'),))] == 0.0
+    assert _values[('t_odd_total', (('path', 'C:\\\\data \\"x\\"'),))] == 7.0
+    assert _values[('t_queue_depth', ())] == 2.0
+
+    _buckets = [(l['le'], v) for n, l, v in _samples if n == 't_stage_seconds_bucket' and l['stage'] == 'poll']
+    assert _buckets[-1] == ('+Inf', 5)
+    _bounds = [float(le) for le, _ in _buckets]
+    assert _bounds == sorted(_bounds)
+    _counts = [v for _, v in _buckets]
+    assert _counts == sorted(_counts)
+    assert dict(_buckets)[repr(5E-5)] == 2 and dict(_buckets)[repr(0.0025)] == 3 and dict(_buckets)['10.0'] == 4
+    assert _values[('t_stage_seconds_count', (('stage', 'poll'),))] == 5
+    assert _values[('t_stage_seconds_sum', (('stage', 'poll'),))] == pytest.approx(20.04206)
+    assert _values[('t_stage_seconds_count', (('stage', 'idle'),))] == 0
+
+def test_same_family_and_labels_return_the_same_metric():
+    _registry = MetricsRegistry()
+    assert _registry.histogram('a', labels={'x': 1}) is _registry.histogram('a', labels={'x': 1})
+    with pytest.raises(ValueError):
+        _registry.counter('a')
+
+def test_quantiles_are_bucket_bounds():
+    _hist = LatencyHistogram((0.001, 0.01, 0.1))
+    for _ in range(90):
+        _hist.observe(0.0005)
+    for _ in range(10):
+        _hist.observe(0.05)
+    assert _hist.quantile(0.5) == 0.001
+    assert _hist.quantile(0.99) == 0.05
+    assert _hist.stats()['count'] == 100
+    _hist.reset()
+    assert _hist.quantile(0.5) == 0.0
+
+def test_cores_do_not_share_metrics(tmp_path):
+    from core import LoggerCore
+    _a = LoggerCore(str(tmp_path / 'a.json'))
+    _b = LoggerCore(str(tmp_path / 'b.json'))
+    assert _a._metrics is not _b._metrics
+    _a._log_rows_closed[0] += 10
+    _a._metric_stage['sql_flush'].observe(0.001)
+
+    def _value(core, name):
+        return [v for n, _, v in _parse(core._metrics.prometheus())[2] if n == name]
+    assert _value(_a, 'msl_rows_written_total') == [10]
+    assert _value(_b, 'msl_rows_written_total') == [0]
+    assert _value(_a, 'msl_stage_seconds_count') != _value(_b, 'msl_stage_seconds_count')
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from params import ParamEngine
+
+def _engine(*exprs:str) -> ParamEngine:
+    return ParamEngine(list(exprs) + ['']*(4 - len(exprs)), num_ai=4, num_ao=2)
+
+def _evaluate(engine:ParamEngine, ai:list[list[float]]) -> np.ndarray:
+    _ai = np.array(ai, dtype=np.float64)
+    _rows = len(_ai)
+    return engine.evaluate(_ai, np.zeros((_rows, 2)), np.arange(_rows, dtype=np.float64), np.zeros((_rows, 4)), np.zeros(4))
+
+@pytest.mark.parametrize('expr', ['sin()', 'sin(ai_phy_0, 1)', 'atan2(ai_phy_0)', 'where(ai_phy_0)', 'clip(ai_phy_0, 1)', 'min(ai_phy_0)', 'round(ai_phy_0, 1, 2)', 'round(ai_phy_0, ai_phy_1)', 'mavg(ai_phy_0)', 'integ(ai_phy_0, 1)'])
+def test_wrong_arity_is_rejected_at_compile_time(expr):
+    with pytest.raises(ValueError, match='param_0'):
+        _engine(expr)
+
+@pytest.mark.parametrize('expr, expected', [
+    ('atan2(ai_phy_0, ai_phy_1)', np.arctan2(1.5, -2.0)),
+    ('round(ai_phy_0, 1)', 1.5),
+    ('round(ai_phy_1)', -2.0),
+    ('min(ai_phy_0, 1)', 1.0),
+    ('clip(ai_phy_1, -1, 1)', -1.0),
+    ('where(ai_phy_0 > 0, 10, 20)', 10.0),
+    ('10 if ai_phy_1 > 0 else 20', 20.0),
+])
+def test_valid_calls(expr, expected):
+    assert _evaluate(_engine(expr), [[1.5, -2.0, 0.0, 0.0]])[0, 0] == pytest.approx(expected)
+
+def test_nan_stays_in_its_channel():
+    _engine_ = _engine('ai_phy_0 * 2', 'ai_phy_1 + 1', 'max(ai_phy_0, ai_phy_1)')
+    with np.errstate(invalid='ignore'):
+        _out = _evaluate(_engine_, [[np.nan, 3.0, 0.0, 0.0], [1.0, 3.0, 0.0, 0.0]])
+    assert np.isnan(_out[0, 0])
+    assert _out[0, 1] == 4.0
+    assert np.isnan(_out[0, 2])
+    assert _out[1].tolist() == [2.0, 4.0, 3.0, 0.0]
+
+def test_nan_from_the_expression_is_a_value_not_an_error():
+    with np.errstate(invalid='ignore', divide='ignore'):
+        _out = _evaluate(_engine('sqrt(ai_phy_0)', 'ai_phy_2 / ai_phy_3'), [[-1.0, 0.0, 0.0, 0.0]])
+    assert np.isnan(_out[0, 0])
+    assert np.isnan(_out[0, 1])
+
+def test_live_step_matches_batch():
+    _exprs = ('ai_phy_0 + ai_phy_1', 'integ(param_0)', 'mavg(ai_phy_0, 3)')
+    _ai = [[float(i), 1.0, 0.0, 0.0] for i in range(10)]
+    _batch = _evaluate(_engine(*_exprs), _ai)
+    _live = _engine(*_exprs)
+    _param = np.zeros(4)
+    for i, _row in enumerate(_ai):
+        _param = np.array(_live.step(np.array(_row), np.zeros(2), _param, float(i)))
+        assert _param == pytest.approx(_batch[i])
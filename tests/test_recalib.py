@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from channels import calc_phy
+from recalib import recalibrate
+from rollup import RollupWriter, RollupReader
+from storage import SessionReader
+from conftest import make_frames, write_session
+
+AI_CALIB = {3: (1E-4, 2.0, -5.0), 15: (0.0, -0.5, 100.0)}
+AO_CALIB = {1: (0.0, 0.01, 1.0)}
+COLUMNS = ['ai_raw_3', 'ai_raw_15', 'ao_raw_1', 'ai_phy_3', 'ai_phy_15', 'ao_phy_1', 'ai_phy_0']
+
+def _session(tmp_path) -> tuple[str, list]:
+    # 0.25 s apart: several rows per 1 s rollup bucket
+    _frames = make_frames(1000, interval_ns=250_000_000)
+    _path = str(tmp_path / 'session.sqlite3')
+    write_session(RollupWriter(_path, flush_interval_ms=10, flush_rows=100), _frames)
+    return _path, _frames
+
+def _read(path:str) -> dict:
+    with SessionReader(path) as _reader:
+        _values = np.concatenate([v for _, v in _reader.iter_arrays(COLUMNS)])
+    return {c: _values[:, i] for i, c in enumerate(COLUMNS)}
+
+def test_phy_matches_calc_phy(tmp_path):
+    _path, _frames = _session(tmp_path)
+    ret = recalibrate(_path, AI_CALIB, AO_CALIB, chunk_rows=333)
+    assert ret['rows'] == len(_frames)
+    assert ret['columns'] == ['ai_phy_3', 'ai_phy_15', 'ao_phy_1']
+    _read_ = _read(_path)
+    for _kind, _calib in (('ai', AI_CALIB), ('ao', AO_CALIB)):
+        for ch, (a, b, c) in _calib.items():
+            _expected = calc_phy(_read_['%s_raw_%d'%(_kind, ch)], a, b, c).astype(np.float64)
+            assert np.array_equal(_read_['%s_phy_%d'%(_kind, ch)], _expected), (_kind, ch)
+    # channels without a new calibration keep their values
+    assert np.array_equal(_read_['ai_phy_0'], [f.ai_phy[0] for f in _frames])
+
+def test_rollups_follow_new_phy(tmp_path):
+    _path, _frames = _session(tmp_path)
+    recalibrate(_path, AI_CALIB, chunk_rows=128)
+    _phy = _read(_path)['ai_phy_3']
+    _phy_0 = np.array([f.ai_phy[0] for f in _frames], dtype=np.float64)
+    _keys = np.array([f.time_ns for f in _frames]) // 1_000_000_000
+    with RollupReader(_path) as _reader:
+        _levels = _reader.levels
+        _rollup = _reader.read(1, ['ai_phy_3', 'ai_phy_0'])
+    assert _levels
+    assert _rollup['count'].sum() == len(_frames)
+    for i, _bucket in enumerate(_rollup['bucket']):
+        _in = _keys == _bucket
+        assert _rollup['min'][i, 0] == _phy[_in].min()
+        assert _rollup['max'][i, 0] == _phy[_in].max()
+        assert _rollup['mean'][i, 0] == pytest.approx(_phy[_in].mean())
+        assert _rollup['last'][i, 0] == _phy[_in][-1]
+        # untouched channel, rebuilt to the same values
+        assert _rollup['mean'][i, 1] == pytest.approx(_phy_0[_in].mean())
+
+def test_out_path_leaves_source(tmp_path):
+    _path, _ = _session(tmp_path)
+    _before = _read(_path)
+    _out = str(tmp_path / 'recalibrated.sqlite3')
+    ret = recalibrate(_path, AI_CALIB, out_path=_out)
+    assert ret['path'] == _out and ret['catalog'] is False
+    _after = _read(_path)
+    for c in COLUMNS:
+        assert np.array_equal(_after[c], _before[c]), c
+    assert not np.array_equal(_read(_out)['ai_phy_3'], _before['ai_phy_3'])
+    with pytest.raises(FileExistsError):
+        recalibrate(_path, AI_CALIB, out_path=_out)
+
+@pytest.mark.parametrize('ai, ao, chunk_rows', [({}, {}, 100), ({16: (0, 1, 0)}, {}, 100), ({0: (1, 2)}, {}, 100), ({}, {8: (0, 1, 0)}, 100), ({0: (0, 1, 0)}, {}, 0)])
+def test_invalid_arguments(tmp_path, ai, ao, chunk_rows):
+    _path, _ = _session(tmp_path)
+    with pytest.raises(ValueError):
+        recalibrate(_path, ai, ao, chunk_rows=chunk_rows)
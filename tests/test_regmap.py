@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from fieldbus import ModbusDevice
+from regmap import RegisterEntry, plan_reads, plan_writes, max_gap_registers, REGMAP_MAX_READ_REGISTERS
+
+def _ai(channel:int, address:int, count:int=1, **kwargs) -> RegisterEntry:
+    return RegisterEntry(dict({'ai': channel, 'address': address, 'count': count}, **kwargs), 'ai')
+
+def _spans(requests) -> list[tuple[int, int]]:
+    return [(r.address, r.count) for r in requests]
+
+def test_entries_within_max_gap_are_merged():
+    _entries = [_ai(0, 0, 4), _ai(4, 10, 2), _ai(6, 30, 2)]
+    assert _spans(plan_reads(_entries, 6)) == [(0, 12), (30, 2)]
+    assert _spans(plan_reads(_entries, 18)) == [(0, 32)]
+    assert plan_reads(_entries, 18)[0].gap == 32 - 8
+    assert _spans(plan_reads(_entries, 0)) == [(0, 4), (10, 2), (30, 2)]
+    # negative: never merge, not even adjacent entries
+    assert _spans(plan_reads([_ai(0, 0, 2), _ai(2, 2, 2)], -REGMAP_MAX_READ_REGISTERS)) == [(0, 2), (2, 2)]
+
+def test_requests_stay_within_the_register_limit():
+    _entries = [_ai(i * 10, i * 10, 10) for i in range(16)]
+    _requests = plan_reads(_entries, REGMAP_MAX_READ_REGISTERS)
+    assert all(r.count <= REGMAP_MAX_READ_REGISTERS for r in _requests)
+    assert _spans(_requests) == [(0, 120), (120, 40)]
+    # every channel read exactly once
+    assert sorted(c for r in _requests for c in r.channels) == list(range(160))
+    with pytest.raises(ValueError):
+        plan_reads([_ai(0, 0, 63, type='float32')], 0)
+
+def test_tables_are_planned_separately():
+    _entries = [_ai(0, 0, 2, fc=3), _ai(2, 2, 2, fc=4), _ai(4, 0, 8, fc=2, type='bool')]
+    assert sorted((r.fc, r.address, r.count) for r in plan_reads(_entries, 10)) == [(2, 0, 8), (3, 0, 2), (4, 2, 2)]
+
+def test_max_gap_from_the_line_speed():
+    # a round trip costs more register times on a faster line; TCP merges anything
+    assert max_gap_registers('TCP', 38400) == REGMAP_MAX_READ_REGISTERS
+    assert max_gap_registers('RTU', 9600) < max_gap_registers('RTU', 115200)
+    assert max_gap_registers('ASCII', 9600) == max_gap_registers('RTU', 9600)
+
+def test_rejected_gap_splits_the_read_for_good():
+    _dev = ModbusDevice(0, {'port': 'COM1', 'max_gap': 20, 'registers': [{'ai': 0, 'address': 0, 'count': 4}, {'ai': 4, 'address': 10, 'count': 2}, {'ai': 6, 'address': 100, 'count': 1}]})
+    assert _spans(_dev.reads) == [(0, 12), (100, 1)]
+    _dev.split_read(_dev.reads[0])
+    assert sorted(_spans(_dev.reads)) == [(0, 4), (10, 2), (100, 1)]
+    # a single entry that is refused has nothing to split
+    _single = [r for r in _dev.reads if r.address == 100][0]
+    _dev.split_read(_single)
+    assert sorted(_spans(_dev.reads)) == [(0, 4), (10, 2), (100, 1)]
+
+def _words(values, dtype:str, word_order:str='big') -> list[int]:
+    _words = np.asarray(values, dtype=dtype).view('>u2').reshape(len(values), -1)
+    return (_words[:, ::-1] if word_order == 'little' else _words).reshape(-1).tolist()
+
+@pytest.mark.parametrize('word_order', ['big', 'little'])
+def test_float32_decoding_with_scale(word_order):
+    _entry = _ai(0, 0, 3, type='float32', word_order=word_order, scale=100.0, offset=5.0)
+    _request = plan_reads([_entry], 0)[0]
+    assert _request.count == 6
+    assert _request.decode(_words([1.5, -2.25, 0.014], '>f4', word_order)).tolist() == [155, -220, 6]
+
+def test_word_order_of_32_bit_integers():
+    _big = plan_reads([_ai(0, 0, 2, type='int32')], 0)[0]
+    _little = plan_reads([_ai(0, 0, 2, type='int32', word_order='little')], 0)[0]
+    # 70000 does not fit int16: identity only applies to 16 bit types, this saturates
+    assert _big.decode(_words([-3, 70000], '>i4')).tolist() == [-3, 32767]
+    assert _little.decode(_words([-3, -70000], '>i4', 'little')).tolist() == [-3, -32768]
+
+def test_scale_and_offset_saturate():
+    _request = plan_reads([_ai(0, 0, 4, type='float32', scale=1000.0)], 0)[0]
+    assert _request.decode(_words([1E6, -1E6, np.nan, 12.3456], '>f4')).tolist() == [32767, -32768, 0, 12346]
+    _uint = plan_reads([_ai(0, 0, 2, type='uint16', offset=-40000.0)], 0)[0]
+    assert _uint.decode([65535, 0]).tolist() == [25535, -32768]
+
+def test_16_bit_registers_are_taken_bit_for_bit():
+    _request = plan_reads([_ai(0, 0, 2), _ai(2, 2, 2, type='uint16')], 0)[0]
+    assert _request.decode([0xffff, 0x7fff, 0x8000, 1]).tolist() == [-1, 32767, -32768, 1]
+
+def test_merged_read_decodes_each_entry_at_its_offset():
+    _entries = [_ai(0, 0, 2), _ai(5, 4, 1, type='float32', scale=10.0), _ai(2, 10, 3, fc=4, type='int16')]
+    _request = plan_reads(_entries, 10)[0]
+    assert _spans([_request]) == [(0, 13)]
+    _data = [10, 20, 0, 0] + _words([2.5], '>f4') + [0] * 4 + [-1 & 0xffff, 7, 8]
+    _raw = np.zeros(8, dtype=np.int16)
+    _raw[_request.channels] = _request.decode(_data)
+    assert _raw.tolist() == [10, 20, -1, 7, 8, 25, 0, 0]
+
+def test_writes_never_fill_gaps():
+    _entries = [RegisterEntry({'ao': 0, 'address': 0, 'count': 2}, 'ao'), RegisterEntry({'ao': 2, 'address': 3, 'count': 1, 'type': 'float32', 'scale': 10.0}, 'ao')]
+    _writes = plan_writes(_entries)
+    assert [(w.address, w.count) for w in _writes] == [(0, 2), (3, 2)]
+    assert _writes[1].encode([0, 0, 25]) == _words([2.5], '>f4')
@@ -0,0 +1,34 @@
+import numpy as np
+
+from channels import NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM
+from ringbuffer import FrameRingBuffer, frame_column
+from conftest import make_frames
+
+def _buffer(capacity:int, count:int) -> FrameRingBuffer:
+    ret = FrameRingBuffer(capacity, NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM)
+    for frame in make_frames(count):
+        ret.append(frame)
+    return ret
+
+def test_copy_windows_after_wrap_around():
+    _buf = _buffer(100, 250)
+    assert len(_buf) == 100
+    assert _buf.copy_window_by_seq()['seq'].tolist() == list(range(150, 250))
+    assert _buf.copy_window_by_seq(240)['seq'].tolist() == list(range(240, 250))
+    _frames = make_frames(250)
+    assert _buf.copy_window_by_time(_frames[195].time_ns, _frames[205].time_ns)['seq'].tolist() == list(range(195, 205))
+    assert len(_buf.copy_window_by_seq(1000)) == 0
+
+def test_copy_drops_rows_overwritten_while_copying():
+    _buf = _buffer(100, 250)
+    # what a reader sees when the writer lands on the oldest slot mid-copy
+    _buf._buf[250 % 100]['seq'] = 250
+    assert _buf.copy_window_by_seq()['seq'].tolist() == list(range(151, 250))
+
+def test_frame_column_names_match_the_session_columns():
+    _frames = make_frames(20)
+    _rows = _buffer(100, 20).copy_window_by_seq()
+    assert np.array_equal(frame_column(_rows, 'ai_raw_3'), [f.ai_raw[3] for f in _frames])
+    assert np.array_equal(frame_column(_rows, 'ao_phy_7'), [f.ao_phy[7] for f in _frames])
+    assert np.array_equal(frame_column(_rows, 'param_phy_0'), [f.param[0] for f in _frames])
+    assert np.array_equal(frame_column(_rows, 'mono_ns'), [f.mono_ns for f in _frames])
@@ -0,0 +1,48 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from rollup import RollupWriter, RollupReader, rebuild_rollups, rollup_columns, ROLLUP_LEVELS, ROLLUP_STATS
+from conftest import make_frames, write_session
+
+def _read_all(path:str) -> dict:
+    with RollupReader(path) as _reader:
+        assert _reader.levels == ROLLUP_LEVELS
+        return {s: _reader.read(s, rollup_columns()) for s in _reader.levels}
+
+@pytest.mark.parametrize('flush_rows', [1, 37, 5000])
+def test_rebuild_matches_incremental(tmp_path, flush_rows):
+    # 0.37 s apart: buckets of every level are split across flushes
+    _frames = make_frames(2000, interval_ns=370_000_000)
+    _frames[5] = _frames[5]._replace(ai_phy=np.full(16, np.nan, dtype=np.float32))
+    _live = str(tmp_path / 'live.sqlite3')
+    write_session(RollupWriter(_live, flush_interval_ms=10, flush_rows=flush_rows), _frames)
+    _rebuilt = str(tmp_path / 'rebuilt.sqlite3')
+    shutil.copyfile(_live, _rebuilt)
+    assert rebuild_rollups(_rebuilt, chunk_rows=333) == len(_frames)
+
+    _expected = _read_all(_live)
+    _actual = _read_all(_rebuilt)
+    for _level in ROLLUP_LEVELS:
+        for _key in ('bucket', 'time', 'count', 'first_id', 'last_id'):
+            assert np.array_equal(_actual[_level][_key], _expected[_level][_key]), (_level, _key)
+        for _stat in ROLLUP_STATS:
+            np.testing.assert_allclose(_actual[_level][_stat], _expected[_level][_stat], rtol=1E-12, equal_nan=True, err_msg='%d %s'%(_level, _stat))
+    assert _expected[60]['count'].sum() == len(_frames)
+
+def test_rollup_values(tmp_path):
+    _frames = make_frames(300, interval_ns=100_000_000)
+    _path = str(tmp_path / 'live.sqlite3')
+    write_session(RollupWriter(_path, flush_interval_ms=10, flush_rows=64), _frames)
+    with RollupReader(_path) as _reader:
+        _read = _reader.read(1, ['ai_raw_3', 'param_phy_0'])
+    _raw = np.array([f.ai_raw[3] for f in _frames], dtype=np.float64)
+    _keys = np.array([f.time_ns for f in _frames]) // 1_000_000_000
+    for i, _bucket in enumerate(_read['bucket']):
+        _in = _keys == _bucket
+        assert _read['count'][i] == _in.sum()
+        assert _read['min'][i, 0] == _raw[_in].min()
+        assert _read['max'][i, 0] == _raw[_in].max()
+        assert _read['mean'][i, 0] == pytest.approx(_raw[_in].mean())
+        assert _read['last'][i, 0] == _raw[_in][-1]
@@ -0,0 +1,98 @@
+import queue, threading
+
+import pytest
+
+import scheduler
+from scheduler import CommandQueue, TickScheduler
+
+def _drain(commands:CommandQueue) -> list:
+    ret = []
+    while True:
+        try:
+            ret.append(commands.get_nowait())
+        except queue.Empty:
+            return ret
+
+def test_ao_send_is_served_first_fifo_otherwise():
+    _commands = CommandQueue({'ao_send': 0}, ('ao_send', 'ai_receive'))
+    for cmd in ('ai_receive', 'start', 'ao_send', 'stop'):
+        _commands.put(cmd)
+    assert _drain(_commands) == ['ao_send', 'ai_receive', 'start', 'stop']
+
+def test_waiting_setpoints_collapse_into_one():
+    _commands = CommandQueue({'ao_send': 0}, ('ao_send',))
+    for _ in range(5):
+        _commands.put('ao_send')
+        _commands.put('start')
+    assert _commands.qsize() == 6
+    assert _commands.collapsed == 4
+    assert _drain(_commands) == ['ao_send'] + ['start'] * 5
+    # once taken, the next request is queued again
+    _commands.put('ao_send')
+    assert _drain(_commands) == ['ao_send']
+
+def test_get_blocks_until_put_or_timeout():
+    _commands = CommandQueue()
+    with pytest.raises(queue.Empty):
+        _commands.get(timeout=0.05)
+    threading.Timer(0.05, _commands.put, ('stop',)).start()
+    assert _commands.get(timeout=2.0) == 'stop'
+
+class _Clock():
+    # perf_counter of the scheduler, moved by the test and by the callbacks
+    def __init__(self):
+        self.now = 100.0
+
+    def perf_counter(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    _clock = _Clock()
+    monkeypatch.setattr(scheduler, 'time', _clock)
+    return _clock
+
+def _run_until(ticks:TickScheduler, clock:_Clock, end:float, late:float=0.0):
+    # what the owner thread does: sleep for timeout(), wake up a little late, run
+    while clock.now < end:
+        clock.now += ticks.timeout() + late
+        ticks.run_due()
+
+def test_long_call_does_not_shift_the_grid(clock):
+    _starts = []
+    def _job():
+        _starts.append(clock.now)
+        # the fifth tick blocks for 3.5 intervals, e.g. a Modbus timeout
+        clock.now += 0.035 if len(_starts) == 5 else 0.001
+    _ticks = TickScheduler()
+    _ticks.add_job('poll', 10, _job)
+    _ticks.start_job('poll')
+    _t0 = clock.now
+    _run_until(_ticks, clock, _t0 + 1.0)
+    _stats = _ticks.stats()['poll']
+    # ticks 5..7 are skipped, not run back to back, and the rest stays on the grid
+    assert _stats['overruns'] == 1
+    assert _stats['missed'] == 3
+    _slots = [round((s - _t0) / 0.010, 6) for s in _starts]
+    assert _slots[:5] == [0, 1, 2, 3, 4]
+    assert _slots[5:8] == [8, 9, 10]
+    assert all(s == int(s) for s in _slots)
+    assert _stats['ticks'] == len(_starts) == 101 - 3
+
+def test_late_wakeups_do_not_accumulate(clock):
+    _starts = []
+    _ticks = TickScheduler()
+    _ticks.add_job('poll', 10, lambda: _starts.append(clock.now))
+    _ticks.add_job('save', 25, lambda: None)
+    _ticks.start_job('poll')
+    _ticks.start_job('save')
+    _t0 = clock.now
+    # every wakeup 2 ms late, a relative sleep would drift by that each tick
+    _run_until(_ticks, clock, _t0 + 1.0, late=0.002)
+    _offsets = [(s - _t0) % 0.010 for s in _starts]
+    assert min(_offsets) == pytest.approx(0.002, abs=1E-6) and max(_offsets) == pytest.approx(0.002, abs=1E-6)
+    assert len(_starts) == 101
+    _stats = _ticks.stats()
+    assert _stats['poll']['missed'] == _stats['poll']['overruns'] == 0
+    assert _stats['poll']['jitter_max_us'] == pytest.approx(2000, abs=1)
+    assert _stats['save']['ticks'] == 41
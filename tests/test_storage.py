@@ -0,0 +1,95 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from channels import NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM
+from columnar import ColumnarWriter, ColumnarReader
+from storage import SqlWriter, FrameDecimator, FrameGap
+from conftest import make_frames
+
+MISSING = [10, 11, 12, 13, 20, 29]
+
+def _sql_gaps(path:str) -> list[tuple]:
+    _conn = sqlite3.connect(path)
+    try:
+        return _conn.execute('SELECT seq, frames FROM gaps ORDER BY seq').fetchall()
+    finally:
+        _conn.close()
+
+@pytest.mark.parametrize('backend', ['sqlite', 'columnar'])
+@pytest.mark.parametrize('flush_rows', [1, 3, 1000])
+def test_gap_rows_merge_across_flushes(tmp_path, backend, flush_rows):
+    if backend == 'sqlite':
+        _writer = SqlWriter(str(tmp_path / 's.sqlite3'), flush_interval_ms=10, flush_rows=flush_rows)
+    else:
+        _writer = ColumnarWriter(str(tmp_path / 's.msl'), NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM, flush_interval_ms=10, flush_rows=flush_rows)
+    _frames = make_frames(30)
+    _writer.start()
+    for frame in _frames:
+        if frame.seq in MISSING:
+            assert _writer.put_gap(frame.seq, frame.time_ns, frame.mono_ns)
+        else:
+            assert _writer.put(frame)
+    _writer.stop()
+    assert _writer.rows_written == 30 - len(MISSING)
+    assert _writer.frames_missed == len(MISSING)
+    if backend == 'sqlite':
+        assert _sql_gaps(_writer.path) == [(10, 4), (20, 1), (29, 1)]
+        return
+    with ColumnarReader(_writer.path) as _reader:
+        assert _reader.gaps == [FrameGap(10, 4, _frames[10].time_ns, _frames[10].mono_ns, _frames[13].time_ns), FrameGap(20, 1, _frames[20].time_ns, _frames[20].mono_ns, _frames[20].time_ns),
+                                FrameGap(29, 1, _frames[29].time_ns, _frames[29].mono_ns, _frames[29].time_ns)]
+        assert len(_reader) == 30 - len(MISSING)
+
+def _decimate(decimator:FrameDecimator, frames:list) -> list:
+    ret = [f for frame in frames for f in decimator.push(frame)]
+    _last = decimator.flush()
+    return ret + ([_last] if _last is not None else [])
+
+def test_every_keeps_the_first_frame_of_each_block():
+    _frames = [f for f in make_frames(20) if f.seq not in (0, 7, 8)]
+    assert [f.seq for f in _decimate(FrameDecimator(4, 'every'), _frames)] == [1, 4, 9, 12, 16]
+    # seq aligned blocks: a missing frame does not shift the phase
+    assert [f.seq for f in _decimate(FrameDecimator(5, 'every'), make_frames(20))] == [0, 5, 10, 15]
+
+def test_mean_averages_each_block():
+    _frames = make_frames(10)
+    _frames[5] = _frames[5]._replace(stale=0b100)
+    _frames[6] = _frames[6]._replace(stale=0b001)
+    _out = _decimate(FrameDecimator(4, 'mean'), [f for f in _frames if f.seq != 2])
+    assert [f.seq for f in _out] == [0, 4, 8]
+    for _out_frame, _block in zip(_out, ([0, 1, 3], [4, 5, 6, 7], [8, 9])):
+        _in = [_frames[i] for i in _block]
+        assert _out_frame.ai_raw.dtype == np.int16
+        assert np.array_equal(_out_frame.ai_raw, np.rint(np.mean([f.ai_raw for f in _in], axis=0)).astype(np.int16))
+        assert np.allclose(_out_frame.ai_phy, np.mean([f.ai_phy for f in _in], axis=0))
+        assert np.allclose(_out_frame.param, np.mean([f.param for f in _in], axis=0))
+        assert _out_frame.time_ns == sum(f.time_ns for f in _in) // len(_in)
+    assert [f.stale for f in _out] == [0, 0b101, 0]
+
+def test_mean_block_is_written_when_complete():
+    _decimator = FrameDecimator(3, 'mean')
+    _frames = make_frames(6)
+    assert _decimator.push(_frames[0]) == [] and _decimator.push(_frames[1]) == []
+    assert [f.seq for f in _decimator.push(_frames[2])] == [0]
+    # block 1 misses its last frame: written when block 2 starts
+    assert _decimator.push(_frames[3]) == []
+    assert [f.seq for f in _decimator.push(_frames[5]._replace(seq=6))] == [3]
+    assert _decimator.flush().seq == 6
+    assert _decimator.flush() is None
+
+def test_decimated_writer_output(tmp_path):
+    _writer = SqlWriter(str(tmp_path / 's.sqlite3'), flush_interval_ms=10, flush_rows=7)
+    _writer.set_decimation(10, 'mean')
+    _writer.start()
+    for frame in make_frames(95):
+        _writer.put(frame)
+    # stop() writes out the open block 90..94
+    _writer.stop()
+    _conn = sqlite3.connect(_writer.path)
+    _rows = _conn.execute('SELECT seq, ai_raw_0 FROM data ORDER BY id').fetchall()
+    _conn.close()
+    _frames = make_frames(95)
+    assert [r[0] for r in _rows] == list(range(0, 95, 10))
+    assert [r[1] for r in _rows] == [int(np.rint(np.mean([f.ai_raw[0] for f in _frames[s:s+10]]))) for s in range(0, 95, 10)]
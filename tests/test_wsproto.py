@@ -0,0 +1,157 @@
+import json
+
+import numpy as np
+
+from broadcast import BroadcastHub
+from channels import NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM
+from wsproto import FrameCodec, HEADER, MSG_FRAME, MSG_DELTA
+from conftest import make_frames
+
+def _codec() -> FrameCodec:
+    return FrameCodec(NUM_CH_AI, NUM_CH_AO, NUM_CH_PARAM)
+
+class _Client():
+    # what a subscriber does with the metadata layout: full frames replace the
+    # state, deltas patch the channels set in each field's bitmask
+    def __init__(self, layout:dict):
+        self.layout = layout
+        self.state = None
+
+    def decode(self, msg:bytes) -> dict:
+        _type, _, _meta_version, _seq, _time_ns, _stale = HEADER.unpack_from(msg)
+        ret = {'meta_version': _meta_version, 'seq': _seq, 'time_ns': _time_ns, 'stale': _stale}
+        if _type == MSG_FRAME:
+            assert len(msg) == self.layout['frame_size']
+            for f in self.layout['fields']:
+                ret[f['name']] = np.frombuffer(msg, dtype=f['dtype'], count=f['count'], offset=f['offset']).copy()
+        else:
+            assert _type == MSG_DELTA and self.state is not None
+            _pos = self.layout['header_size']
+            for f in self.layout['fields']:
+                _bytes = (f['count'] + 7) // 8
+                _mask = np.unpackbits(np.frombuffer(msg, dtype=np.uint8, count=_bytes, offset=_pos), bitorder='little')[:f['count']].astype(bool)
+                _pos += _bytes
+                _n = int(_mask.sum())
+                _values = self.state[f['name']].copy()
+                _values[_mask] = np.frombuffer(msg, dtype=f['dtype'], count=_n, offset=_pos)
+                _pos += _n * np.dtype(f['dtype']).itemsize
+                ret[f['name']] = _values
+            assert _pos == len(msg)
+        self.state = ret
+        return ret
+
+def _assert_frame(decoded:dict, frame):
+    assert (decoded['seq'], decoded['time_ns'], decoded['stale']) == (frame.seq, frame.time_ns, frame.stale)
+    for name in ('ai_raw', 'ao_raw', 'ai_phy', 'ao_phy', 'param'):
+        assert np.array_equal(decoded[name], np.asarray(getattr(frame, name)).astype(decoded[name].dtype), equal_nan=decoded[name].dtype.kind == 'f')
+
+def _stream(count:int) -> list:
+    # a few channels change per frame, as on a real bench
+    _frames = make_frames(count)
+    ret = [_frames[0]]
+    for frame in _frames[1:]:
+        _prev = ret[-1]
+        _ai_raw = _prev.ai_raw.copy()
+        _ai_raw[frame.seq % NUM_CH_AI] = frame.ai_raw[0]
+        ret.append(frame._replace(ai_raw=_ai_raw, ai_phy=(_ai_raw * 0.5).astype(np.float32), ao_raw=_prev.ao_raw, ao_phy=_prev.ao_phy))
+    return ret
+
+def test_keyframe_round_trip():
+    _codec_ = _codec()
+    _frame = make_frames(3)[2]._replace(stale=(1 << 62) | 0b101)
+    _frame.ai_phy[4] = np.nan
+    _msg = _codec_.encode(_frame, 0x12345)
+    assert len(_msg) == _codec_.frame_size
+    _decoded = _Client(_codec_.layout()).decode(_msg)
+    assert _decoded['meta_version'] == 0x2345
+    _assert_frame(_decoded, _frame)
+
+def test_delta_round_trip():
+    _codec_ = _codec()
+    _client = _Client(_codec_.layout())
+    _frames = _stream(50)
+    _frames[20] = _frames[20]._replace(stale=0b10)
+    _frames[21] = _frames[21]._replace(stale=0b10)
+    _assert_frame(_client.decode(_codec_.encode(_frames[0], 1)), _frames[0])
+    for _prev, _frame in zip(_frames, _frames[1:]):
+        _msg = _codec_.encode_delta(_frame, _prev, 1)
+        # one ai_raw and its ai_phy changed, param always changes
+        assert len(_msg) < _codec_.frame_size
+        _assert_frame(_client.decode(_msg), _frame)
+
+def test_unchanged_frame_is_only_header_and_masks():
+    _codec_ = _codec()
+    _frame = make_frames(1)[0]
+    _msg = _codec_.encode_delta(_frame._replace(seq=1, stale=1), _frame, 0)
+    assert len(_msg) == HEADER.size + sum((f['count'] + 7) // 8 for f in _codec_.layout()['fields'])
+    _client = _Client(_codec_.layout())
+    _client.decode(_codec_.encode(_frame, 0))
+    _assert_frame(_client.decode(_msg), _frame._replace(seq=1, stale=1))
+
+def test_client_joining_mid_stream():
+    _codec_ = _codec()
+    _frames = _stream(30)
+    _current = [_frames[0]]
+    _meta = (3, json.dumps({'layout': _codec_.layout()}))
+    _hub = BroadcastHub(lambda: _current[0], lambda f: json.dumps({'seq': f.seq}), _codec_, lambda: _meta, queue_size=100)
+    # the stream is already running when the first client connects
+    _hub._publish()
+    _early = _hub.subscribe('delta')
+    for _frame in _frames[1:15]:
+        _current[0] = _frame
+        _hub._publish()
+    _late = _hub.subscribe('delta')
+    for _frame in _frames[15:]:
+        _current[0] = _frame
+        _hub._publish()
+    for _sub, _expected in ((_early, _frames), (_late, _frames[14:])):
+        _messages = [_sub.queue.get_nowait() for _ in range(_sub.queue.qsize())]
+        # metadata first, then a full frame, then deltas on top of it
+        assert _messages[0] == _meta[1]
+        _client = _Client(json.loads(_messages[0])['layout'])
+        _types = [HEADER.unpack_from(m)[0] for m in _messages[1:]]
+        assert _types == [MSG_FRAME] + [MSG_DELTA] * (len(_expected) - 1)
+        for _msg, _frame in zip(_messages[1:], _expected):
+            _decoded = _client.decode(_msg)
+            assert _decoded['meta_version'] == 3
+            _assert_frame(_decoded, _frame)
+
+def test_slow_client_drops_to_latest():
+    _codec_ = _codec()
+    _frames = _stream(40)
+    _current = [_frames[0]]
+    _meta = (1, json.dumps({'layout': _codec_.layout()}))
+    _hub = BroadcastHub(lambda: _current[0], lambda f: json.dumps({'seq': f.seq}), _codec_, lambda: _meta, queue_size=4)
+    _hub._publish()
+    _fast = _hub.subscribe('delta')
+    _slow = _hub.subscribe('delta')
+    _slow_json = _hub.subscribe('json')
+    _fast_client = _Client(json.loads(_fast.queue.get_nowait())['layout'])
+    _received = [_fast_client.decode(_fast.queue.get_nowait())]
+    for _frame in _frames[1:]:
+        _current[0] = _frame
+        _hub._publish()
+        # never more than the bound, whatever the slow clients do
+        assert _slow.queue.qsize() <= 4 and _slow_json.queue.qsize() <= 4
+        while not _fast.queue.empty():
+            _received.append(_fast_client.decode(_fast.queue.get_nowait()))
+    # the client that keeps up is not affected by the ones that do not
+    assert [r['seq'] for r in _received] == [f.seq for f in _frames]
+    assert _fast.dropped == 0
+    assert _slow.dropped > 0 and _slow_json.dropped > 0
+    assert _hub.dropped == _slow.dropped + _slow_json.dropped
+
+    # json: only recent frames are left, the newest last
+    _seqs = [json.loads(_slow_json.queue.get_nowait())['seq'] for _ in range(_slow_json.queue.qsize())]
+    assert _seqs[-1] == _frames[-1].seq and len(_seqs) <= 4
+    assert _seqs == sorted(_seqs)
+
+    # delta: after the drop the client gets metadata and a full frame again,
+    # so it decodes the latest frame without the deltas it missed
+    _messages = [_slow.queue.get_nowait() for _ in range(_slow.queue.qsize())]
+    assert _messages[0] == _meta[1]
+    _client = _Client(json.loads(_messages[0])['layout'])
+    assert HEADER.unpack_from(_messages[1])[0] == MSG_FRAME
+    for _msg in _messages[1:]:
+        _decoded = _client.decode(_msg)
+    _assert_frame(_decoded, _frames[-1])
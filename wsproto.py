@@ -0,0 +1,62 @@
+import struct
+
+import numpy as np
+
+WS_FORMATS = ('json', 'binary', 'delta')
+WS_SUBPROTOCOLS = {'msl.json.v1': 'json', 'msl.binary.v1': 'binary', 'msl.delta.v1': 'delta'}
+
+MSG_FRAME = 1
+MSG_DELTA = 2
+
+# type, reserved, meta_version (low 16 bits), padding, seq, time_ns, stale
+HEADER = struct.Struct('<BBH4xQqQ')
+
+class FrameCodec():
+    # Packed little-endian frames for the binary websocket protocol.
+    # binary: header + every field in FIELDS order.
+    # delta:  header + for each field a bitmask (ceil(count/8) bytes, LSB first) of
+    #         the channels that changed since the previous frame, followed by only
+    #         those values.
+    FIELDS = (('ai_raw', '<i2'), ('ao_raw', '<u2'), ('ai_phy', '<f4'), ('ao_phy', '<f4'), ('param', '<f4'))
+
+    def __init__(self, num_ai:int, num_ao:int, num_param:int):
+        _counts = {'ai_raw': num_ai, 'ao_raw': num_ao, 'ai_phy': num_ai, 'ao_phy': num_ao, 'param': num_param}
+        self._fields = []
+        _offset = HEADER.size
+        for name, dtype in self.FIELDS:
+            _dtype = np.dtype(dtype)
+            self._fields.append((name, _dtype, _counts[name], _offset))
+            _offset += _dtype.itemsize * _counts[name]
+        self.frame_size = _offset
+
+    def layout(self) -> dict:
+        return {
+            'byteorder': 'little',
+            'header': [['type', 'u1'], ['reserved', 'u1'], ['meta_version', 'u2'], ['padding', '4x'], ['seq', 'u8'], ['time_ns', 'i8'], ['stale', 'u8']],
+            'header_size': HEADER.size,
+            'frame_type': MSG_FRAME,
+            'delta_type': MSG_DELTA,
+            'fields': [{'name': name, 'dtype': dtype.str, 'count': count, 'offset': offset} for name, dtype, count, offset in self._fields],
+            'frame_size': self.frame_size,
+        }
+
+    def _header(self, buf, msg_type:int, frame, meta_version:int):
+        HEADER.pack_into(buf, 0, msg_type, 0, meta_version & 0xffff, frame.seq, frame.time_ns, frame.stale)
+
+    def encode(self, frame, meta_version:int) -> bytes:
+        _buf = bytearray(self.frame_size)
+        self._header(_buf, MSG_FRAME, frame, meta_version)
+        for name, dtype, count, offset in self._fields:
+            np.frombuffer(_buf, dtype=dtype, count=count, offset=offset)[:] = getattr(frame, name)
+        return bytes(_buf)
+
+    def encode_delta(self, frame, prev, meta_version:int) -> bytes:
+        _header = bytearray(HEADER.size)
+        self._header(_header, MSG_DELTA, frame, meta_version)
+        _parts = [bytes(_header)]
+        for name, dtype, count, offset in self._fields:
+            _cur = getattr(frame, name)
+            _changed = _cur != getattr(prev, name)
+            _parts.append(np.packbits(_changed, bitorder='little').tobytes())
+            _parts.append(_cur[_changed].astype(dtype).tobytes())
+        return b''.join(_parts)